@@ -7,151 +7,316 @@ Usage:
  1. Set `API_KEY` and `API_SECRET` environment variables
  2. `import api`
  3. call methods, eg `api.get_trades()`
+
+For several accounts, create a `Client` per account with explicit credentials, eg
+`api.Client(key, secret, name='shop').get_trades()`, and use `fetch_accounts()` to call them concurrently.
+Every client has its own rate limiter and nonce sequence.
+
+Requests go through a pooled session and are rate limited on the client side to
+`COINTRACKING_API_CALLS_PER_HOUR` (default 20) calls per hour. Throttled and failed requests are retried.
+
+Responses can be cached on disk: set `COINTRACKING_API_CACHE_DIR` or call `enable_cache()`.
 """
 import os
-import time
 import logging
-import hashlib
-import hmac
-import urllib.parse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
+import profiling
+from cache import ResponseCache
+from transport import Transport
 
 
 log = logging.getLogger(__name__)
 
-API_URL = 'https://cointracking.info/api/v1/'
+API_URL = os.environ.get('COINTRACKING_API_URL', 'https://cointracking.info/api/v1/')
 
-API_KEY = os.environ['COINTRACKING_API_KEY']
-API_SECRET = os.environ['COINTRACKING_API_SECRET'].encode('utf-8')
+API_KEY = os.environ.get('COINTRACKING_API_KEY')
+API_SECRET = os.environ.get('COINTRACKING_API_SECRET')
 
+API_CALLS_PER_HOUR = float(os.environ.get('COINTRACKING_API_CALLS_PER_HOUR', 20))
 
-def _api_call(api_method, **kwargs):
-    payload = {}
+_client = None
+_client_lock = threading.Lock()
+_cache = None
 
-    # Copy over any argument that's none None (None would use API default).
-    for key in kwargs.keys():
-        if kwargs[key] is not None:
-            payload[key] = kwargs[key]
 
-    payload['method'] = api_method
-    payload['nonce'] = int(time.time() * 1000)
+class Client(object):
+    """
+    API client for one account. Each client has its own transport, so its own rate limiter and nonce sequence.
+    """
 
-    payload_bytes = urllib.parse.urlencode(payload).encode('utf8')
-    signed_payload = hmac.new(API_SECRET, payload_bytes, hashlib.sha512).hexdigest()
+    def __init__(self, key, secret, name=None, url=API_URL, calls_per_hour=API_CALLS_PER_HOUR, cache=None,
+                 **transport_options):
+        """
+        @param key: API key
+        @type key: str
+        @param secret: API secret
+        @type secret: str|bytes
+        @param name: Name of the account, used to tag its trades when merging accounts. Default is the key.
+        @type name: str
+        @param url: API url
+        @type url: str
+        @param calls_per_hour: Request quota of the API key.
+        @type calls_per_hour: float
+        @param cache: Cache for the responses. Several clients can share a cache.
+        @type cache: ResponseCache
+        @param transport_options: Further options of `Transport`, eg `max_retries`.
+        """
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        self.name = name if name is not None else key
+        self.cache = cache
+        self.transport = Transport(url, key, secret, calls_per_hour=calls_per_hour, **transport_options)
 
-    headers = {
-        'Key': API_KEY,
-        'Sign': signed_payload,
-    }
+    def __repr__(self):
+        return 'Client({})'.format(self.name)
 
-    r = requests.post(API_URL, headers=headers, data=payload)
-    return r.json()
+    def _api_call(self, api_method, **kwargs):
+        with profiling.stage('api.' + api_method) as stage:
+            cache = self.cache
+            # Responses of different accounts must not be mixed up in a shared cache.
+            cache_params = dict(kwargs, api_key=self.transport.key)
+            if cache is not None:
+                response = cache.get(api_method, cache_params)
+                if response is not None:
+                    stage.add(cache_hits=1)
+                    return response
 
+            response = self.transport.call(api_method, **kwargs)
 
-def get_trades(limit=None, order=None, start_time=None, end_time=None):
+            if cache is not None:
+                cache.put(api_method, cache_params, response)
+            return response
+
+    def get_trades(self, limit=None, order=None, start_time=None, end_time=None):
+        """
+        Returns all your CoinTracking trades and transactions.
+        Similar to the 'Trade List' on the website.
+        @param limit: Number of trades. `None` will use API default (all).
+        @type limit: int
+        @param order: Trade ordering. `None` will use API default (by time, ascending).
+        @type order: str
+        @param start_time: Only list trades after this time. `None` will use API default (no start time).
+        @type start_time: int
+        @param end_time: Only list trades before this time.`None` will use API default (no end time).
+        @type end_time: int
+        @return: result as dict
+        @rtype: dict
+        """
+        return self._api_call('getTrades', limit=limit, order=order, start_time=start_time, end_time=end_time)
+
+    def get_balance(self):
+        """
+        Returns your current CoinTracking account and coin balance.
+        Similar to the `Current Balance` on the website.
+        @return: result as dict
+        @rtype: dict
+        """
+        return self._api_call('getBalance')
+
+    def get_historical_summary(self, show_as_btc=None, start_time=None, end_time=None):
+        """
+        Returns all historical values for all your coins, currencies, commodities, and the total account value.
+        Similar to the `Daily Balance` or the `Trade Statistics` on the website.
+        @param show_as_btc: True to show values in BTC, False to show values in fiat currency. `None` will use API
+                            default.
+        @type show_as_btc: bool
+        @param start_time: Only list trades after this time. `None` will use API default (no start time).
+        @type start_time: int
+        @param end_time: Only list trades before this time.`None` will use API default (no end time).
+        @type end_time: int
+        @return: result as dict
+        @rtype: dict
+        """
+        btc = 1 if show_as_btc else 0
+        return self._api_call('getHistoricalSummary', btc=btc, start_time=start_time, end_time=end_time)
+
+    def get_historical_currency(self, currency=None, start_time=None, end_time=None):
+        """
+        Returns all historical amounts and values for a specific currency/coin or for all currencies/coins.
+        Similar to the `Daily Balance` or the `Trade Statistics` on the website.
+        @param currency: Load only values of this currency/coin (e.g. ETH). `None` will use API default (load
+                         historical values for all currencies/coins).
+        @type currency: str
+        @param start_time: Only list trades after this time. `None` will use API default (no start time).
+        @type start_time: int
+        @param end_time: Only list trades before this time.`None` will use API default (no end time).
+        @type end_time: int
+        @return: result as dict
+        @rtype: dict
+        """
+        return self._api_call('getHistoricalCurrency', currency=currency, start_time=start_time, end_time=end_time)
+
+    # noinspection PyShadowingBuiltins
+    def get_grouped_balance(self, group=None, exclude_movements=None, type=None):
+        """
+        Returns the current balance grouped by exchange, trade-group or transaction type.
+        Similar to the `Balance by Exchange` on the website.
+        @param group: Field to group by, either `exchange`, `group` or `type`. `None` will use API default
+                      (exchange).
+        @type group: str
+        @param exclude_movements: Set to True to exclude account movements (deposits/withdrawals). Excluding
+                                  movements is recommended. `None` will use API default (True).
+        @type exclude_movements: bool
+        @param type: `None` to calculate all transaction types. Set a type to calculate the balance for a specific
+                     type. Possible types: `Trade`, `Deposit`, `Withdrawal`, `Income`, `Mining`, `Gift/Tip(In)`,
+                                           `Spend`, `Donation`, `Gift(Out)`, `Stolen`, `Lost`
+        @type type: str
+        @return: result as dict
+        @rtype: dict
+        """
+        exclude_dep_with = 1 if exclude_movements else 0
+        return self._api_call('getGroupedBalance', group=group, exclude_dep_with=exclude_dep_with, type=type)
+
+    def get_gains(self, method=None, price=None, exclude_movements=None, cost_basis=None, show_as_btc=None):
+        """
+        Returns your current realized and unrealized gains data.
+        Similar to the `Realized and Unrealized Gains` on the website.
+        Setting parameters to `None` will use API defaults, which depends on your account setting.
+        @param method: Possible methods: FIFO, LIFO, HIFO, LOFO, HPFO, LPFO, HAFO, LAFO.
+        @type method: str
+        @param price: Possible values: best, transaction, counterpart
+        @type price: str
+        @param exclude_movements: Set to True to exclude account movements (deposits/withdrawals). Excluding
+                                  movements is recommended. `None` will use API default (True).
+        @type exclude_movements: bool
+        @param cost_basis: Possible values: unsold (recommended) and all
+        @type cost_basis: str
+        @param show_as_btc: True to show values in BTC, False to show values in fiat currency. `None` will use API
+                            default.
+        @type show_as_btc: bool
+        @return: result as dict
+        @rtype: dict
+        """
+        exclude_dep_with = 1 if exclude_movements else 0
+        btc = 1 if show_as_btc else 0
+        return self._api_call('getGains', method=method, price=price, exclude_dep_with=exclude_dep_with,
+                              costbasis=cost_basis, btc=btc)
+
+
+def fetch_accounts(clients, api_method='get_trades', max_workers=None, **kwargs):
+    """
+    Calls the same API method for several accounts concurrently. Each account is limited by its own rate limiter.
+    @param clients: Clients of the accounts.
+    @type clients: iterable<Client>
+    @param api_method: Name of the `Client` method, eg `get_trades`.
+    @type api_method: str
+    @param max_workers: Maximum number of concurrent calls. Default is one per account.
+    @type max_workers: int
+    @param kwargs: Parameters of the method.
+    @return: responses by account name
+    @rtype: OrderedDict
+    """
+    clients = list(clients)
+    if not clients:
+        return OrderedDict()
+    with ThreadPoolExecutor(max_workers=max_workers or len(clients)) as executor:
+        futures = [(client.name, executor.submit(getattr(client, api_method), **kwargs)) for client in clients]
+        return OrderedDict((name, future.result()) for name, future in futures)
+
+
+def default_client():
+    """
+    Returns the client for the credentials in the `COINTRACKING_API_KEY` and `COINTRACKING_API_SECRET`
+    environment variables, which is used by the module functions.
+    @rtype: Client
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            if API_KEY is None or API_SECRET is None:
+                raise KeyError("Set COINTRACKING_API_KEY and COINTRACKING_API_SECRET, or use api.Client")
+            _client = Client(API_KEY, API_SECRET, calls_per_hour=API_CALLS_PER_HOUR, cache=_cache)
+        return _client
+
+
+def enable_cache(directory, max_bytes=100 * 1024 * 1024, ttls=None):
+    """
+    Enables caching of API responses on disk for the module functions.
+    @param directory: Directory to store responses in.
+    @type directory: str
+    @param max_bytes: Maximum size of the cache. Least recently used responses are evicted first.
+    @type max_bytes: int
+    @param ttls: Time to live per API method in seconds, eg `{'getBalance': 60}`. See `cache.DEFAULT_TTLS`.
+    @type ttls: dict
+    @return: the cache, which can also be passed to other clients
+    @rtype: ResponseCache
     """
-    Returns all your CoinTracking trades and transactions.
-    Similar to the 'Trade List' on the website.
-    @param limit: Number of trades. `None` will use API default (all).
-    @type limit: int
-    @param order: Trade ordering. `None` will use API default (by time, ascending).
-    @type order: str
-    @param start_time: Only list trades after this time. `None` will use API default (no start time).
-    @type start_time: int
-    @param end_time: Only list trades before this time.`None` will use API default (no end time).
-    @type end_time: int
-    @return: result as dict
+    global _cache
+    _cache = ResponseCache(directory, max_bytes=max_bytes, ttls=ttls)
+    if _client is not None:
+        _client.cache = _cache
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = None
+    if _client is not None:
+        _client.cache = None
+
+
+def cache_stats():
+    """
+    Returns hit/miss statistics of the cache, or None if caching is disabled.
     @rtype: dict
     """
-    return _api_call('getTrades', limit=limit, order=order, start_time=start_time, end_time=end_time)
+    return _cache.stats() if _cache is not None else None
+
+
+if os.environ.get('COINTRACKING_API_CACHE_DIR'):
+    enable_cache(os.environ['COINTRACKING_API_CACHE_DIR'])
+
+
+def _api_call(api_method, **kwargs):
+    return default_client()._api_call(api_method, **kwargs)
+
+
+def get_trades(limit=None, order=None, start_time=None, end_time=None):
+    """
+    Returns all your CoinTracking trades and transactions. See `Client.get_trades`.
+    """
+    return default_client().get_trades(limit=limit, order=order, start_time=start_time, end_time=end_time)
 
 
 def get_balance():
     """
-    Returns your current CoinTracking account and coin balance.
-    Similar to the `Current Balance` on the website.
-    @return: result as dict
-    @rtype: dict
+    Returns your current CoinTracking account and coin balance. See `Client.get_balance`.
     """
-    return _api_call('getBalance')
+    return default_client().get_balance()
 
 
 def get_historical_summary(show_as_btc=None, start_time=None, end_time=None):
     """
     Returns all historical values for all your coins, currencies, commodities, and the total account value.
-    Similar to the `Daily Balance` or the `Trade Statistics` on the website.
-    @param show_as_btc: True to show values in BTC, False to show values in fiat currency. `None` will use API default.
-    @type show_as_btc: bool
-    @param start_time: Only list trades after this time. `None` will use API default (no start time).
-    @type start_time: int
-    @param end_time: Only list trades before this time.`None` will use API default (no end time).
-    @type end_time: int
-    @return: result as dict
-    @rtype: dict
+    See `Client.get_historical_summary`.
     """
-    btc = 1 if show_as_btc else 0
-    return _api_call('getHistoricalSummary', btc=btc, start_time=start_time, end_time=end_time)
+    return default_client().get_historical_summary(show_as_btc=show_as_btc, start_time=start_time,
+                                                   end_time=end_time)
 
 
 def get_historical_currency(currency=None, start_time=None, end_time=None):
     """
     Returns all historical amounts and values for a specific currency/coin or for all currencies/coins.
-    Similar to the `Daily Balance` or the `Trade Statistics` on the website.
-    @param currency: Load only values of this currency/coin (e.g. ETH). `None` will use API default (load historical
-                     values for all currencies/coins).
-    @type currency: str
-    @param start_time: Only list trades after this time. `None` will use API default (no start time).
-    @type start_time: int
-    @param end_time: Only list trades before this time.`None` will use API default (no end time).
-    @type end_time: int
-    @return: result as dict
-    @rtype: dict
+    See `Client.get_historical_currency`.
     """
-    return _api_call('getHistoricalCurrency', currency=currency, start_time=start_time, end_time=end_time)
+    return default_client().get_historical_currency(currency=currency, start_time=start_time, end_time=end_time)
 
 
 # noinspection PyShadowingBuiltins
 def get_grouped_balance(group=None, exclude_movements=None, type=None):
     """
     Returns the current balance grouped by exchange, trade-group or transaction type.
-    Similar to the `Balance by Exchange` on the website.
-    @param group: Field to group by, either `exchange`, `group` or `type`. `None` will use API default (exchange).
-    @type group: str
-    @param exclude_movements: Set to True to exclude account movements (deposits/withdrawals). Excluding
-                              movements is recommended. `None` will use API default (True).
-    @type exclude_movements: bool
-    @param type: `None` to calculate all transaction types. Set a type to calculate the balance for a specific type.
-                 Possible types: `Trade`, `Deposit`, `Withdrawal`, `Income`, `Mining`, `Gift/Tip(In)`,
-                                 `Spend`, `Donation`, `Gift(Out)`, `Stolen`, `Lost`
-    @type type: str
-    @return: result as dict
-    @rtype: dict
+    See `Client.get_grouped_balance`.
     """
-    exclude_dep_with = 1 if exclude_movements else 0
-    return _api_call('getGroupedBalance', group=group, exclude_dep_with=exclude_dep_with, type=type)
+    return default_client().get_grouped_balance(group=group, exclude_movements=exclude_movements, type=type)
 
 
 def get_gains(method=None, price=None, exclude_movements=None, cost_basis=None, show_as_btc=None):
     """
-    Returns your current realized and unrealized gains data.
-    Similar to the `Realized and Unrealized Gains` on the website.
-    Setting parameters to `None` will use API defaults, which depends on your account setting.
-    @param method: Possible methods: FIFO, LIFO, HIFO, LOFO, HPFO, LPFO, HAFO, LAFO.
-    @type method: str
-    @param price: Possible values: best, transaction, counterpart
-    @type price: str
-    @param exclude_movements: Set to True to exclude account movements (deposits/withdrawals). Excluding
-                              movements is recommended. `None` will use API default (True).
-    @type exclude_movements: bool
-    @param cost_basis: Possible values: unsold (recommended) and all
-    @type cost_basis: str
-    @param show_as_btc: True to show values in BTC, False to show values in fiat currency. `None` will use API default.
-    @type show_as_btc: bool
-    @return: result as dict
-    @rtype: dict
+    Returns your current realized and unrealized gains data. See `Client.get_gains`.
     """
-    exclude_dep_with = 1 if exclude_movements else 0
-    btc = 1 if show_as_btc else 0
-    return _api_call('getGains', method=method, price=price, exclude_dep_with=exclude_dep_with,
-                     costbasis=cost_basis, btc=btc)
+    return default_client().get_gains(method=method, price=price, exclude_movements=exclude_movements,
+                                      cost_basis=cost_basis, show_as_btc=show_as_btc)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent, time-sharded fetching of trades.
+
+Splits the requested time range into windows, fetches them concurrently (within the rate limit of the
+transport) and merges the results. Windows that return too many records are split further.
+
+Usage:
+ 1. `import async_api`
+ 2. `async_api.get_trades(start_time=..., end_time=...)` returns the same structure as `api.get_trades()`
+"""
+import asyncio
+import functools
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import api
+
+
+log = logging.getLogger(__name__)
+
+# There are no trades before the bitcoin genesis block.
+EARLIEST_TIME = 1230940800
+
+
+class ShardError(Exception):
+    """
+    Raised if the API returned an error for a shard.
+    """
+    pass
+
+
+async def _fetch_window(loop, executor, semaphore, get_trades, start_time, end_time, shard_limit):
+    """
+    Fetches a single window, splitting it in two if the API returned as many records as requested.
+    A window with `end_time` None is open-ended: it includes trades dated in the future.
+    @return: list of (key, trade) tuples
+    @rtype: list
+    """
+    async with semaphore:
+        # Widen the window by a second as the API might exclude its bounds. Duplicates are removed later.
+        response = await loop.run_in_executor(executor, functools.partial(
+            get_trades, limit=shard_limit, start_time=max(start_time - 1, 0),
+            end_time=end_time + 1 if end_time is not None else None))
+
+    if response.get('success') != 1:
+        raise ShardError("API returned an error for {}-{}: {}".format(
+            start_time, end_time, response.get('error_msg', response)))
+
+    items = [(key, trade) for key, trade in response.items() if key not in ('success', 'method')]
+    if len(items) < shard_limit:
+        return items
+    if end_time is None:
+        # Trades come ordered by time: the window is complete up to the last trade returned, the rest is after it.
+        last_time = max(max(int(trade['time']) for key, trade in items), start_time)
+        log.debug("Window %d- is full, splitting at %d", start_time, last_time)
+        parts = await asyncio.gather(
+            _fetch_window(loop, executor, semaphore, get_trades, start_time, last_time, shard_limit),
+            _fetch_window(loop, executor, semaphore, get_trades, last_time + 1, None, shard_limit))
+        return parts[0] + parts[1]
+    if end_time - start_time <= 1:
+        log.warning("More than %d trades between %d and %d, result might be truncated",
+                    shard_limit, start_time, end_time)
+        return items
+
+    middle = (start_time + end_time) // 2
+    log.debug("Window %d-%d is full, splitting", start_time, end_time)
+    halves = await asyncio.gather(
+        _fetch_window(loop, executor, semaphore, get_trades, start_time, middle, shard_limit),
+        _fetch_window(loop, executor, semaphore, get_trades, middle, end_time, shard_limit))
+    return halves[0] + halves[1]
+
+
+async def fetch_trades(start_time=None, end_time=None, shards=8, shard_limit=5000, concurrency=4,
+                       get_trades=None):
+    """
+    Fetches trades concurrently in time windows.
+    @param start_time: Only list trades after this time. `None` fetches from the earliest possible time.
+    @type start_time: int
+    @param end_time: Only list trades before this time. `None` for no end time, like `api.get_trades()`: the last
+                     window is open-ended.
+    @type end_time: int
+    @param shards: Number of windows to start with.
+    @type shards: int
+    @param shard_limit: Maximum number of records per request. Windows returning this many records are split.
+    @type shard_limit: int
+    @param concurrency: Maximum number of concurrent requests.
+    @type concurrency: int
+    @param get_trades: Function with the signature of `api.get_trades`. Default is `api.get_trades`.
+    @type get_trades: callable
+    @return: result as dict, same as `api.get_trades()`
+    @rtype: dict
+    """
+    if get_trades is None:
+        get_trades = api.get_trades
+    # Without an end time, the windows are spread up to now and the last one has no end.
+    last_time = int(time.time()) if end_time is None else end_time
+
+    first_time = EARLIEST_TIME if start_time is None else start_time
+    width = max((last_time - first_time) // shards, 1)
+    bounds = (list(range(first_time, last_time, width)) or [first_time]) + [end_time]
+    if start_time is None:
+        # Still catch entries with bogus early dates.
+        start_time = bounds[0] = 0
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        windows = await asyncio.gather(*[
+            _fetch_window(loop, executor, semaphore, get_trades, window_start, window_end, shard_limit)
+            for window_start, window_end in zip(bounds, bounds[1:])])
+
+    # Windows overlap at their bounds, deduplicate by trade id.
+    trades = OrderedDict()
+    for items in windows:
+        for key, trade in items:
+            trades.setdefault(trade['trade_id'], (key, trade))
+
+    result = OrderedDict([('success', 1), ('method', 'getTrades')])
+    for key, trade in sorted(trades.values(), key=lambda item: int(item[1]['time'])):
+        if start_time <= int(trade['time']) and (end_time is None or int(trade['time']) <= end_time):
+            result[key] = trade
+    return result
+
+
+def get_trades(start_time=None, end_time=None, **kwargs):
+    """
+    Blocking wrapper around `fetch_trades`. Takes the same arguments.
+    @return: result as dict, same as `api.get_trades()`
+    @rtype: dict
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(fetch_trades(start_time=start_time, end_time=end_time, **kwargs))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Runs several consistency checks on a json export (or snapshot) in one go.
+
+The export is loaded and sorted once. A single traversal of the sorted trades finds duplicates, collects the
+movements and keeps running balances; the movements are then matched and, with `--fuzzy`, near-duplicates are
+searched. The checks are the same as in the separate scripts:
+
+ - duplicates: see `find_duplicates.py`
+ - movements: withdrawals and deposits without a match, see `find_unmatched_movements.py`
+ - balances: the balance of a currency on an exchange dropping below zero, which means that an earlier
+   deposit, trade or income is missing (or a withdrawal, trade or fee is wrong)
+
+The result is one combined report, printed as json.
+"""
+import argparse
+import time
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+import profiling
+from find_duplicates import list_near_duplicates
+from find_unmatched_movements import MOVEMENT_TYPES, match_movements
+from tools import prettify, iter_trades, ConversionReport
+
+
+ANALYSES = ('duplicates', 'movements', 'balances')
+
+ZERO = Decimal(0)
+
+
+def _sorted_trades(trades):
+    sorted_rows = getattr(trades, 'sorted_rows', None)
+    if sorted_rows is not None:
+        return sorted_rows()  # A TradeTable sorts its time column instead of comparing rows.
+    return sorted(trades)
+
+
+def audit(trades, analyses=ANALYSES, window=timedelta(0), fuzzy=False, fuzzy_window=60,
+          amount_tolerance=Decimal('0.00000001'), relative=False, balance_tolerance=Decimal('0.00000001')):
+    """
+    Runs the selected analyses on the trades, with one sort and one traversal.
+    @param trades: Trades
+    @type trades: iterable<Trade>
+    @param analyses: Names of the analyses to run, see `ANALYSES`.
+    @type analyses: iterable<str>
+    @param window: Maximum time between a withdrawal and its deposit, see `match_movements`.
+    @type window: timedelta
+    @param fuzzy: Also find near-duplicates, see `list_near_duplicates`.
+    @type fuzzy: bool
+    @param fuzzy_window: Maximum time difference of near-duplicates in seconds.
+    @type fuzzy_window: float
+    @param amount_tolerance: Maximum amount difference of near-duplicates.
+    @type amount_tolerance: Decimal
+    @param relative: True if `amount_tolerance` is relative.
+    @type relative: bool
+    @param balance_tolerance: Negative balances down to this amount are ignored (rounding).
+    @type balance_tolerance: Decimal
+    @return: report
+    @rtype: OrderedDict
+    """
+    analyses = set(analyses)
+    unknown = analyses.difference(ANALYSES)
+    if unknown:
+        raise ValueError("Unknown analyses {}".format(sorted(unknown)))
+    check_duplicates = 'duplicates' in analyses
+    check_movements = 'movements' in analyses
+    check_balances = 'balances' in analyses
+
+    timings = OrderedDict()
+    start = time.perf_counter()
+    with profiling.stage('audit.sort'):
+        trades = _sorted_trades(trades)
+    timings['sort'] = time.perf_counter() - start
+
+    seen = set()
+    duplicated = set()
+    duplicates = []
+    movements = []
+    balances = defaultdict(lambda: ZERO)  # (currency, exchange) -> balance
+    negative = set()  # (currency, exchange) currently below zero
+    negative_balances = []
+
+    def book(trade, currency, amount):
+        key = (currency, trade.exchange)
+        balance = balances[key] + amount
+        balances[key] = balance
+        if balance < -balance_tolerance:
+            if key not in negative:
+                negative.add(key)
+                negative_balances.append(OrderedDict([
+                    ('currency', currency),
+                    ('exchange', trade.exchange),
+                    ('balance', balance),
+                    ('trade', trade.to_odict()),
+                ]))
+        else:
+            negative.discard(key)
+
+    start = time.perf_counter()
+    with profiling.stage('audit.traverse') as stage:
+        stage.add(records=len(trades))
+        for trade in trades:
+            if check_duplicates:
+                if trade in seen:
+                    if trade not in duplicated and 'dupok' not in trade.comment:
+                        duplicates.append(trade)
+                    duplicated.add(trade)
+                else:
+                    seen.add(trade)
+            if check_movements and trade.type in MOVEMENT_TYPES:
+                movements.append(trade)
+            if check_balances:
+                # Debit before credit, so that a trade's own proceeds do not cover its costs.
+                if trade.sell_currency and trade.sell_amount:
+                    book(trade, trade.sell_currency, -trade.sell_amount)
+                if trade.fee_currency and trade.fee_amount:
+                    book(trade, trade.fee_currency, -trade.fee_amount)
+                if trade.buy_currency and trade.buy_amount:
+                    book(trade, trade.buy_currency, trade.buy_amount)
+    timings['traverse'] = time.perf_counter() - start
+
+    report = OrderedDict([('checked', len(trades))])
+    if check_duplicates:
+        report['duplicates'] = [trade.to_odict() for trade in duplicates]
+        if fuzzy:
+            start = time.perf_counter()
+            with profiling.stage('audit.near_duplicates'):
+                pairs = list_near_duplicates(trades, fuzzy_window, amount_tolerance, relative)
+            timings['near_duplicates'] = time.perf_counter() - start
+            report['near_duplicates'] = [[trade1.to_odict(), trade2.to_odict()] for trade1, trade2 in pairs]
+    if check_movements:
+        start = time.perf_counter()
+        with profiling.stage('audit.match_movements') as stage:
+            stage.add(records=len(movements))
+            result = match_movements(movements, window)
+        timings['match_movements'] = time.perf_counter() - start
+        report['matched_movements'] = len(result.matched)
+        report['unmatched_movements'] = [movement.to_odict() for movement in result.unmatched]
+        report['ambiguous_movements'] = [[withdrawal.to_odict(), deposit.to_odict()]
+                                         for withdrawal, deposit in result.ambiguous]
+    if check_balances:
+        report['negative_balances'] = negative_balances
+    report['seconds'] = OrderedDict((name, round(seconds, 6)) for name, seconds in timings.items())
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs duplicate, movement and balance checks on a json export.")
+    parser.add_argument('json_file')
+    parser.add_argument('--only', nargs='+', choices=ANALYSES, default=ANALYSES,
+                        help="analyses to run (default: all)")
+    parser.add_argument('--window', type=float, default=0,
+                        help="minutes a deposit may arrive after its withdrawal (default: 0, same time only)")
+    parser.add_argument('--fuzzy', action='store_true',
+                        help="also find entries with nearly the same time and amounts")
+    parser.add_argument('--fuzzy-window', type=float, default=60,
+                        help="maximum time difference of near-duplicates in seconds (default: 60)")
+    parser.add_argument('--amount-tolerance', type=Decimal, default=Decimal('0.00000001'),
+                        help="maximum amount difference of near-duplicates (default: 0.00000001)")
+    parser.add_argument('--relative', action='store_true',
+                        help="amount tolerance is relative to the amount, eg 0.001 for 0.1%%")
+    parser.add_argument('--balance-tolerance', type=Decimal, default=Decimal('0.00000001'),
+                        help="ignore negative balances down to this amount (default: 0.00000001)")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    load_start = time.perf_counter()
+    conversion_report = ConversionReport()
+    trades = iter_trades(args.json_file, conversion_report)
+    if not hasattr(trades, 'sorted_rows'):
+        trades = list(trades)
+    load_seconds = time.perf_counter() - load_start
+
+    report = audit(trades, args.only, timedelta(minutes=args.window), args.fuzzy, args.fuzzy_window,
+                   args.amount_tolerance, args.relative, args.balance_tolerance)
+    report['seconds']['load'] = round(load_seconds, 6)
+    if conversion_report.rejected:
+        report['rejected'] = conversion_report.rejected
+    print(prettify(report, indent=4))
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Local balance engine, an offline alternative to `api.get_balance()`, `api.get_grouped_balance()` and
+`api.get_historical_currency()`.
+
+Every trade changes the balance of up to three currencies (buy, sell and fee). The changes are kept as running
+balances (prefix sums over time) per (currency, exchange, group, type), so the balance at any time is a binary
+search per series instead of a pass over all trades. `BalanceIndex.updated` applies added and removed trades to
+a copy of only the series they change.
+"""
+import copy
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+
+MOVEMENT_TYPES = ('Deposit', 'Withdrawal')
+GROUP_FIELDS = ('exchange', 'group', 'type')
+
+ZERO = Decimal(0)
+
+
+def _changes(trade):
+    """
+    Yields the (currency, amount) balance changes of a trade.
+    """
+    if trade.buy_currency and trade.buy_amount:
+        yield trade.buy_currency, trade.buy_amount
+    if trade.sell_currency and trade.sell_amount:
+        yield trade.sell_currency, -trade.sell_amount
+    if trade.fee_currency and trade.fee_amount:
+        yield trade.fee_currency, -trade.fee_amount
+
+
+def _to_datetime(time):
+    if time is None or isinstance(time, datetime):
+        return time
+    return datetime.fromtimestamp(int(time))
+
+
+class BalanceSeries(object):
+    """
+    Running balance of one (currency, exchange, group, type).
+    """
+    __slots__ = ('times', 'balances')
+
+    def __init__(self):
+        self.times = []
+        self.balances = []
+
+    def add(self, time, amount):
+        balance = (self.balances[-1] if self.balances else ZERO) + amount
+        if self.times and self.times[-1] == time:
+            self.balances[-1] = balance
+        else:
+            self.times.append(time)
+            self.balances.append(balance)
+
+    def change(self, time, amount):
+        """
+        Adds a change at any time, updating the running balances after it. Times whose changes cancel out are
+        left out.
+        """
+        index = bisect_left(self.times, time)
+        if index == len(self.times) or self.times[index] != time:
+            self.times.insert(index, time)
+            self.balances.insert(index, self.balances[index - 1] if index else ZERO)
+        for later in range(index, len(self.balances)):
+            self.balances[later] += amount
+        if self.balances[index] == (self.balances[index - 1] if index else ZERO):
+            del self.times[index]
+            del self.balances[index]
+
+    def copy(self):
+        series = BalanceSeries()
+        series.times = list(self.times)
+        series.balances = list(self.balances)
+        return series
+
+    def at(self, time=None):
+        """
+        Returns the balance after all changes up to and including `time`.
+        """
+        if time is None:
+            return self.balances[-1] if self.balances else ZERO
+        index = bisect_right(self.times, time)
+        return self.balances[index - 1] if index else ZERO
+
+
+class BalanceIndex(object):
+    """
+    Balances of all currencies, indexed by currency, exchange, group and type.
+    """
+
+    def __init__(self, trades):
+        """
+        @param trades: Trades, in any order.
+        @type trades: iterable<Trade>
+        """
+        self.series = OrderedDict()  # (currency, exchange, group, type) -> BalanceSeries
+        self.by_currency = defaultdict(list)  # currency -> keys of its series
+        for trade in sorted(trades):
+            for currency, amount in _changes(trade):
+                self._add(trade, currency, amount)
+
+    def _add(self, trade, currency, amount):
+        key = (currency, trade.exchange, trade.group, trade.type)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = BalanceSeries()
+            self.by_currency[currency].append(key)
+        series.add(trade.time, amount)
+
+    def updated(self, removed, added):
+        """
+        Returns a new index without the removed and with the added trades. Only the series that change are
+        copied, so this index stays valid for the queries still using it.
+        @param removed: Trades of this index to remove.
+        @type removed: iterable<Trade>
+        @param added: Trades to add.
+        @type added: iterable<Trade>
+        @rtype: BalanceIndex
+        """
+        index = copy.copy(self)
+        index.series = OrderedDict(self.series)
+        index.by_currency = defaultdict(list, ((currency, list(keys)) for currency, keys in self.by_currency.items()))
+        copied = set()
+        for sign, trades in ((-1, removed), (1, added)):
+            for trade in trades:
+                for currency, amount in _changes(trade):
+                    key = (currency, trade.exchange, trade.group, trade.type)
+                    if key not in copied:
+                        copied.add(key)
+                        series = index.series.get(key)
+                        if series is None:
+                            index.series[key] = BalanceSeries()
+                            index.by_currency[currency].append(key)
+                        else:
+                            index.series[key] = series.copy()
+                    index.series[key].change(trade.time, sign * amount)
+
+        for key in copied:
+            if not index.series[key].times:
+                del index.series[key]
+                index.by_currency[key[0]].remove(key)
+                if not index.by_currency[key[0]]:
+                    del index.by_currency[key[0]]
+        return index
+
+    @property
+    def currencies(self):
+        return sorted(self.by_currency)
+
+    # noinspection PyShadowingBuiltins
+    def _keys(self, currency, exchange=None, group=None, exclude_movements=False, type=None):
+        currencies = [currency] if currency is not None else self.currencies
+        for currency in currencies:
+            for key in self.by_currency.get(currency, ()):
+                _, key_exchange, key_group, key_type = key
+                if exchange is not None and key_exchange != exchange:
+                    continue
+                if group is not None and key_group != group:
+                    continue
+                if type is not None and key_type != type:
+                    continue
+                if exclude_movements and key_type in MOVEMENT_TYPES:
+                    continue
+                yield key
+
+    # noinspection PyShadowingBuiltins
+    def balance(self, currency, time=None, exchange=None, group=None, exclude_movements=False, type=None):
+        """
+        Returns the balance of a currency at a time.
+        @param currency: Currency, eg `BTC`
+        @type currency: str
+        @param time: Time (datetime or unix timestamp). `None` for the current balance.
+        @type time: datetime
+        @param exchange: Only this exchange. `None` for all exchanges.
+        @type exchange: str
+        @param group: Only this trade group. `None` for all groups.
+        @type group: str
+        @param exclude_movements: Set to True to exclude account movements (deposits/withdrawals).
+        @type exclude_movements: bool
+        @param type: Only this transaction type, see `api.get_grouped_balance()`. `None` for all types.
+        @type type: str
+        @rtype: Decimal
+        """
+        time = _to_datetime(time)
+        return sum((self.series[key].at(time)
+                    for key in self._keys(currency, exchange, group, exclude_movements, type)), ZERO)
+
+    # noinspection PyShadowingBuiltins
+    def balances(self, time=None, exchange=None, group=None, exclude_movements=False, type=None):
+        """
+        Returns the balances of all currencies at a time, like `api.get_balance()`. Currencies with a zero
+        balance are left out. See `balance` for the parameters.
+        @rtype: OrderedDict
+        """
+        time = _to_datetime(time)
+        result = OrderedDict()
+        for currency in self.currencies:
+            amount = self.balance(currency, time, exchange, group, exclude_movements, type)
+            if amount:
+                result[currency] = amount
+        return result
+
+    # noinspection PyShadowingBuiltins
+    def grouped_balance(self, group_by='exchange', time=None, exclude_movements=False, type=None):
+        """
+        Returns the balances grouped by exchange, trade group or transaction type, like
+        `api.get_grouped_balance()`.
+        @param group_by: Field to group by, either `exchange`, `group` or `type`.
+        @type group_by: str
+        @return: result as dict: group -> currency -> balance
+        @rtype: OrderedDict
+        """
+        if group_by not in GROUP_FIELDS:
+            raise ValueError("Cannot group by {}".format(group_by))
+        field = GROUP_FIELDS.index(group_by) + 1
+        time = _to_datetime(time)
+        totals = defaultdict(lambda: defaultdict(lambda: ZERO))
+        for key in self._keys(None, exclude_movements=exclude_movements, type=type):
+            totals[key[field]][key[0]] += self.series[key].at(time)
+
+        result = OrderedDict()
+        for group_value in sorted(totals):
+            currencies = OrderedDict((currency, amount) for currency, amount in sorted(totals[group_value].items())
+                                     if amount)
+            if currencies:
+                result[group_value] = currencies
+        return result
+
+    # noinspection PyShadowingBuiltins
+    def daily_balances(self, currency, start_time=None, end_time=None, exchange=None, group=None,
+                       exclude_movements=False, type=None):
+        """
+        Returns the balance of a currency at the end of every day, like the amounts of
+        `api.get_historical_currency()`.
+        @param start_time: First day. `None` for the day of the first trade.
+        @type start_time: datetime
+        @param end_time: Last day. `None` for the day of the last trade.
+        @type end_time: datetime
+        @return: result as dict: date -> balance
+        @rtype: OrderedDict
+        """
+        keys = list(self._keys(currency, exchange, group, exclude_movements, type))
+        result = OrderedDict()
+        if not keys:
+            return result
+        start_time = _to_datetime(start_time) or min(self.series[key].times[0] for key in keys)
+        end_time = _to_datetime(end_time) or max(self.series[key].times[-1] for key in keys)
+
+        day = start_time.date()
+        while day <= end_time.date():
+            end_of_day = datetime.combine(day, datetime.max.time())
+            result[day] = sum((self.series[key].at(end_of_day) for key in keys), ZERO)
+            day += timedelta(days=1)
+        return result
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the hot paths of the tools on synthetic data.
+
+Generates seeded, realistic exports and csv files (mixed transaction types, bursts of records within the same
+second, withdrawals with their matching deposits, injected duplicates) and measures time and peak memory of:
+
+ - `tools.read_trades_from_file`
+ - `tools.convert_trade_objs`, and `Trade(**trade)` per record as a baseline for it
+ - `tools.iter_trades_from_file`, streaming a file into a list of trades
+ - `find_duplicates.list_duplicates`
+ - `find_unmatched_movements.match_movements`
+ - `group_by_day.process_csv`
+
+Results are written to a json file. Pass the results of an earlier run with `--compare` to see the changes.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from decimal import Decimal
+
+from find_duplicates import list_duplicates
+from find_unmatched_movements import match_movements
+from group_by_day import process_csv
+from tools import Trade, read_trades_from_file, convert_trade_objs, iter_trades_from_file
+
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+START_TIME = 1483228800  # 2017-01-01
+CURRENCIES = ('BTC', 'ETH', 'XMR', 'LTC', 'DASH', 'BNB')
+FIAT_CURRENCIES = ('EUR', 'USD')
+EXCHANGES = ('Kraken', 'Poloniex', 'Bitstamp', 'Binance', 'BTC Wallet')
+INCOME_TYPES = ('Income', 'Mining', 'Gift/Tip(In)')
+OUTGOING_TYPES = ('Spend', 'Donation', 'Gift(Out)', 'Lost')
+
+
+def _amount(rnd, low, high, places=8):
+    return '{:.{}f}'.format(rnd.uniform(low, high), places)
+
+
+def generate_trades(num_records, seed=1):
+    """
+    Generates a synthetic export, in the format of `api.get_trades()`.
+    About half of the records are trades, a third are movements (90% of the withdrawals have a matching deposit
+    with the same net amount, at the same time or some minutes later) and the rest other transaction types.
+    Records come in bursts within the same second, and 1% are exact duplicates of an earlier record.
+    @param num_records: Number of records
+    @type num_records: int
+    @param seed: Seed of the random generator. The same seed generates the same export.
+    @type seed: int
+    @return: result as dict
+    @rtype: OrderedDict
+    """
+    rnd = random.Random(seed)
+    trades = OrderedDict([('success', 1), ('method', 'getTrades')])
+    records = []
+    timestamp = START_TIME
+
+    def add(record_type, buy_currency='', buy_amount='', sell_currency='', sell_amount='', fee_currency='',
+            fee_amount='', exchange='', offset=0):
+        trade_id = str(1000000 + len(records))
+        record = OrderedDict([
+            ('type', record_type),
+            ('time', str(timestamp + offset)),
+            ('trade_id', trade_id),
+            ('buy_currency', buy_currency),
+            ('sell_currency', sell_currency),
+            ('fee_currency', fee_currency),
+            ('buy_amount', buy_amount),
+            ('sell_amount', sell_amount),
+            ('fee_amount', fee_amount),
+            ('exchange', exchange or rnd.choice(EXCHANGES)),
+            ('group', rnd.choice(('', '', 'Margin'))),
+            ('comment', ''),
+            ('imported_from', 'API'),
+            ('imported_time', str(timestamp + offset + 3600)),
+        ])
+        records.append(record)
+        trades[trade_id] = record
+
+    while len(records) < num_records:
+        # Most records are alone in their second, some come in bursts (eg a large order filled in parts).
+        timestamp += rnd.randint(1, 600)
+        burst = rnd.randint(2, 20) if rnd.random() < 0.1 else 1
+        for _ in range(burst):
+            if len(records) >= num_records:
+                break
+            r = rnd.random()
+            currency = rnd.choice(CURRENCIES)
+            if r < 0.01 and records:
+                duplicate = OrderedDict(rnd.choice(records))
+                records.append(duplicate)
+                trades['{}-{}'.format(duplicate['trade_id'], len(records))] = duplicate
+            elif r < 0.5:
+                fiat = rnd.choice(FIAT_CURRENCIES)
+                if rnd.random() < 0.5:
+                    add('Trade', currency, _amount(rnd, 0.01, 10), fiat, _amount(rnd, 10, 5000, 2), fiat, '0.10')
+                else:
+                    add('Trade', fiat, _amount(rnd, 10, 5000, 2), currency, _amount(rnd, 0.01, 10), fiat, '0.10')
+            elif r < 0.8:
+                amount = Decimal(_amount(rnd, 0.01, 10))
+                fee = Decimal('0.001')
+                exchange, other_exchange = rnd.sample(EXCHANGES, 2)
+                add('Withdrawal', sell_currency=currency, sell_amount=str(amount), fee_currency=currency,
+                    fee_amount=str(fee), exchange=exchange)
+                if rnd.random() < 0.9:
+                    add('Deposit', buy_currency=currency, buy_amount=str(amount - fee), exchange=other_exchange,
+                        offset=rnd.choice((0, 0, 60, 600)))
+            elif r < 0.9:
+                add(rnd.choice(INCOME_TYPES), buy_currency=currency, buy_amount=_amount(rnd, 0.0001, 1))
+            else:
+                add(rnd.choice(OUTGOING_TYPES), sell_currency=currency, sell_amount=_amount(rnd, 0.0001, 1))
+    return trades
+
+
+def write_trades(filename, num_records, seed=1):
+    """
+    Writes a synthetic export (see `generate_trades`) to a json file, like `export_to_json.py`.
+    """
+    with open(filename, 'w') as output_file:
+        json.dump(generate_trades(num_records, seed), output_file, indent=4)
+
+
+def write_csv(filename, num_records, seed=1):
+    """
+    Writes a synthetic "Trade List" csv in the input format of `group_by_day.py`.
+    Records are spread over one year, so many of them share a day, exchange and currency pair and are grouped.
+    """
+    rnd = random.Random(seed)
+    with open(filename, 'w') as output_file:
+        output_file.write('Type,Buy,Cur.,Sell,Cur.,Fee,Cur.,Exchange,Group,Comment,Date,Tx-ID\n')
+        for index in range(num_records):
+            record_type = rnd.choice(('Trade', 'Trade', 'Margin Profit', 'Margin Loss'))
+            exchange = rnd.choice(EXCHANGES)
+            date = '{:02d}.{:02d}.2019 {:02d}:{:02d}'.format(rnd.randint(1, 28), rnd.randint(1, 12),
+                                                             rnd.randint(0, 23), rnd.randint(0, 59))
+            tx_id = 'tx{}'.format(index) + ('_fee' if rnd.random() < 0.05 else '')
+            output_file.write(','.join([
+                record_type,
+                _amount(rnd, 0, 5) if rnd.random() < 0.9 else '', rnd.choice(CURRENCIES),
+                _amount(rnd, 0, 5), rnd.choice(FIAT_CURRENCIES),
+                _amount(rnd, 0, 0.01) if rnd.random() < 0.7 else '', 'BNB',
+                exchange, rnd.choice(('', 'Margin')), '', date, tx_id,
+            ]) + '\n')
+
+
+def measure(function, *args):
+    """
+    Calls a function twice: once with tracemalloc to record its peak memory, and once to time it. The first call
+    also warms up the allocator, so the timing does not depend on which benchmark ran before.
+    @return: seconds, peak memory in bytes, and the result of the function
+    @rtype: tuple
+    """
+    tracemalloc.start()
+    try:
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    return seconds, peak, result
+
+
+def convert_one_by_one(trades):
+    """
+    Converts the trade dicts one by one, the way the tools did before `tools.TradeConverter`. The garbage
+    collector is paused like `TradeConverter` does, so that both are measured under the same gc state.
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return [Trade(**trade) for trade in trades.values() if trade != 1 and trade != 'getTrades']
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def load_trade_objs(filename):
+    return list(iter_trades_from_file(filename))
+
+
+def run_benchmarks(num_records, directory, seed=1):
+    """
+    Runs all benchmarks on synthetic data of one size.
+    @param num_records: Number of records
+    @type num_records: int
+    @param directory: Directory for the generated files.
+    @type directory: str
+    @return: results
+    @rtype: list<OrderedDict>
+    """
+    json_file = os.path.join(directory, 'trades_{}.json'.format(num_records))
+    csv_in = os.path.join(directory, 'trades_{}.csv'.format(num_records))
+    csv_out = os.path.join(directory, 'grouped_{}.csv'.format(num_records))
+    write_trades(json_file, num_records, seed)
+    write_csv(csv_in, num_records, seed)
+
+    results = []
+
+    def run(name, function, *args):
+        seconds, peak, result = measure(function, *args)
+        results.append(OrderedDict([
+            ('benchmark', name),
+            ('records', num_records),
+            ('seconds', round(seconds, 6)),
+            ('records_per_second', round(num_records / seconds) if seconds else None),
+            ('peak_memory_bytes', peak),
+        ]))
+        print("{:>26} {:>9} records: {:9.3f} s, {:9.1f} MiB peak".format(
+            name, num_records, seconds, peak / 1024.0 / 1024.0), file=sys.stderr)
+        return result
+
+    trades = run('read_trades_from_file', read_trades_from_file, json_file)
+    run('convert_trades_one_by_one', convert_one_by_one, trades)
+    trade_objs = run('convert_trade_objs', convert_trade_objs, trades)
+    del trades
+    run('iter_trades_from_file', load_trade_objs, json_file)
+    run('list_duplicates', list_duplicates, trade_objs)
+    run('match_movements', match_movements, trade_objs)
+    del trade_objs
+    run('process_csv', process_csv, csv_in, csv_out)
+    return results
+
+
+def compare(results, baseline):
+    """
+    Prints the change of each result relative to the same benchmark and size in the baseline.
+    """
+    previous = dict(((r['benchmark'], r['records']), r) for r in baseline['results'])
+    for result in results:
+        old = previous.get((result['benchmark'], result['records']))
+        if old is None:
+            continue
+        print("{:>26} {:>9} records: time {:+7.1%}, peak memory {:+7.1%}".format(
+            result['benchmark'], result['records'],
+            result['seconds'] / old['seconds'] - 1 if old['seconds'] else 0,
+            result['peak_memory_bytes'] / float(old['peak_memory_bytes']) - 1 if old['peak_memory_bytes'] else 0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the tools on synthetic data.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="numbers of records (default: 10000 100000 1000000)")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the data generator (default: 1)")
+    parser.add_argument('--output', default='benchmark.json',
+                        help="json file to write the results to (default: benchmark.json)")
+    parser.add_argument('--compare', metavar='BASELINE_FILE',
+                        help="results of an earlier run to compare with")
+    parser.add_argument('--data-dir',
+                        help="directory to keep the generated files in (default: a temporary directory)")
+    args = parser.parse_args()
+
+    results = []
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+        for size in args.sizes:
+            results.extend(run_benchmarks(size, args.data_dir, args.seed))
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            for size in args.sizes:
+                results.extend(run_benchmarks(size, data_dir, args.seed))
+
+    with open(args.output, 'w') as output_file:
+        json.dump(OrderedDict([
+            ('created', int(time.time())),
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('seed', args.seed),
+            ('results', results),
+        ]), output_file, indent=4)
+    print("Wrote results to {}.".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for API responses.
+
+Responses are keyed on the API method and its parameters (without the nonce) and stored gzip-compressed,
+one file per response. Each method has its own time to live. The cache is bounded in size; the least recently
+used responses are evicted first. A cache can be shared by several clients and threads.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+# Time to live per API method in seconds.
+DEFAULT_TTLS = {
+    'getTrades': 300,
+    'getBalance': 60,
+    'getGroupedBalance': 60,
+    'getGains': 300,
+    'getHistoricalSummary': 3600,
+    'getHistoricalCurrency': 3600,
+}
+DEFAULT_TTL = 60
+
+# Historical data for a date range that ended more than a day ago does not change any more.
+CLOSED_RANGE_METHODS = ('getHistoricalSummary', 'getHistoricalCurrency')
+CLOSED_RANGE_TTL = 30 * 86400
+CLOSED_RANGE_MIN_AGE = 86400
+
+CACHE_SUFFIX = '.json.gz'
+
+
+class ResponseCache(object):
+    """
+    Size-bounded LRU cache of API responses on disk.
+    """
+
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024, ttls=None, clock=time.time):
+        """
+        @param directory: Directory to store responses in. Created if it does not exist.
+        @type directory: str
+        @param max_bytes: Maximum total size of the stored (compressed) responses.
+        @type max_bytes: int
+        @param ttls: Time to live per API method in seconds, overrides `DEFAULT_TTLS`.
+        @type ttls: dict
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Guards the entries and the files; responses are encoded and compressed outside of it.
+        self.lock = threading.Lock()
+
+        # Cache keys and file sizes, least recently used first. The file mtime is used as last access time.
+        self.entries = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for filename in os.listdir(directory):
+            if filename.endswith(CACHE_SUFFIX):
+                stat = os.stat(os.path.join(directory, filename))
+                files.append((stat.st_mtime, filename[:-len(CACHE_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+
+    @staticmethod
+    def key(api_method, params):
+        """
+        Returns the cache key of a call. The nonce and parameters that are None are ignored.
+        """
+        normalized = sorted((str(k), str(v)) for k, v in params.items() if v is not None and k != 'nonce')
+        data = json.dumps([api_method, normalized], separators=(',', ':'))
+        return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+    def ttl(self, api_method, params):
+        """
+        Returns the time to live of a response in seconds.
+        """
+        end_time = params.get('end_time')
+        if api_method in CLOSED_RANGE_METHODS and end_time is not None and \
+                int(end_time) < self.clock() - CLOSED_RANGE_MIN_AGE:
+            return CLOSED_RANGE_TTL
+        return self.ttls.get(api_method, DEFAULT_TTL)
+
+    @property
+    def size(self):
+        return sum(self.entries.values())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self, api_method, params):
+        """
+        Returns the cached response of a call, or None if there is none or it has expired.
+        """
+        key = self.key(api_method, params)
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        if key in self.entries:
+            try:
+                with gzip.open(self._path(key), 'rt', encoding='utf8') as cache_file:
+                    entry = json.load(cache_file, object_pairs_hook=OrderedDict)
+            except (OSError, ValueError) as e:
+                log.warning("Dropping unreadable cache entry %s: %s", key, e)
+                entry = None
+
+            if entry is not None and entry['expires'] > self.clock():
+                self.hits += 1
+                self.entries.move_to_end(key)
+                os.utime(self._path(key))
+                return entry['response']
+            self._remove(key)
+
+        self.misses += 1
+        return None
+
+    def put(self, api_method, params, response):
+        """
+        Stores the response of a call. Responses reporting an error are not stored.
+        """
+        if response.get('success') != 1:
+            return
+
+        key = self.key(api_method, params)
+        entry = OrderedDict([
+            ('method', api_method),
+            ('expires', self.clock() + self.ttl(api_method, params)),
+            ('response', response),
+        ])
+        path = self._path(key)
+        # Every writer has its own temporary file, concurrent writers of the same key must not mix their data.
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(handle)
+        try:
+            with gzip.open(tmp_path, 'wt', encoding='utf8') as cache_file:
+                json.dump(entry, cache_file, separators=(',', ':'))
+            with self.lock:
+                os.replace(tmp_path, path)
+                self.entries.pop(key, None)
+                self.entries[key] = os.path.getsize(path)
+                self._evict()
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _evict(self):
+        size = self.size
+        while size > self.max_bytes and len(self.entries) > 1:
+            key, entry_size = next(iter(self.entries.items()))
+            self._remove(key)
+            size -= entry_size
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._remove(key)
+
+    def stats(self):
+        """
+        Returns hit/miss statistics.
+        @rtype: OrderedDict
+        """
+        with self.lock:
+            return OrderedDict([
+                ('hits', self.hits),
+                ('misses', self.misses),
+                ('evictions', self.evictions),
+                ('entries', len(self.entries)),
+                ('bytes', self.size),
+            ])
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Transparent compression of the files the tools read and write (exports, stores, snapshots and csv files).
+
+Readers detect the codec from the magic bytes at the start of a file, so compressed and uncompressed files can
+be used interchangeably. Writers compress according to the extension of the file: `.gz`, `.bz2`, `.xz`, and
+`.zst` if the `zstandard` package is installed. All codecs stream, so reading a compressed file does not take
+more memory than reading an uncompressed one.
+"""
+import bz2
+import gzip
+import lzma
+import os
+
+try:
+    # noinspection PyUnresolvedReferences
+    import zstandard
+    zstandard_available = True
+except ImportError:
+    zstandard_available = False
+
+
+# Magic bytes at the start of the compressed file -> codec
+MAGIC_BYTES = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+EXTENSIONS = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.zst': 'zstd',
+}
+CODECS = ('gzip', 'bz2', 'xz', 'zstd')
+
+# Compression level of gzip. The default of the gzip module (9) is a lot slower for hardly smaller files.
+GZIP_LEVEL = 6
+
+
+class CompressionError(Exception):
+    """
+    Raised if a file is compressed with a codec that is not available.
+    """
+    pass
+
+
+def detect_compression(filename):
+    """
+    Returns the codec a file is compressed with, from its magic bytes.
+    @param filename: Filename
+    @type filename: str
+    @return: codec, see `CODECS`, or None if the file is not compressed
+    @rtype: str
+    """
+    with open(filename, 'rb') as input_file:
+        head = input_file.read(8)
+    for magic, codec in MAGIC_BYTES:
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def compression_for(filename):
+    """
+    Returns the codec to write a file with, from its extension, or None for an uncompressed file.
+    @rtype: str
+    """
+    return EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+def is_compressed(filename):
+    return detect_compression(filename) is not None
+
+
+def open_file(filename, mode='r', compression='auto', **kwargs):
+    """
+    Opens a file like `open()`, compressing or decompressing it on the fly.
+    @param filename: Filename
+    @type filename: str
+    @param mode: `r`, `w` or `a`, plus `b` for binary files.
+    @type mode: str
+    @param compression: Codec, see `CODECS`. `auto` to detect it from the magic bytes when reading and from the
+                        extension when writing, `None` for an uncompressed file.
+    @type compression: str
+    @param kwargs: Arguments for text files, eg `encoding` and `newline`.
+    @return: file object
+    """
+    if compression == 'auto':
+        if 'r' in mode:
+            compression = detect_compression(filename)
+        else:
+            compression = compression_for(filename)
+    if compression is None:
+        return open(filename, mode, **kwargs)
+
+    if 'b' not in mode and 't' not in mode:
+        mode += 't'
+    if compression == 'gzip':
+        if 'r' not in mode:
+            kwargs['compresslevel'] = GZIP_LEVEL
+        return gzip.open(filename, mode, **kwargs)
+    if compression == 'bz2':
+        return bz2.open(filename, mode, **kwargs)
+    if compression == 'xz':
+        return lzma.open(filename, mode, **kwargs)
+    if compression == 'zstd':
+        if not zstandard_available:
+            raise CompressionError("{}: zstd compression needs the zstandard package".format(filename))
+        return zstandard.open(filename, mode, **kwargs)
+    raise CompressionError("Unknown compression {}".format(compression))
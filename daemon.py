@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+Keeps the trades of a local store (see `store.py`) indexed in memory and answers queries over localhost HTTP.
+
+The store is loaded, converted and indexed once. A background thread syncs it with the API every `--interval`
+seconds (only trades newer than the last sync are fetched), converts the new and changed records and swaps in an
+updated copy of the index, so queries never wait for the API or for parsing. Only the parts of the index that the
+changed trades touch are copied.
+
+Queries (GET, parameters in the query string, results as json):
+
+ - `/status`: number of trades, high-water mark and time of the last refresh
+ - `/trade?trade_id=...`
+ - `/duplicates`
+ - `/movements?window=<minutes>`: unmatched and ambiguous movements
+ - `/balance?currency=BTC[&time=...][&exchange=...][&group=...][&type=...][&exclude_movements=1]`
+ - `/balances?[time=...][&exchange=...][&group=...][&type=...][&exclude_movements=1]`
+ - `/grouped_balance?group=exchange|group|type[&time=...][&type=...][&exclude_movements=1]`
+ - `/daily_balances?currency=BTC[&start_time=...][&end_time=...][&exchange=...]...`
+
+Times are unix timestamps or ISO dates. `POST /refresh` triggers a refresh right away.
+"""
+import argparse
+import copy
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left, insort_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from balances import BalanceIndex
+from find_duplicates import list_duplicates
+from find_unmatched_movements import MOVEMENT_TYPES, match_movements
+from store import TradeStore
+from tools import ExtendedJSONEncoder, TradeConverter
+
+
+log = logging.getLogger(__name__)
+
+
+class QueryError(Exception):
+    """
+    Raised for invalid query parameters.
+    """
+    pass
+
+
+class UnknownQueryError(Exception):
+    """
+    Raised for unknown query paths.
+    """
+    pass
+
+
+class TradeIndex(object):
+    """
+    Immutable, indexed view of the trades at one point in time. Duplicates and movement matches are computed on
+    first use.
+    """
+
+    def __init__(self, trades):
+        self.created = time.time()
+        self.trades = sorted(trades)
+        self.by_id = dict((trade.trade_id, trade) for trade in self.trades)
+        self.balances = BalanceIndex(self.trades)
+        self._reset()
+
+    def _reset(self):
+        self._duplicates = None
+        self._matches = {}
+        self._lock = threading.Lock()
+
+    def updated(self, removed, added):
+        """
+        Returns a new index without the removed and with the added trades. This index stays valid for the queries
+        still using it.
+        @param removed: Trades of this index to remove.
+        @type removed: list<Trade>
+        @param added: Trades to add.
+        @type added: list<Trade>
+        @rtype: TradeIndex
+        """
+        index = copy.copy(self)
+        index.created = time.time()
+        index.trades = list(self.trades)
+        index.by_id = dict(self.by_id)
+        for trade in removed:
+            # Trades are ordered by time only, so look for the trade itself among those of the same time.
+            position = bisect_left(index.trades, trade)
+            while index.trades[position] is not trade:
+                position += 1
+            del index.trades[position]
+            del index.by_id[trade.trade_id]
+        for trade in added:
+            insort_right(index.trades, trade)
+            index.by_id[trade.trade_id] = trade
+        index.balances = self.balances.updated(removed, added)
+        index._reset()
+        return index
+
+    @property
+    def duplicates(self):
+        with self._lock:
+            if self._duplicates is None:
+                self._duplicates = [trade for trade in list_duplicates(self.trades) if 'dupok' not in trade.comment]
+            return self._duplicates
+
+    def match_movements(self, window):
+        with self._lock:
+            result = self._matches.get(window)
+            if result is None:
+                movements = [trade for trade in self.trades if trade.type in MOVEMENT_TYPES]
+                result = self._matches[window] = match_movements(movements, timedelta(minutes=window))
+            return result
+
+
+class TradeDaemon(object):
+    """
+    Loads a store, keeps it indexed and refreshes it in the background.
+    """
+
+    def __init__(self, filename, get_trades=None, interval=300, lookback=86400):
+        """
+        @param filename: Filename of the store.
+        @type filename: str
+        @param get_trades: Function with the signature of `api.get_trades`. `None` to never refresh.
+        @type get_trades: callable
+        @param interval: Seconds between refreshes.
+        @type interval: float
+        @param lookback: Seconds before the last synced trade to fetch again, see `TradeStore.sync`.
+        @type lookback: int
+        """
+        self.store = TradeStore(filename)
+        self.get_trades = get_trades
+        self.interval = interval
+        self.lookback = lookback
+        self.converter = TradeConverter()
+        self.records = OrderedDict()  # trade_id -> (record, Trade) of the converted records
+        self.last_refresh = None
+        self.last_error = None
+        self.refreshes = 0
+        self._refresh_now = threading.Event()
+        self._stopped = threading.Event()
+        self.index = None
+        self._update_index()
+
+    def _update_index(self):
+        # Records that upsert inserted or replaced are new objects, all others are converted already.
+        records = OrderedDict()
+        changed = OrderedDict()
+        for trade_id, record in self.store.trades.items():
+            converted = self.records.get(trade_id)
+            if converted is not None and converted[0] is record:
+                records[trade_id] = converted
+            else:
+                changed[trade_id] = record
+        removed = [trade for trade_id, (record, trade) in self.records.items() if records.get(trade_id) is None]
+        # Records that cannot be converted are logged and skipped by the converter.
+        trade_objs = dict((trade.trade_id, trade) for trade in self.converter.convert_all(changed.values()))
+        added = []
+        for trade_id, record in changed.items():
+            trade = trade_objs.get(trade_id.strip())
+            if trade is not None:
+                records[trade_id] = (record, trade)
+                added.append(trade)
+        self.records = records
+        if self.index is None:
+            self.index = TradeIndex(trade for record, trade in records.values())
+        else:
+            self.index = self.index.updated(removed, added)
+
+    def refresh(self):
+        """
+        Syncs the store with the API and swaps in an updated index if there were changes.
+        @return: number of inserted, updated and deleted trades
+        @rtype: tuple
+        """
+        inserted, updated, deleted = self.store.sync(self.get_trades, lookback=self.lookback)
+        if inserted or updated or deleted:
+            self.store.save()
+            self._update_index()
+        self.last_refresh = time.time()
+        self.refreshes += 1
+        log.info("Refreshed: inserted %d, updated %d and deleted %d trades", inserted, updated, deleted)
+        return inserted, updated, deleted
+
+    def request_refresh(self):
+        self._refresh_now.set()
+
+    def run_refresh_loop(self):
+        while not self._stopped.is_set():
+            self._refresh_now.wait(self.interval)
+            self._refresh_now.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = '{}: {}'.format(type(e).__name__, e)
+                log.exception("Refresh failed")
+
+    def start(self):
+        if self.get_trades is not None:
+            thread = threading.Thread(target=self.run_refresh_loop, name='refresh', daemon=True)
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._refresh_now.set()
+
+    def status(self):
+        return OrderedDict([
+            ('trades', len(self.index.trades)),
+            ('max_time', self.store.max_time),
+            ('index_created', int(self.index.created)),
+            ('last_refresh', int(self.last_refresh) if self.last_refresh else None),
+            ('refreshes', self.refreshes),
+            ('last_error', self.last_error),
+        ])
+
+    def query(self, path, params):
+        """
+        Answers a query.
+        @param path: Path of the request, eg `/balance`.
+        @type path: str
+        @param params: Query parameters.
+        @type params: dict
+        @return: result, serializable with `ExtendedJSONEncoder`
+        """
+        index = self.index  # The refresh thread may swap the index while the query runs.
+        if path == '/status':
+            return self.status()
+        if path == '/trade':
+            trade = index.by_id.get(_param(params, 'trade_id', required=True))
+            if trade is None:
+                raise QueryError("Unknown trade_id")
+            return trade.to_odict()
+        if path == '/duplicates':
+            return [trade.to_odict() for trade in index.duplicates]
+        if path == '/movements':
+            result = index.match_movements(float(_param(params, 'window', '0')))
+            return OrderedDict([
+                ('matched', len(result.matched)),
+                ('unmatched', [movement.to_odict() for movement in result.unmatched]),
+                ('ambiguous', [[withdrawal.to_odict(), deposit.to_odict()]
+                               for withdrawal, deposit in result.ambiguous]),
+            ])
+
+        filters = OrderedDict([
+            ('exclude_movements', _param(params, 'exclude_movements', '0') not in ('0', 'false', '')),
+            ('type', _param(params, 'type')),
+        ])
+        if path == '/grouped_balance':
+            return index.balances.grouped_balance(_param(params, 'group', 'exchange'),
+                                                  _time_param(params, 'time'), **filters)
+        filters['exchange'] = _param(params, 'exchange')
+        filters['group'] = _param(params, 'group')
+        if path == '/balance':
+            currency = _param(params, 'currency', required=True)
+            return OrderedDict([
+                ('currency', currency),
+                ('balance', index.balances.balance(currency, _time_param(params, 'time'), **filters)),
+            ])
+        if path == '/balances':
+            return index.balances.balances(_time_param(params, 'time'), **filters)
+        if path == '/daily_balances':
+            series = index.balances.daily_balances(_param(params, 'currency', required=True),
+                                                   _time_param(params, 'start_time'),
+                                                   _time_param(params, 'end_time'), **filters)
+            return OrderedDict((day.isoformat(), balance) for day, balance in series.items())
+        raise UnknownQueryError("Unknown query {}".format(path))
+
+
+def _param(params, name, default=None, required=False):
+    values = params.get(name)
+    if not values:
+        if required:
+            raise QueryError("Missing parameter {}".format(name))
+        return default
+    return values[0]
+
+
+def _time_param(params, name):
+    value = _param(params, name)
+    if value is None:
+        return None
+    try:
+        return datetime.fromtimestamp(int(value)) if value.isdigit() else datetime.fromisoformat(value)
+    except ValueError:
+        raise QueryError("Invalid time {}".format(value))
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    Serves the queries of the daemon set on the server.
+    """
+
+    def _send(self, status, data):
+        body = json.dumps(data, cls=ExtendedJSONEncoder).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            self._send(200, self.server.trade_daemon.query(url.path, parse_qs(url.query)))
+        except UnknownQueryError as e:
+            self._send(404, {'error': str(e)})
+        except (QueryError, ValueError) as e:
+            self._send(400, {'error': str(e)})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != '/refresh':
+            self._send(404, {'error': 'Unknown query {}'.format(self.path)})
+            return
+        self.server.trade_daemon.request_refresh()
+        self._send(202, {'refresh': 'requested'})
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.address_string(), format % args)
+
+
+def serve(daemon, host='127.0.0.1', port=8765):
+    """
+    Serves queries until interrupted.
+    """
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.trade_daemon = daemon
+    daemon.start()
+    try:
+        server.serve_forever()
+    finally:
+        daemon.stop()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keeps a trade store indexed in memory and serves queries.")
+    parser.add_argument('json_file', help="trade store, see export_to_json.py --sync")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8765, help="port to listen on (default: 8765)")
+    parser.add_argument('--interval', type=float, default=300,
+                        help="seconds between refreshes from the API (default: 300)")
+    parser.add_argument('--lookback', type=int, default=86400,
+                        help="seconds before the last synced trade to fetch again when syncing (default: 86400)")
+    parser.add_argument('--offline', action='store_true', help="never refresh from the API")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    get_trades = None
+    if not args.offline:
+        from api import get_trades  # Only needed online, it pulls in requests.
+
+    trade_daemon = TradeDaemon(args.json_file, get_trades, interval=args.interval, lookback=args.lookback)
+    log.info("Indexed %d trades, serving on http://%s:%d/", len(trade_daemon.index.trades), args.host, args.port)
+    serve(trade_daemon, args.host, args.port)
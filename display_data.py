@@ -2,6 +2,7 @@
 """
 Simple testscript that pulls all data from the API and pretty-prints it.
 """
+import api
 from api import *
 from tools import prettify
 
@@ -23,3 +24,7 @@ print(prettify(get_grouped_balance()))
 
 print('#' * 120)
 print(prettify(get_gains()))
+
+if api.cache_stats() is not None:
+    print('#' * 120)
+    print(prettify(api.cache_stats()))
@@ -3,20 +3,97 @@
 Simple script that exports all trades from cointracking and write them into a json file.
 
 Note that the exported json is NOT compatible with the json export from the cointracking site.
+
+With `--sync`, the json file is used as a local trade store: only trades newer than the last sync are fetched
+and merged into the file, which is a lot faster and cheaper on the API request limits than a full export.
+The changes are appended to `<json_file>.journal`, which the other scripts apply when they read the json file,
+and merged into it once the journal gets large. Trades deleted on cointracking are removed if they are newer than
+the start of the sync.
+
+Files ending in `.gz`, `.bz2`, `.xz` or `.zst` are written compressed (see `compression.py`), and `--compact`
+writes json without indentation. All scripts read compressed files transparently.
+
+With `--accounts`, the trades of several accounts are fetched concurrently and merged into one file, with the
+trade ids tagged with the account name. The accounts file is json: `{"<name>": {"key": ..., "secret": ...}}`.
 """
+import argparse
+import functools
 import json
-import sys
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import async_api
+import profiling
+from api import Client, get_trades
+from compression import open_file
+from snapshot import write_snapshot
+from store import JOURNAL_SUFFIX, STATE_SUFFIX, TradeStore, merge_accounts
+from trade_table import TradeTable
+
+
+parser = argparse.ArgumentParser(description="Exports all trades from cointracking into a json file.")
+parser.add_argument('json_file')
+parser.add_argument('--sync', action='store_true',
+                    help="only fetch trades newer than the last sync and merge them into json_file")
+parser.add_argument('--lookback', type=int, default=86400,
+                    help="seconds before the last synced trade to fetch again when syncing (default: 86400)")
+parser.add_argument('--concurrent', action='store_true',
+                    help="fetch trades concurrently in time windows instead of in a single request")
+parser.add_argument('--snapshot', metavar='SNAPSHOT_FILE',
+                    help="also write a binary snapshot that the analysis scripts load a lot faster than json")
+parser.add_argument('--compact', action='store_true',
+                    help="write json without indentation, which is smaller and faster to read")
+parser.add_argument('--accounts', metavar='ACCOUNTS_FILE',
+                    help="fetch the accounts in ACCOUNTS_FILE concurrently instead of the account in the environment")
+profiling.add_arguments(parser)
+args = parser.parse_args()
+profiling.enable_from_args(args)
 
-from api import get_trades
+fetch_trades = async_api.get_trades if args.concurrent else get_trades
 
+# Every account has its own client, so its own rate limit and nonces.
+fetchers = None
+if args.accounts:
+    with open(args.accounts) as accounts_file:
+        accounts = json.load(accounts_file, object_pairs_hook=OrderedDict)
+    fetchers = OrderedDict()
+    for name, account in accounts.items():
+        client = Client(account['key'], account['secret'], name=name)
+        fetchers[name] = functools.partial(async_api.get_trades, get_trades=client.get_trades) \
+            if args.concurrent else client.get_trades
 
-if len(sys.argv) != 2:
-    print("Usage: {} <json_file>".format(sys.argv[0]))
-    exit(1)
+if args.sync:
+    store = TradeStore(args.json_file, compact=args.compact)
+    if fetchers:
+        counts = store.sync_accounts(fetchers, lookback=args.lookback)
+        inserted, updated, deleted = (sum(account_counts) for account_counts in zip(*counts.values()))
+    else:
+        inserted, updated, deleted = store.sync(fetch_trades, lookback=args.lookback)
+    store.save()
+    all_trades = store.trades
+    print("Success. Inserted {}, updated {} and deleted {} items, store has {} items.".format(
+        inserted, updated, deleted, len(store)))
+else:
+    if fetchers:
+        with ThreadPoolExecutor(max_workers=len(fetchers)) as executor:
+            futures = [(name, executor.submit(fetch)) for name, fetch in fetchers.items()]
+            all_trades = merge_accounts(OrderedDict((name, future.result()) for name, future in futures))
+    else:
+        all_trades = fetch_trades()
 
-all_trades = get_trades()
+    with open_file(args.json_file, 'w') as output_file:
+        if args.compact:
+            json.dump(all_trades, output_file, separators=(',', ':'))
+        else:
+            json.dump(all_trades, output_file, indent=4)
+    # The journal and the high-water marks of an earlier sync do not belong to the new export.
+    for suffix in (JOURNAL_SUFFIX, STATE_SUFFIX):
+        if os.path.exists(args.json_file + suffix):
+            os.remove(args.json_file + suffix)
 
-with open(sys.argv[1], 'w') as output_file:
-    json.dump(all_trades, output_file, indent=4)
+    print("Success. Exported {} items.".format(len(all_trades)))
 
-print("Success. Exported {} items.".format(len(all_trades)))
+if args.snapshot:
+    write_snapshot(TradeTable.from_dicts(all_trades.values()), args.snapshot)
+    print("Wrote snapshot to {}.".format(args.snapshot))
@@ -8,41 +8,244 @@ occur when trading on exchanges.
 
 You can mark a duplicate entry as acceptable by adding `dupok` to the entry's comment.
 
+With `--fuzzy`, the script also finds near-duplicates: entries of the same type and currencies whose times
+differ by at most `--window` seconds and whose amounts differ by at most `--amount-tolerance` (absolute, or
+relative with `--relative`).
+
+With `--incremental`, the state of the analysis is kept in `<json_file>.duplicates.state` and the next run only
+re-checks the records that changed since, see `incremental.py`.
+
 This script works on a json export as the API has rather low request limits.
 """
+import argparse
+import math
 import sys
-from tools import prettify, read_trades_from_file, convert_trade_objs
-
-
-if len(sys.argv) != 2:
-    print("Usage: {} <json_file>".format(sys.argv[0]))
-    exit(1)
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
 
-all_trades = read_trades_from_file(sys.argv[1])
+import profiling
+import snapshot
+from incremental import IncrementalDuplicates, read_export
+from tools import prettify, iter_trades, ConversionReport, ReportWriter, Trade
 
-trade_objs = convert_trade_objs(all_trades)
 
-
-def list_duplicates(seq):
+def iter_duplicates(seq):
+    """
+    Yields each value that occurred before, as soon as it is seen the second time.
+    """
     seen = set()  # seen values
-    dupl = set()  # values listed in duplist
-    duplist = []  # result
+    dupl = set()  # values already yielded
     for x in seq:
         if x in seen and x not in dupl:
-            duplist.append(x)
+            yield x
             dupl.add(x)
         else:
             seen.add(x)
-    return duplist
 
-output = []
-for d in list_duplicates(trade_objs):
-    # Ignore duplicates that have been marked as being ok.
-    if 'dupok' not in d.comment:
-        output.append(d.to_odict())
 
-if len(output):
-    print(prettify(output, indent=4))
+def list_duplicates(seq):
+    return list(iter_duplicates(seq))
+
+
+def _bucket(value, width, log_scale):
+    """
+    Returns the bucket of a value and the offsets of the buckets that can hold values within `width` of it.
+    """
+    if log_scale:
+        if value <= 0:
+            return None, (0,)
+        value = math.log(value)
+    if width == 0:
+        return value, (0,)
+    return int(value // width), (-1, 0, 1)
+
+
+def amounts_close(amount1, amount2, tolerance, relative):
+    difference = abs(amount1 - amount2)
+    if relative:
+        return difference <= tolerance * max(abs(amount1), abs(amount2))
+    return difference <= tolerance
+
+
+def is_near_duplicate(trade1, trade2, window, tolerance, relative):
+    """
+    Returns True if two different entries have the same type and currencies, and nearly the same time and amounts.
+    @param window: Maximum difference of the times in seconds.
+    @type window: float
+    @param tolerance: Maximum difference of the amounts, absolute or relative to the larger amount.
+    @type tolerance: Decimal
+    @param relative: True if `tolerance` is relative.
+    @type relative: bool
+    """
+    return (trade1.trade_id != trade2.trade_id and
+            trade1.type == trade2.type and
+            trade1.buy_currency == trade2.buy_currency and
+            trade1.sell_currency == trade2.sell_currency and
+            abs((trade1.time - trade2.time).total_seconds()) <= window and
+            amounts_close(trade1.buy_amount, trade2.buy_amount, tolerance, relative) and
+            amounts_close(trade1.sell_amount, trade2.sell_amount, tolerance, relative))
+
+
+def _find_near_duplicates(args):
+    """
+    Finds near-duplicate pairs among indexed trades. Runs in a worker process for partitioned runs.
+    @return: pairs of indexes
+    @rtype: list
+    """
+    indexed_trades, window, tolerance, relative = args
+    amount_width = float(-math.log1p(-float(tolerance))) if relative else tolerance
+
+    # Block candidates into (type, currencies, amount bucket, time bucket), so that only trades in the same or
+    # neighbouring buckets have to be compared.
+    blocks = defaultdict(list)
+    keys = []
+    for index, trade in indexed_trades:
+        # Trades of a block have the same currencies, so they all bucket the same amount, even if it is zero.
+        amount = trade.buy_amount if trade.buy_currency else trade.sell_amount
+        amount_bucket, amount_offsets = _bucket(amount, amount_width, relative)
+        time_bucket, time_offsets = _bucket(trade.time.timestamp(), window, False)
+        block = (trade.type, trade.buy_currency, trade.sell_currency)
+        blocks[block + (amount_bucket, time_bucket)].append((index, trade))
+        keys.append((index, trade, block, amount_bucket, amount_offsets, time_bucket, time_offsets))
+
+    pairs = []
+    for index, trade, block, amount_bucket, amount_offsets, time_bucket, time_offsets in keys:
+        for amount_offset in amount_offsets:
+            for time_offset in time_offsets:
+                if amount_bucket is None:
+                    neighbour = block + (None, time_bucket + time_offset)
+                else:
+                    neighbour = block + (amount_bucket + amount_offset, time_bucket + time_offset)
+                for other_index, other in blocks.get(neighbour, ()):
+                    if other_index > index and is_near_duplicate(trade, other, window, tolerance, relative):
+                        pairs.append((index, other_index))
+    return pairs
+
+
+def list_near_duplicates(trades, window, tolerance, relative=False, jobs=1):
+    """
+    Finds pairs of near-duplicate entries. Entries marked with `dupok` are ignored.
+    @param trades: Trades
+    @type trades: iterable<Trade>
+    @param window: Maximum difference of the times in seconds.
+    @type window: float
+    @param tolerance: Maximum difference of the amounts, absolute or relative to the larger amount. A relative
+        tolerance must be less than 1.
+    @type tolerance: Decimal
+    @param relative: True if `tolerance` is relative.
+    @type relative: bool
+    @param jobs: Number of processes. Trades are partitioned by type and currencies.
+    @type jobs: int
+    @return: pairs of near-duplicate trades, ordered by the position of the trades in the input
+    @rtype: list<tuple>
+    """
+    if tolerance < 0 or (relative and tolerance >= 1):
+        raise ValueError("Invalid amount tolerance {}".format(tolerance))
+    trades = [trade for trade in trades if 'dupok' not in trade.comment]
+    if jobs <= 1:
+        pairs = _find_near_duplicates((list(enumerate(trades)), window, tolerance, relative))
+    else:
+        partitions = [[] for _ in range(jobs)]
+        for index, trade in enumerate(trades):
+            if not isinstance(trade, Trade):
+                trade = trade.to_trade()  # Rows of a TradeTable can't be sent to other processes.
+            block = '\0'.join((trade.type, trade.buy_currency, trade.sell_currency))
+            partitions[zlib.crc32(block.encode('utf8')) % jobs].append((index, trade))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(_find_near_duplicates,
+                                   [(partition, window, tolerance, relative) for partition in partitions])
+            pairs = [pair for result in results for pair in result]
+    return [(trades[i], trades[j]) for i, j in sorted(pairs)]
+
+
+def count_trades(trades):
+    global num_checked
+    for trade in trades:
+        num_checked += 1
+        yield trade
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Finds duplicate entries in a json export.")
+    parser.add_argument('json_file')
+    parser.add_argument('--fuzzy', action='store_true',
+                        help="also find entries with nearly the same time and amounts")
+    parser.add_argument('--window', type=float, default=60,
+                        help="maximum time difference of near-duplicates in seconds (default: 60)")
+    parser.add_argument('--amount-tolerance', type=Decimal, default=Decimal('0.00000001'),
+                        help="maximum amount difference of near-duplicates (default: 0.00000001)")
+    parser.add_argument('--relative', action='store_true',
+                        help="amount tolerance is relative to the amount, eg 0.001 for 0.1%%")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="number of processes for finding near-duplicates (default: 1)")
+    parser.add_argument('--format', choices=ReportWriter.FORMATS, default='json',
+                        help="output format (default: json). With ndjson and csv, the summary goes to stderr.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="keep the state in <json_file>.duplicates.state and only re-check changed records")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    if args.incremental and args.fuzzy:
+        parser.error("--incremental does not support --fuzzy")
+    if args.incremental and snapshot.is_snapshot(args.json_file):
+        parser.error("--incremental needs a json export")
+    if args.window < 0:
+        parser.error("--window must not be negative")
+    if args.amount_tolerance < 0:
+        parser.error("--amount-tolerance must not be negative")
+    if args.relative and args.amount_tolerance >= 1:
+        parser.error("--amount-tolerance must be less than 1 with --relative")
+    profiling.enable_from_args(args)
+
+    num_checked = 0
+    report = ConversionReport()
+    analysis = None
+    if args.incremental:
+        with profiling.stage('incremental.update'):
+            analysis = IncrementalDuplicates(args.json_file + '.duplicates.state', report)
+            analysis.update(read_export(args.json_file))
+        num_checked = len(analysis.records)
+        duplicates = analysis.duplicates()
+        analysis.save()
+    else:
+        trade_objs = count_trades(iter_trades(args.json_file, report))
+        if args.fuzzy:
+            # Finding near-duplicates needs all trades, exact duplicates can be found while streaming.
+            trade_objs = list(trade_objs)
+        # Ignore duplicates that have been marked as being ok.
+        duplicates = (d for d in iter_duplicates(trade_objs) if 'dupok' not in d.comment)
+    # Keep stdout machine-readable for ndjson and csv.
+    info = sys.stdout if args.format == 'json' else sys.stderr
+
+    # Duplicates are written as soon as they are found.
+    writer = ReportWriter(format=args.format)
+    num_duplicates = 0
+    with profiling.stage('list_duplicates'):
+        for d in duplicates:
+            writer.write(d.to_odict(), 'duplicate')
+            num_duplicates += 1
+    writer.close()
+
+    num_near_duplicates = 0
+    if args.fuzzy:
+        with profiling.stage('list_near_duplicates') as stage:
+            stage.add(records=len(trade_objs))
+            near_duplicates = list_near_duplicates(trade_objs, args.window, args.amount_tolerance, args.relative,
+                                                   args.jobs)
+        for trade1, trade2 in near_duplicates:
+            writer.write([trade1.to_odict(), trade2.to_odict()], 'near_duplicate')
+            num_near_duplicates += 1
+        writer.close()
+
+    if report.rejected:
+        print("Skipped unexpected records:", file=info)
+        print(prettify(report.rejected, indent=4), file=info)
 
-print("Checked {} transactions.".format(len(trade_objs)))
-print("Found {} duplicates.".format(len(output)))
+    print("Checked {} transactions.".format(num_checked), file=info)
+    if analysis is not None:
+        print("Re-checked {} new or changed and {} removed transactions.".format(analysis.changed, analysis.removed),
+              file=info)
+    print("Found {} duplicates.".format(num_duplicates), file=info)
+    if args.fuzzy:
+        print("Found {} near-duplicates.".format(num_near_duplicates), file=info)
@@ -4,85 +4,163 @@ Finds movement entries (INs/OUTs) that don't have a matching entry in the other
 Essentially, this script verify the consistency of double-entry-bookkeeping.
 Very useful.
 
+A withdrawal matches a deposit of the same currency and the same net amount (amount minus/plus fee) that happens
+at the same time or within `--window` minutes after it. Each entry is matched at most once.
+
+With `--incremental`, the matches are kept in `<json_file>.movements.state` and the next run only re-matches the
+movements of the currencies and amounts that changed since, see `incremental.py`.
+
 This script works on a json export as the API has rather low request limits.
 """
+import argparse
 import sys
-from tools import prettify, read_trades_from_file, convert_trade_objs
-
-
-if len(sys.argv) != 2:
-    print("Usage: {} <json_file>".format(sys.argv[0]))
-    exit(1)
-
-all_trades = read_trades_from_file(sys.argv[1])
-
-trade_objs = sorted(convert_trade_objs(all_trades))
-
-
-def do_movements_match(trade1, trade2):
-    if trade1.time != trade2.time:
-        return False
-
-    # make sure there is a withdrawal
-    if 'Withdrawal' == trade1.type:
-        withdrawal = trade1
-    elif 'Withdrawal' == trade2.type:
-        withdrawal = trade2
+from collections import defaultdict, deque, namedtuple
+from datetime import timedelta
+
+import profiling
+from trade_table import TradeTable
+from tools import prettify, iter_trades, ConversionReport, ReportWriter
+
+
+MOVEMENT_TYPES = ('Withdrawal', 'Deposit')
+
+MatchResult = namedtuple('MatchResult', ['matched', 'ambiguous', 'unmatched'])
+
+
+def movement_key(trade):
+    """
+    Returns the key under which a withdrawal and its deposit match: currency and net amount.
+    """
+    if 'Withdrawal' == trade.type:
+        return trade.sell_currency, trade.sell_amount - trade.fee_amount
+    return trade.buy_currency, trade.buy_amount + trade.fee_amount
+
+
+def match_movements(trades, window=timedelta(0)):
+    """
+    Matches withdrawals with deposits one-to-one.
+    Movements are indexed by (currency, net amount), then each index entry is swept in time order. A deposit is
+    assigned to the oldest pending withdrawal it can match, which maximizes the number of matches.
+    @param trades: Trades, other types than movements are ignored.
+    @type trades: iterable<Trade>
+    @param window: Maximum time between a withdrawal and its deposit.
+    @type window: timedelta
+    @return: matched (withdrawal, deposit) pairs, the subset of these pairs for which there was more than one
+             candidate, and the movements without a match (ordered by time)
+    @rtype: MatchResult
+    """
+    movements = [trade for trade in trades if trade.type in MOVEMENT_TYPES]
+    # Rows of a TradeTable are keyed by their scaled integer amounts, which saves creating and hashing a Decimal
+    # for every movement.
+    tables = set(getattr(trade, 'table', None) for trade in movements)
+    if len(tables) == 1 and isinstance(next(iter(tables)), TradeTable):
+        key = lambda row, table=tables.pop(): table.movement_key(row.row)
     else:
-        return False
-
-    # make sure there is a deposit
-    if 'Deposit' == trade1.type:
-        deposit = trade1
-    elif 'Deposit' == trade2.type:
-        deposit = trade2
+        key = movement_key
+
+    index = defaultdict(list)
+    for trade in movements:
+        index[key(trade)].append(trade)
+
+    matched = []
+    ambiguous = []
+    unmatched = []
+    for movements in index.values():
+        # Withdrawals go before deposits with the same time.
+        movements.sort(key=lambda t: (t.time, 'Withdrawal' != t.type))
+        pending = deque()
+        for i, trade in enumerate(movements):
+            if 'Withdrawal' == trade.type:
+                pending.append(trade)
+                continue
+
+            while pending and pending[0].time + window < trade.time:
+                unmatched.append(pending.popleft())
+            if not pending:
+                unmatched.append(trade)
+                continue
+
+            withdrawal = pending.popleft()
+            matched.append((withdrawal, trade))
+            # Another withdrawal could have taken this deposit, or another deposit could have taken the withdrawal.
+            next_movement = movements[i + 1] if i + 1 < len(movements) else None
+            if pending or (next_movement is not None and 'Deposit' == next_movement.type and
+                           next_movement.time <= withdrawal.time + window):
+                ambiguous.append((withdrawal, trade))
+        unmatched.extend(pending)
+
+    unmatched.sort()
+    return MatchResult(matched, ambiguous, unmatched)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Finds movements without a matching movement in the other direction.")
+    parser.add_argument('json_file')
+    parser.add_argument('--window', type=float, default=0,
+                        help="minutes a deposit may arrive after its withdrawal (default: 0, same time only)")
+    parser.add_argument('--format', choices=ReportWriter.FORMATS, default='json',
+                        help="output format (default: json). With ndjson and csv, the summary goes to stderr.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="keep the matches in <json_file>.movements.state and only re-match changed movements")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    num_checked = 0
+    movements = []
+    report = ConversionReport()
+    analysis = None
+    if args.incremental:
+        # Imported here as incremental depends on this module.
+        import snapshot
+        from incremental import IncrementalMovements, read_export
+        if snapshot.is_snapshot(args.json_file):
+            parser.error("--incremental needs a json export")
+        with profiling.stage('incremental.update'):
+            analysis = IncrementalMovements(args.json_file + '.movements.state', report,
+                                            timedelta(minutes=args.window))
+            analysis.update(read_export(args.json_file))
+            result = analysis.result()
+        num_checked = len(analysis.records)
+        analysis.save()
+    else:
+        # Only movements can match each other, so there is no need to keep the other records in memory.
+        for trade in iter_trades(args.json_file, report):
+            num_checked += 1
+            if trade.type in MOVEMENT_TYPES:
+                movements.append(trade)
+
+        with profiling.stage('match_movements') as stage:
+            stage.add(records=len(movements))
+            result = match_movements(movements, timedelta(minutes=args.window))
+
+    if args.format == 'json':
+        info = sys.stdout
+        for movement in result.unmatched:
+            print("Found no match for the following movement:")
+            print(prettify(movement.to_odict()))
+
+        for withdrawal, deposit in result.ambiguous:
+            print("Found too many matches for the movement.")
+            print("Check for duplicates!")
+            print(prettify([withdrawal.to_odict(), deposit.to_odict()]))
     else:
-        return False
-
-    if withdrawal.sell_currency != deposit.buy_currency:
-        return False
-
-    # totals match
-    if withdrawal.sell_amount - withdrawal.fee_amount != deposit.buy_amount + deposit.fee_amount:
-        return False
-
-    return True
-
-num_unmatched = 0
-
-for i in range(0, len(trade_objs)):
-    trade = trade_objs[i]
-    
-    if trade.type != 'Withdrawal' and trade.type != 'Deposit':
-        continue
-
-    finds = [trade]
-
-    # step backwards
-    j = i - 1
-    while j >= 0 and trade_objs[j].time == trade.time:
-        if do_movements_match(trade_objs[j], trade):
-            finds.append(trade_objs[j])
-        j -= 1
-
-    # step forwards
-    j = i + 1
-    while j < len(trade_objs) and trade_objs[j].time == trade.time:
-        if do_movements_match(trade_objs[j], trade):
-            finds.append(trade_objs[j])
-        j += 1
-
-    if len(finds) == 1:
-        print("Found no match for the following movement:")
-        print(prettify(finds[0].to_odict()))
-        num_unmatched += 1
-
-    if len(finds) > 2:
-        print("Found too many matches for the movement.")
-        print("Check for duplicates!")
-        # for found in finds:
-        #     print(prettify(found.to_odict()))
-        # num_unmatched += 1
-
-print("Checked {} transactions.".format(len(trade_objs)))
-print("Found {} unmatched movements.".format(num_unmatched))
+        # Keep stdout machine-readable.
+        info = sys.stderr
+        with ReportWriter(format=args.format) as writer:
+            for movement in result.unmatched:
+                writer.write(movement.to_odict(), 'unmatched')
+            for withdrawal, deposit in result.ambiguous:
+                writer.write([withdrawal.to_odict(), deposit.to_odict()], 'ambiguous')
+
+    if report.rejected:
+        print("Skipped unexpected records:", file=info)
+        print(prettify(report.rejected), file=info)
+
+    print("Checked {} transactions.".format(num_checked), file=info)
+    if analysis is not None:
+        print("Re-checked {} new or changed and {} removed transactions.".format(analysis.changed, analysis.removed),
+              file=info)
+    print("Matched {} pairs of movements ({} ambiguous).".format(len(result.matched), len(result.ambiguous)),
+          file=info)
+    print("Found {} unmatched movements.".format(len(result.unmatched)), file=info)
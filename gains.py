@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+Local cost-basis and gains engine, an offline alternative to `api.get_gains()`.
+
+Computes realized and unrealized gains from a list of trades for several cost-basis methods in a single pass.
+Lots are kept per currency in a structure suited to each method: a deque for FIFO/LIFO and a heap for the
+methods that pick lots by price or amount. The lot state is checkpointed at every year boundary, so a tax year
+can be recomputed without replaying the years before it.
+
+Values are in a base (fiat) currency. Trades against the base currency carry their own value; for all other
+trades a price lookup function has to be given. A fee in the base currency is added to the cost of the bought
+currency, or deducted from the proceeds if the base currency is bought.
+
+Income (including staking, airdrops and margin profits) is acquired at market value. Outgoing transactions other
+than spending, eg losses and fees (including margin losses and fees), are disposed of without proceeds. Other
+types are ignored with a warning.
+
+Methods:
+ - FIFO/LIFO: first/last in, first out
+ - HIFO/LOFO: highest/lowest purchase price first out
+ - HPFO/LPFO: highest/lowest profit first out. At a given sale price, the highest profit comes from the
+   cheapest lot, so these consume lots like LOFO/HIFO.
+ - HAFO/LAFO: highest/lowest (remaining) amount first out
+"""
+import copy
+import heapq
+import logging
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime
+from decimal import Decimal
+
+
+METHODS = ('FIFO', 'LIFO', 'HIFO', 'LOFO', 'HPFO', 'LPFO', 'HAFO', 'LAFO')
+
+log = logging.getLogger(__name__)
+
+INCOME_TYPES = ('Income', 'Mining', 'Gift/Tip(In)', 'Staking', 'Airdrop', 'Interest Income', 'Lending Income',
+                'Reward / Bonus', 'Other Income', 'Margin Profit', 'Derivatives / Futures Profit')
+OUTGOING_TYPES = ('Spend', 'Donation', 'Gift(Out)', 'Stolen', 'Lost', 'Other Fee', 'Margin Fee', 'Borrowing Fee',
+                  'Settlement Fee', 'Margin Loss', 'Derivatives / Futures Loss')
+MOVEMENT_TYPES = ('Deposit', 'Withdrawal')
+
+ZERO = Decimal(0)
+
+
+class MissingPriceError(Exception):
+    """
+    Raised if a trade has no value in the base currency and no price lookup was given.
+    """
+    pass
+
+
+class Lot(object):
+    """
+    An amount of a currency acquired at a time for a price (in base currency per unit).
+    """
+    __slots__ = ('time', 'seq', 'amount', 'price')
+
+    def __init__(self, time, seq, amount, price):
+        self.time = time
+        self.seq = seq
+        self.amount = amount
+        self.price = price
+
+    def __repr__(self):
+        return 'Lot({}, {}, {})'.format(self.time, self.amount, self.price)
+
+
+class QueueLots(object):
+    """
+    Lots of a currency in order of acquisition, consumed from the front (FIFO) or the back (LIFO).
+    """
+
+    def __init__(self, last_first):
+        self.last_first = last_first
+        self.lots = deque()
+
+    def add(self, lot):
+        self.lots.append(lot)
+
+    def peek(self):
+        return self.lots[-1] if self.last_first else self.lots[0]
+
+    def pop(self):
+        return self.lots.pop() if self.last_first else self.lots.popleft()
+
+    def update(self, lot):
+        pass  # Order does not depend on the amount.
+
+    def __len__(self):
+        return len(self.lots)
+
+    def __iter__(self):
+        return iter(self.lots)
+
+
+class HeapLots(object):
+    """
+    Lots of a currency ordered by a key, eg the price. Ties are consumed in order of acquisition.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.heap = []
+
+    def add(self, lot):
+        heapq.heappush(self.heap, (self.key(lot), lot.seq, lot))
+
+    def peek(self):
+        return self.heap[0][2]
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+    def update(self, lot):
+        # The amount of the first lot changed, which can change its position for amount-ordered methods.
+        heapq.heapreplace(self.heap, (self.key(lot), lot.seq, lot))
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        return (entry[2] for entry in self.heap)
+
+
+def new_lots(method):
+    """
+    Returns an empty lot structure for a cost-basis method.
+    """
+    if method == 'FIFO':
+        return QueueLots(last_first=False)
+    if method == 'LIFO':
+        return QueueLots(last_first=True)
+    if method in ('HIFO', 'LPFO'):
+        return HeapLots(lambda lot: -lot.price)
+    if method in ('LOFO', 'HPFO'):
+        return HeapLots(lambda lot: lot.price)
+    if method == 'HAFO':
+        return HeapLots(lambda lot: -lot.amount)
+    if method == 'LAFO':
+        return HeapLots(lambda lot: lot.amount)
+    raise ValueError("Unknown method {}".format(method))
+
+
+class MethodState(object):
+    """
+    Lots and realized gains of a single method.
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.lots = defaultdict(lambda: new_lots(method))
+        # year -> currency -> [proceeds, cost]
+        self.realized = defaultdict(lambda: defaultdict(lambda: [ZERO, ZERO]))
+        # Amounts disposed without any lots left (missing acquisitions), per currency.
+        self.shortfall = defaultdict(lambda: ZERO)
+
+    def acquire(self, currency, time, seq, amount, cost):
+        if amount > 0:
+            self.lots[currency].add(Lot(time, seq, amount, cost / amount))
+
+    def dispose(self, currency, year, amount, proceeds):
+        lots = self.lots[currency]
+        remaining = amount
+        cost = ZERO
+        while remaining > 0 and len(lots):
+            lot = lots.peek()
+            if lot.amount <= remaining:
+                lots.pop()
+                cost += lot.amount * lot.price
+                remaining -= lot.amount
+            else:
+                cost += remaining * lot.price
+                lot.amount -= remaining
+                lots.update(lot)
+                remaining = ZERO
+        if remaining > 0:
+            self.shortfall[currency] += remaining
+        entry = self.realized[year][currency]
+        entry[0] += proceeds
+        entry[1] += cost
+
+    def snapshot(self):
+        """
+        Returns a copy of the lots and shortfalls, to be restored with `restore`.
+        """
+        lots = dict((currency, copy.deepcopy(lots)) for currency, lots in self.lots.items() if len(lots))
+        return lots, dict(self.shortfall)
+
+    def restore(self, snapshot):
+        lots, shortfall = snapshot
+        self.lots = defaultdict(lambda: new_lots(self.method))
+        for currency, currency_lots in lots.items():
+            self.lots[currency] = copy.deepcopy(currency_lots)
+        self.shortfall = defaultdict(lambda: ZERO, shortfall)
+
+
+class GainsEngine(object):
+    """
+    Computes gains for several methods in one pass over the trades.
+    """
+
+    def __init__(self, trades, base_currency='EUR', methods=METHODS, price_lookup=None, exclude_movements=True):
+        """
+        @param trades: Trades
+        @type trades: iterable<Trade>
+        @param base_currency: Currency to value trades in.
+        @type base_currency: str
+        @param methods: Cost-basis methods to compute.
+        @type methods: iterable<str>
+        @param price_lookup: Function `(currency, time) -> price in base currency` for trades that are not against
+                             the base currency, and for income. `None` if all trades are against the base currency.
+        @type price_lookup: callable
+        @param exclude_movements: Set to False to treat deposits as acquisitions and withdrawals as disposals at
+                                  market value, like the API does.
+        @type exclude_movements: bool
+        """
+        self.trades = sorted(trades)
+        self.times = [trade.time for trade in self.trades]
+        self.base_currency = base_currency
+        self.methods = tuple(methods)
+        self.price_lookup = price_lookup
+        self.exclude_movements = exclude_movements
+        self.states = OrderedDict((method, MethodState(method)) for method in self.methods)
+        # year -> method -> lots at the start of the year
+        self.checkpoints = OrderedDict()
+        self.processed = False
+        # Unknown types of trades that were ignored.
+        self.ignored_types = set()
+
+    def _value(self, trade, currency, amount):
+        if currency == self.base_currency:
+            return amount
+        if trade.sell_currency == self.base_currency and trade.sell_amount:
+            return trade.sell_amount
+        if trade.buy_currency == self.base_currency and trade.buy_amount:
+            return trade.buy_amount
+        if self.price_lookup is None:
+            raise MissingPriceError("No {} value for trade {}".format(self.base_currency, trade.trade_id))
+        return amount * Decimal(self.price_lookup(currency, trade.time))
+
+    def _apply(self, seq, trade):
+        base = self.base_currency
+        year = trade.time.year
+        acquisitions = []  # (currency, amount, cost)
+        disposals = []  # (currency, amount, proceeds)
+
+        if trade.type == 'Trade':
+            value = self._value(trade, trade.buy_currency, trade.buy_amount)
+            fee_value = ZERO
+            if trade.fee_amount and trade.fee_currency == base:
+                fee_value = trade.fee_amount
+            if trade.buy_currency != base:
+                acquisitions.append((trade.buy_currency, trade.buy_amount, value + fee_value))
+                fee_value = ZERO  # Part of the cost, not deducted again from the proceeds.
+            if trade.sell_currency != base:
+                disposals.append((trade.sell_currency, trade.sell_amount, value - fee_value))
+        elif trade.type in INCOME_TYPES or (trade.type == 'Deposit' and not self.exclude_movements):
+            if trade.buy_currency != base:
+                acquisitions.append((trade.buy_currency, trade.buy_amount,
+                                     self._value(trade, trade.buy_currency, trade.buy_amount)))
+        elif trade.type == 'Spend' or (trade.type == 'Withdrawal' and not self.exclude_movements):
+            if trade.sell_currency != base:
+                disposals.append((trade.sell_currency, trade.sell_amount,
+                                  self._value(trade, trade.sell_currency, trade.sell_amount)))
+        elif trade.type in OUTGOING_TYPES:
+            if trade.sell_currency != base:
+                disposals.append((trade.sell_currency, trade.sell_amount, ZERO))
+        elif trade.type not in MOVEMENT_TYPES:
+            if trade.type not in self.ignored_types:
+                log.warning("Ignoring trades of unknown type %r, eg %s", trade.type, trade.trade_id)
+                self.ignored_types.add(trade.type)
+            return
+
+        # Fees paid in a coin reduce its holdings.
+        if trade.fee_amount and trade.fee_currency and trade.fee_currency != base and \
+                (trade.type not in ('Deposit', 'Withdrawal') or not self.exclude_movements):
+            disposals.append((trade.fee_currency, trade.fee_amount, ZERO))
+
+        for state in self.states.values():
+            for currency, amount, proceeds in disposals:
+                state.dispose(currency, year, amount, proceeds)
+            for currency, amount, cost in acquisitions:
+                state.acquire(currency, trade.time, seq, amount, cost)
+
+    def _checkpoint(self, year):
+        self.checkpoints[year] = OrderedDict((method, state.snapshot()) for method, state in self.states.items())
+
+    def run(self):
+        """
+        Processes all trades, checkpointing the lots at the start of every year.
+        @return: self
+        """
+        self._replay(0)
+        self.processed = True
+        return self
+
+    def _replay(self, start):
+        """
+        Processes the trades from the given position to the end.
+        """
+        year = self.trades[start - 1].time.year if start else None
+        for seq in range(start, len(self.trades)):
+            trade = self.trades[seq]
+            if trade.time.year != year:
+                year = trade.time.year
+                self._checkpoint(year)
+            self._apply(seq, trade)
+
+    def recompute_year(self, year, trades=None):
+        """
+        Recomputes the gains from the checkpoint at the start of a year, eg after trades of that year changed.
+        The years before are not replayed. The later years are, as their lots depend on that year.
+        Requires `run()` to have been called.
+        @param year: Year
+        @type year: int
+        @param trades: All trades of that year, replacing the current ones. `None` to keep them.
+        @type trades: iterable<Trade>
+        @return: realized gains of that year, see `realized`
+        @rtype: OrderedDict
+        """
+        if not self.processed:
+            raise RuntimeError("Call run() first")
+        start = bisect_left(self.times, datetime(year, 1, 1))
+        end = bisect_left(self.times, datetime(year + 1, 1, 1))
+        # The lots before the first trade from that year on. Without such trades, the current lots are.
+        checkpoint = self.checkpoints[self.times[start].year] if start < len(self.trades) else None
+
+        if trades is not None:
+            trades = sorted(trades)
+            if any(trade.time.year != year for trade in trades):
+                raise ValueError("All trades must be from {}".format(year))
+            self.trades[start:end] = trades
+            self.times[start:end] = [trade.time for trade in trades]
+
+        for checkpoint_year in list(self.checkpoints):
+            if checkpoint_year >= year:
+                del self.checkpoints[checkpoint_year]
+        for method, state in self.states.items():
+            if checkpoint is not None:
+                state.restore(checkpoint[method])
+            for realized_year in list(state.realized):
+                if realized_year >= year:
+                    del state.realized[realized_year]
+
+        self._replay(start)
+        return self.realized(year)
+
+    def realized(self, year=None):
+        """
+        Returns realized gains per method and currency.
+        @param year: Only this year. `None` for all years.
+        @type year: int
+        @rtype: OrderedDict
+        """
+        result = OrderedDict()
+        for method, state in self.states.items():
+            totals = defaultdict(lambda: [ZERO, ZERO])
+            for realized_year, currencies in state.realized.items():
+                if year is not None and realized_year != year:
+                    continue
+                for currency, (proceeds, cost) in currencies.items():
+                    totals[currency][0] += proceeds
+                    totals[currency][1] += cost
+            result[method] = OrderedDict(
+                (currency, OrderedDict([('proceeds', proceeds), ('cost', cost), ('gain', proceeds - cost)]))
+                for currency, (proceeds, cost) in sorted(totals.items()))
+        return result
+
+    def unrealized(self, prices):
+        """
+        Returns holdings and unrealized gains per method and currency, after the last processed trade.
+        @param prices: Current price in base currency per currency. Currencies without price are valued at 0.
+        @type prices: dict
+        @rtype: OrderedDict
+        """
+        result = OrderedDict()
+        for method, state in self.states.items():
+            currencies = OrderedDict()
+            for currency, lots in sorted(state.lots.items()):
+                amount = sum((lot.amount for lot in lots), ZERO)
+                if not amount:
+                    continue
+                cost = sum((lot.amount * lot.price for lot in lots), ZERO)
+                value = amount * Decimal(prices.get(currency, 0))
+                currencies[currency] = OrderedDict([
+                    ('amount', amount), ('cost', cost), ('value', value), ('gain', value - cost)])
+            result[method] = currencies
+        return result
+
+
+def compute_gains(trades, methods=METHODS, base_currency='EUR', price_lookup=None, exclude_movements=True,
+                  prices=None):
+    """
+    Computes realized (and optionally unrealized) gains for several methods in one pass.
+    @param prices: Current prices for unrealized gains, see `GainsEngine.unrealized`. `None` to skip.
+    @type prices: dict
+    @return: result as dict: method -> `realized` and `unrealized` per currency
+    @rtype: OrderedDict
+    """
+    engine = GainsEngine(trades, base_currency=base_currency, methods=methods, price_lookup=price_lookup,
+                         exclude_movements=exclude_movements).run()
+    realized = engine.realized()
+    unrealized = engine.unrealized(prices) if prices is not None else None
+    result = OrderedDict()
+    for method in engine.methods:
+        result[method] = OrderedDict([('realized', realized[method])])
+        if unrealized is not None:
+            result[method]['unrealized'] = unrealized[method]
+    return result
@@ -19,12 +19,26 @@ For example:
     1.95852928, BTC, 114.87092795, 1312.95150627, XMR, 116.15735953, Poloniex, 30.08.2016 13:31
 
 Output format is the same.
+
+Input and output may be compressed (see `compression.py`): the input is decompressed whatever its codec and the
+output is compressed according to its extension, eg `grouped.csv.gz`.
 """
+import argparse
 import csv
-import sys
+import heapq
+import io
+import locale
+import os
+import tempfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 from decimal import Decimal
 
+import profiling
+from compression import open_file, is_compressed
+
 
 class Record(object):
     exchange_exceptions = ["Wallet", "Transaction"]  # E.g. don't process autoimported blockchain transactions
@@ -47,29 +61,43 @@ class Record(object):
         """
         Exports as csv row.
         """
+        return ','.join(self.fields())
+
+    def fields(self):
+        """
+        Returns the csv columns of the record.
+        """
         buyamt_str = str(self.buyamt) if self.buyamt is not None else ''
         sellamt_str = str(self.sellamt) if self.sellamt is not None else ''
         fee_str = str(self.fee) if self.fee is not None else ''
-        
-        return "{},{},{},{},{},{},{},{},{},{},{},{}".format(self.record_type, buyamt_str, self.buycur,
-                                                sellamt_str, self.sellcur, fee_str, self.fee_cur,
-                                                self.exchange, self.group, self.comment, self.date, self.tx_id)
 
-    def __eq__(self, other):
+        return [self.record_type, buyamt_str, self.buycur, sellamt_str, self.sellcur, fee_str, self.fee_cur,
+                self.exchange, self.group, self.comment, self.date, self.tx_id]
+
+    def group_key(self):
         """
-        Returns True if two records can be combined (same currencies, same venue, same date)
+        Returns the key of the group of records that can be combined (same currencies, same venue, same date),
+        or None if the record must not be combined with any other record.
         """
         # Check if the exchange contains any of the exception strings (case insensitive)
         if any(exc.lower() in self.exchange.lower() for exc in self.exchange_exceptions):
-            return False  # They are not equal if the self exchange contains any exception string
+            return None
+
+        return (self.record_type, self.buycur, self.sellcur, self.exchange, self.fee_cur,
+                self.date.split(' ')[0])  # Compare only the date part
 
-        res = (self.record_type == other.record_type and
-               self.buycur == other.buycur and
-               self.sellcur == other.sellcur and
-               self.exchange == other.exchange and
-               self.fee_cur == other.fee_cur and
-               self.date.split(' ')[0] == other.date.split(' ')[0])  # Compare only the date part
-        return res
+    def is_ignored(self):
+        """
+        Returns True if the record is redundant and should be dropped.
+        """
+        return self.record_type == "Lost" and self.exchange == "Binance" and "_fee" in self.tx_id
+
+    def __eq__(self, other):
+        """
+        Returns True if two records can be combined (same currencies, same venue, same date)
+        """
+        key = self.group_key()
+        return key is not None and key == other.group_key()
 
     def __add__(self, other):
         """
@@ -97,48 +125,206 @@ class Record(object):
                       self.fee_cur, self.exchange, group, comment, self.date, self.tx_id)
 
 
-def process_csv(input_file, output_file):
-    output = []
-    previous = None
-    header = None
+def aggregate_records(rows, first_index=0, groups=None):
+    """
+    Combines records of the same group, independent of the order of the rows.
+    The first record of a group keeps its position, date and tx id; the other records are added to it.
+    @param rows: csv rows (without header)
+    @type rows: iterable<list>
+    @param first_index: Index of the first row, used to order the groups.
+    @type first_index: int
+    @param groups: Groups to add to. A new dict is created if None.
+    @type groups: OrderedDict
+    @return: combined records keyed by group key, in order of their first row: key -> (row index, record)
+    @rtype: OrderedDict
+    """
+    if groups is None:
+        groups = OrderedDict()
+    for index, row in enumerate(rows, first_index):
+        record = Record(*row)
+        if record.is_ignored():
+            continue  # ignore redundant binance "lost" type fee
+        _add_to_groups(groups, index, record)
+    return groups
 
-    with open(input_file) as csvfile:
-        csvdata = csv.reader(csvfile, delimiter=',')
 
-        for row in csvdata:
-            if header is None:
-                header = row
-                continue
+def _add_to_groups(groups, index, record):
+    key = record.group_key()
+    if key is None:
+        key = ('row', index)
+    if key in groups:
+        first, previous = groups[key]
+        groups[key] = (first, previous + record)
+    else:
+        groups[key] = (index, record)
 
-            record = Record(*row)
-            if previous is None:
-                previous = record
-                continue
 
-            if record.record_type == "Lost" and record.exchange == "Binance" and "_fee" in record.tx_id:
-                continue # ignore redundant binance "lost" type fee
-            elif record == previous:
-                previous += record
-                continue
-            else:
-                output.append(previous)
-                previous = record
+def _partition(key, num_partitions):
+    return zlib.crc32(repr(key).encode('utf8')) % num_partitions
+
 
-        output.append(previous)
+def _spill(groups, partition_files):
+    """
+    Appends partially combined records to the partition files.
+    """
+    for key, (index, record) in groups.items():
+        partition_files[_partition(key, len(partition_files))].writerow([index] + record.fields())
+    groups.clear()
 
-    with open(output_file, 'w') as csvfile:
-        if header is not None:  # Ensure header is not None
-            csvfile.writelines(','.join(header) + '\n')
+
+def _aggregate_partition(filename):
+    """
+    Combines the spilled records of a single partition and writes them back ordered by their first row.
+    """
+    groups = OrderedDict()
+    with open(filename, newline='') as partition_file:
+        for row in csv.reader(partition_file):
+            _add_to_groups(groups, int(row[0]), Record(*row[1:]))
+    with open(filename, 'w', newline='') as partition_file:
+        writer = csv.writer(partition_file)
+        for index, record in sorted(groups.values(), key=lambda group: group[0]):
+            writer.writerow([index] + record.fields())
+
+
+def _read_partition(filename):
+    with open(filename, newline='') as partition_file:
+        for row in csv.reader(partition_file):
+            yield int(row[0]), Record(*row[1:])
+
+
+def _split_ranges(input_file, jobs):
+    """
+    Splits a csv file into line-aligned byte ranges, one per job.
+    Assumes that fields do not contain line breaks.
+    @return: header row and list of (start, end) byte ranges
+    @rtype: tuple
+    """
+    size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as csvfile:
+        header_line = csvfile.readline()
+        start = csvfile.tell()
+        boundaries = [start]
+        for job in range(1, jobs):
+            csvfile.seek(start + (size - start) * job // jobs)
+            csvfile.readline()
+            boundaries.append(max(csvfile.tell(), boundaries[-1]))
+        boundaries.append(size)
+
+    header = next(csv.reader([header_line.decode(locale.getpreferredencoding(False))]), None)
+    return header, [(begin, end) for begin, end in zip(boundaries, boundaries[1:]) if begin < end]
+
+
+def _aggregate_range(args):
+    """
+    Reads and combines the records of a single byte range. Runs in a worker process.
+    """
+    input_file, begin, end = args
+    with open(input_file, 'rb') as csvfile:
+        csvfile.seek(begin)
+        data = csvfile.read(end - begin)
+    text = io.StringIO(data.decode(locale.getpreferredencoding(False)), newline=None)
+    # Plain strings are a lot cheaper to send back to the parent process than records holding Decimals.
+    return [(index, record.fields()) for index, record in aggregate_records(csv.reader(text, delimiter=',')).values()]
+
+
+def aggregate_parallel(input_file, jobs):
+    """
+    Parses and combines the records of a csv file in a pool of processes.
+    The partially combined groups of all ranges are merged in the order of the ranges, so the result is the
+    same as `aggregate_records` on the whole file.
+    @param input_file: csv file to read
+    @type input_file: str
+    @param jobs: Number of processes.
+    @type jobs: int
+    @return: header row and combined records: key -> (row index, record)
+    @rtype: tuple
+    """
+    header, ranges = _split_ranges(input_file, jobs)
+    groups = OrderedDict()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(_aggregate_range, [(input_file, begin, end) for begin, end in ranges])
+        for range_no, partial_groups in enumerate(results):
+            for index, fields in partial_groups:
+                _add_to_groups(groups, (range_no, index), Record(*fields))
+    return header, groups
+
+
+def process_csv(input_file, output_file, max_groups=None, num_partitions=16, jobs=1):
+    """
+    Groups the records of a csv file by day.
+    Records are aggregated in a dict keyed on the group, so the input does not need to be sorted. If there are
+    more than `max_groups` groups, partially combined groups are spilled to partition files on disk, which are
+    combined and merged at the end.
+    @param input_file: csv file to read
+    @type input_file: str
+    @param output_file: csv file to write
+    @type output_file: str
+    @param max_groups: Maximum number of groups to keep in memory. `None` for no limit.
+    @type max_groups: int
+    @param num_partitions: Number of partitions to spill to.
+    @type num_partitions: int
+    @param jobs: Number of processes to parse the input with. With more than one job, all groups are kept in
+                 memory (`max_groups` is ignored). Compressed input is always parsed in a single process.
+    @type jobs: int
+    """
+    groups = OrderedDict()
+    header = None
+    if jobs > 1 and is_compressed(input_file):
+        jobs = 1  # A compressed file cannot be split into byte ranges.
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        partition_names = [os.path.join(spill_dir, '{}.csv'.format(i)) for i in range(num_partitions)]
+        partition_handles = []
+        partition_files = []
+
+        if jobs > 1:
+            header, groups = aggregate_parallel(input_file, jobs)
         else:
-            raise ValueError("Header is not initialized properly.")
-        for record in output:
-            csvfile.write(str(record) + '\n')
+            with open_file(input_file) as csvfile:
+                csvdata = csv.reader(csvfile, delimiter=',')
+                header = next(csvdata, None)
+
+                for index, row in enumerate(csvdata):
+                    aggregate_records([row], index, groups)
+                    if max_groups is not None and len(groups) > max_groups:
+                        if not partition_files:
+                            partition_handles = [open(name, 'w', newline='') for name in partition_names]
+                            partition_files = [csv.writer(handle) for handle in partition_handles]
+                        _spill(groups, partition_files)
+
+        if partition_files:
+            _spill(groups, partition_files)
+            for handle in partition_handles:
+                handle.close()
+            for name in partition_names:
+                _aggregate_partition(name)
+            output = heapq.merge(*[_read_partition(name) for name in partition_names], key=lambda group: group[0])
+        else:
+            output = groups.values()
+
+        num_exported = 0
+        with open_file(output_file, 'w') as csvfile:
+            if header is not None:  # Ensure header is not None
+                csvfile.writelines(','.join(header) + '\n')
+            else:
+                raise ValueError("Header is not initialized properly.")
+            for index, record in output:
+                csvfile.write(str(record) + '\n')
+                num_exported += 1
 
-    print("Exported {} records.".format(len(output)))
+    print("Exported {} records.".format(num_exported))
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: {} <csv_in> <csv_out>".format(sys.argv[0]))
-        exit(1)
+    parser = argparse.ArgumentParser(description="Groups trades that occur on the same day.")
+    parser.add_argument('csv_in')
+    parser.add_argument('csv_out')
+    parser.add_argument('--max-groups', type=int, default=None,
+                        help="spill groups to disk if there are more than this (default: no limit)")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="number of processes to parse the input with (default: 1)")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
 
-    process_csv(sys.argv[1], sys.argv[2])
\ No newline at end of file
+    with profiling.stage('process_csv'):
+        process_csv(args.csv_in, args.csv_out, max_groups=args.max_groups, jobs=args.jobs)
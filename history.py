@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Local store of historical series, `api.get_historical_currency()` and `api.get_historical_summary()`, that only
+fetches what it does not have yet.
+
+A series is kept per (currency, show_as_btc): the summary of all coins (currency `None`) comes from
+`getHistoricalSummary` in fiat or in BTC, a single currency from `getHistoricalCurrency`. Each series records
+the time intervals it covers, merging overlapping and adjacent ones. A query fetches only the gaps of the
+requested range and answers the rest from the points on disk, which are indexed by time for range and point
+lookups.
+
+Data of the last day (`cache.CLOSED_RANGE_MIN_AGE`) may still change, so it is returned but not marked as
+covered, and is fetched again by the next query.
+"""
+import json
+import os
+import re
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+import profiling
+from cache import CLOSED_RANGE_MIN_AGE
+from compression import open_file
+
+
+NON_SERIES_KEYS = ('success', 'method')
+
+SERIES_SUFFIX = '.json.gz'
+
+
+class HistoryError(Exception):
+    """
+    Raised if the API returns an error for a historical series.
+    """
+    pass
+
+
+def merge_interval(intervals, start, end):
+    """
+    Adds an interval to a sorted list of disjoint intervals, merging it with the ones it overlaps or touches.
+    @param intervals: [start, end] pairs of inclusive integer times, sorted by start
+    @type intervals: list<list>
+    @return: new list of intervals
+    @rtype: list<list>
+    """
+    before = [interval for interval in intervals if interval[1] < start - 1]
+    after = [interval for interval in intervals if interval[0] > end + 1]
+    for interval_start, interval_end in intervals[len(before):len(intervals) - len(after)]:
+        start = min(start, interval_start)
+        end = max(end, interval_end)
+    return before + [[start, end]] + after
+
+
+def find_gaps(intervals, start, end):
+    """
+    Returns the parts of a range that are not covered by intervals.
+    @param intervals: [start, end] pairs of inclusive integer times, sorted by start
+    @type intervals: list<list>
+    @return: (start, end) pairs
+    @rtype: list<tuple>
+    """
+    gaps = []
+    for interval_start, interval_end in intervals:
+        if interval_end < start:
+            continue
+        if interval_start > end:
+            break
+        if interval_start > start:
+            gaps.append((start, interval_start - 1))
+        start = interval_end + 1
+    if start <= end:
+        gaps.append((start, end))
+    return gaps
+
+
+class HistorySeries(object):
+    """
+    Points of one series, indexed by time, and the intervals they cover.
+    A point is the value of every key of the API response (eg the currency) at that time.
+    """
+
+    def __init__(self, times=None, points=None, intervals=None):
+        self.times = times or []
+        self.points = points or []
+        self.intervals = intervals or []
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, response, start, end):
+        """
+        Adds the points of an API response for the range `start` - `end`. Points outside the range are ignored.
+        """
+        by_time = dict(zip(self.times, self.points))
+        for name, values in response.items():
+            if name in NON_SERIES_KEYS or not isinstance(values, dict):
+                continue
+            for timestamp, value in values.items():
+                timestamp = int(timestamp)
+                if start <= timestamp <= end:
+                    point = by_time.get(timestamp)
+                    if point is None:
+                        point = by_time[timestamp] = OrderedDict()
+                    point[name] = value
+        self.times = sorted(by_time)
+        self.points = [by_time[timestamp] for timestamp in self.times]
+
+    def cover(self, start, end):
+        self.intervals = merge_interval(self.intervals, start, end)
+
+    def gaps(self, start, end):
+        return find_gaps(self.intervals, start, end)
+
+    def range(self, start, end):
+        """
+        Returns the points in a time range.
+        @return: (time, point) pairs, sorted by time
+        @rtype: list<tuple>
+        """
+        first = bisect_left(self.times, start)
+        last = bisect_right(self.times, end)
+        return list(zip(self.times[first:last], self.points[first:last]))
+
+    def at(self, timestamp):
+        """
+        Returns the last point at or before a time.
+        @return: (time, point), or None if there is none
+        @rtype: tuple
+        """
+        index = bisect_right(self.times, timestamp)
+        if not index:
+            return None
+        return self.times[index - 1], self.points[index - 1]
+
+    def to_odict(self):
+        return OrderedDict([
+            ('intervals', self.intervals),
+            ('times', self.times),
+            ('points', self.points),
+        ])
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['times'], data['points'], data['intervals'])
+
+
+class HistoryStore(object):
+    """
+    Historical series on disk, one file per series, that are completed from the API on demand.
+    """
+
+    def __init__(self, directory, client=None, clock=time.time):
+        """
+        @param directory: Directory to store the series in. Created if it does not exist.
+        @type directory: str
+        @param client: Client to fetch missing data with. `None` for the default client of `api`.
+        @type client: api.Client
+        """
+        self.directory = directory
+        self.client = client
+        self.clock = clock
+        self.series = {}
+        self.requests = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _client(self):
+        if self.client is None:
+            import api  # Imported here as the default client requires the API credentials.
+            self.client = api.default_client()
+        return self.client
+
+    def _path(self, currency, show_as_btc):
+        if currency is None:
+            name = 'summary_btc' if show_as_btc else 'summary'
+        else:
+            name = 'currency_' + re.sub(r'[^A-Za-z0-9_-]', lambda match: '%{:02x}'.format(ord(match.group())),
+                                        currency)
+        return os.path.join(self.directory, name + SERIES_SUFFIX)
+
+    @staticmethod
+    def _key(currency, show_as_btc):
+        # Values of a single currency come in fiat and BTC at once.
+        return currency, (bool(show_as_btc) if currency is None else None)
+
+    def get_series(self, currency=None, show_as_btc=False):
+        """
+        Returns the stored series of a currency, without fetching anything.
+        @rtype: HistorySeries
+        """
+        key = self._key(currency, show_as_btc)
+        series = self.series.get(key)
+        if series is None:
+            path = self._path(*key)
+            if os.path.exists(path):
+                with open_file(path) as input_file:
+                    series = HistorySeries.from_dict(json.load(input_file, object_pairs_hook=OrderedDict))
+            else:
+                series = HistorySeries()
+            self.series[key] = series
+        return series
+
+    def _save(self, currency, show_as_btc, series):
+        path = self._path(currency, show_as_btc)
+        with open_file(path + '.tmp', 'w', 'gzip') as output_file:
+            json.dump(series.to_odict(), output_file, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+    def _fetch(self, currency, show_as_btc, start, end):
+        if currency is None:
+            response = self._client().get_historical_summary(show_as_btc=show_as_btc, start_time=start,
+                                                             end_time=end)
+        else:
+            response = self._client().get_historical_currency(currency=currency, start_time=start, end_time=end)
+        self.requests += 1
+        if response.get('success') != 1:
+            raise HistoryError("{}: {}".format(response.get('method'),
+                                               response.get('error_msg', response.get('error'))))
+        return response
+
+    def update(self, currency=None, start_time=0, end_time=None, show_as_btc=False):
+        """
+        Fetches the parts of a range that are not stored yet.
+        @param currency: Currency, `None` for the summary of all coins.
+        @type currency: str
+        @param start_time: Start of the range (unix time, inclusive).
+        @type start_time: int
+        @param end_time: End of the range (unix time, inclusive). `None` for now.
+        @type end_time: int
+        @param show_as_btc: Values of the summary in BTC instead of fiat.
+        @type show_as_btc: bool
+        @return: the series
+        @rtype: HistorySeries
+        """
+        key = self._key(currency, show_as_btc)
+        series = self.get_series(*key)
+        now = int(self.clock())
+        start_time = int(start_time or 0)
+        end_time = now if end_time is None else int(end_time)
+        gaps = series.gaps(start_time, end_time)
+        if not gaps:
+            return series
+
+        closed = now - CLOSED_RANGE_MIN_AGE
+        with profiling.stage('history.fetch') as stage:
+            stage.add(requests=len(gaps))
+            for gap_start, gap_end in gaps:
+                series.add(self._fetch(currency, show_as_btc, gap_start, gap_end), gap_start, gap_end)
+                if gap_start <= closed:
+                    series.cover(gap_start, min(gap_end, closed))
+        self._save(key[0], key[1], series)
+        return series
+
+    def get_range(self, currency=None, start_time=0, end_time=None, show_as_btc=False):
+        """
+        Returns a series in a time range, fetching only what is missing. Same parameters as `update`.
+        @return: result with the structure of the API response: name (eg the currency) -> time -> value
+        @rtype: OrderedDict
+        """
+        series = self.update(currency, start_time, end_time, show_as_btc)
+        end_time = int(self.clock()) if end_time is None else int(end_time)
+        result = OrderedDict([
+            ('success', 1),
+            ('method', 'getHistoricalSummary' if currency is None else 'getHistoricalCurrency'),
+        ])
+        for timestamp, point in series.range(int(start_time or 0), end_time):
+            for name, value in point.items():
+                result.setdefault(name, OrderedDict())[str(timestamp)] = value
+        return result
+
+    def get_at(self, currency, timestamp, show_as_btc=False, lookback=86400):
+        """
+        Returns the last point of a series at or before a time, eg the daily value of a coin on a day.
+        @param timestamp: Time (unix time)
+        @type timestamp: int
+        @param lookback: Seconds before `timestamp` to fetch if the time is not covered yet.
+        @type lookback: int
+        @return: (time, point) with point: name -> value, or None if there is none
+        @rtype: tuple
+        """
+        timestamp = int(timestamp)
+        series = self.update(currency, timestamp - lookback, timestamp, show_as_btc)
+        return series.at(timestamp)
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental re-analysis of json exports.
+
+Both duplicates and movement matches are local to groups of records: a record can only be a duplicate of records
+with the same key fields, and a withdrawal can only match deposits of the same currency and net amount. An
+incremental analysis keeps the group of every record (by export key, with a hash of its content) and the findings
+of every group in a state file next to the export. On the next run, the export is diffed against the state and
+only the groups of new, changed, moved and removed records are analyzed again; all other findings are reused.
+
+Only the changed records and the other members of their groups are converted to Trade objects, so the work
+after reading and hashing the export is proportional to the number of changes. The findings equal those of a
+full run (`list_duplicates`, `match_movements`), including their order.
+"""
+import hashlib
+import json
+import os
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from collections.abc import Sequence
+from datetime import timedelta
+
+from compression import open_file
+from find_unmatched_movements import MOVEMENT_TYPES, MatchResult, match_movements, movement_key
+from store import NON_TRADE_KEYS, read_journal, apply_journal
+from tools import TradeConverter
+
+
+STATE_VERSION = 1
+
+
+def _digest(text):
+    return hashlib.blake2b(text.encode('utf8'), digest_size=8).hexdigest()
+
+
+def content_hash(trade):
+    """
+    Returns a hash of all fields of a trade dict.
+    @rtype: str
+    """
+    try:
+        # Records of the API have the same fields in the same order, and all values are strings.
+        text = '\x1f'.join(trade) + '\x1e' + '\x1f'.join(trade.values())
+    except TypeError:
+        text = json.dumps(trade, sort_keys=True)
+    return _digest(text)
+
+
+def read_export(filename):
+    """
+    Reads a json export (which may be compressed) into plain dicts, which is a lot faster than
+    `read_trades_from_file`. Dicts keep the order of the export too. The journal of a trade store is applied.
+    @rtype: dict
+    """
+    with open_file(filename) as input_file:
+        trades = json.load(input_file)
+    journal = read_journal(filename)
+    if journal:
+        trades = dict(apply_journal(trades.items(), journal))
+    return trades
+
+
+def _decimal_key(amount):
+    # Equal amounts (eg 1.0 and 1.00) have to get the same key.
+    return str(amount.normalize()) if amount else '0'
+
+
+class IncrementalAnalysis(object, metaclass=ABCMeta):
+    """
+    Analysis of groups of records whose findings are kept between runs.
+    Subclasses define the `name` of the analysis, the `group` of a trade and how to `analyze` a group.
+    """
+    name = None
+
+    def __init__(self, filename, report=None, **parameters):
+        """
+        Loads the state of the last run. The state is discarded if it was written with other parameters.
+        @param filename: Filename of the state file.
+        @type filename: str
+        @param report: Collects records that could not be converted, see `convert_trade_objs`.
+        @type report: ConversionReport
+        @param parameters: Parameters of the analysis, json-serializable.
+        """
+        self.filename = filename
+        self.parameters = OrderedDict(sorted(parameters.items()))
+        self.converter = TradeConverter(report)
+        self.records = {}  # export key -> (content hash, group), in export order
+        self.findings = {}  # group -> findings
+        self.members = {}  # group -> export keys, in export order
+        self.trades = None  # export of the last update
+        self.positions = {}  # export key -> position in the current export
+        self.changed = 0
+        self.removed = 0
+
+        if os.path.exists(filename):
+            with open(filename) as input_file:
+                state = json.load(input_file)
+            if (state.get('version') == STATE_VERSION and state.get('analysis') == self.name and
+                    state.get('parameters') == self.parameters):
+                # Records are stored as columns, which are much faster to decode.
+                records = state['records']
+                self.records = dict(zip(records['keys'], zip(records['hashes'], records['groups'])))
+                self.findings = state['findings']
+        for key, (_, group) in self.records.items():
+            if group is not None:
+                self.members.setdefault(group, []).append(key)
+
+    @abstractmethod
+    def group(self, trade):
+        """
+        Returns the group of a trade, or None if the trade is not analyzed.
+        @rtype: str
+        """
+
+    @abstractmethod
+    def analyze(self, items):
+        """
+        Analyzes a group.
+        @param items: (export key, Trade) pairs of the group, in export order
+        @type items: list<tuple>
+        @return: findings (by export key, json-serializable), None if there are none
+        """
+
+    def update(self, trades):
+        """
+        Brings the findings up to date with an export.
+        @param trades: Export, as read by `read_export`
+        @type trades: dict
+        @return: self
+        """
+        old_records = self.records
+        ordinals = dict((key, ordinal) for ordinal, key in enumerate(old_records))
+        positions = {}
+        changed = []
+        last_ordinal = -1
+        for position, (key, trade) in enumerate(trades.items()):
+            if key in NON_TRADE_KEYS:
+                continue
+            positions[key] = position
+            digest = content_hash(trade)
+            old = old_records.get(key)
+            if old is not None and old[0] == digest:
+                ordinal = ordinals[key]
+                if ordinal > last_ordinal:
+                    last_ordinal = ordinal
+                    continue
+                # The record moved before records that were before it: its group depends on the order.
+            changed.append((key, digest))
+        removed = [key for key in old_records if key not in positions]
+
+        affected = set()
+        for key in removed + [key for key, _ in changed if key in old_records]:
+            group = old_records.pop(key)[1]
+            if group is not None:
+                self.members[group].remove(key)
+                affected.add(group)
+
+        digests = dict(changed)
+        converted = dict(self.converter.convert_items((key, trades[key]) for key in digests))
+        records = {}
+        for key in positions:
+            record = old_records.get(key)
+            if record is None:
+                trade = converted.get(key)
+                if trade is None:
+                    continue  # Not kept, so that it is reported again on the next run.
+                group = self.group(trade)
+                record = (digests[key], group)
+                if group is not None:
+                    self.members.setdefault(group, []).append(key)
+                    affected.add(group)
+            records[key] = record
+
+        # Analyze the affected groups, converting their unchanged members too.
+        needed = []
+        for group in affected:
+            keys = self.members.get(group)
+            if keys:
+                keys.sort(key=positions.__getitem__)
+                needed.extend(key for key in keys if key not in converted)
+        converted.update(self.converter.convert_items((key, trades[key]) for key in needed))
+        for group in affected:
+            keys = self.members.get(group)
+            findings = self.analyze([(key, converted[key]) for key in keys]) if keys else None
+            if not keys:
+                self.members.pop(group, None)
+            if findings is None:
+                self.findings.pop(group, None)
+            else:
+                self.findings[group] = findings
+
+        self.trades = trades
+        self.records = records
+        self.positions = positions
+        self.changed = len(digests)
+        self.removed = len(removed)
+        return self
+
+    def convert(self, keys):
+        """
+        Converts records of the export of the last update.
+        @param keys: Export keys
+        @type keys: iterable<str>
+        @rtype: list<Trade>
+        """
+        return [trade for _, trade in self.converter.convert_items((key, self.trades[key]) for key in keys)]
+
+    def save(self):
+        """
+        Writes the state atomically (via a temporary file).
+        """
+        state = OrderedDict([
+            ('version', STATE_VERSION),
+            ('analysis', self.name),
+            ('parameters', self.parameters),
+            ('records', OrderedDict([
+                ('keys', list(self.records)),
+                ('hashes', [digest for digest, _ in self.records.values()]),
+                ('groups', [group for _, group in self.records.values()]),
+            ])),
+            ('findings', self.findings),
+        ])
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as output_file:
+            # json.dumps encodes in one go, much faster than json.dump for large states.
+            output_file.write(json.dumps(state, separators=(',', ':')))
+        os.replace(tmp_filename, self.filename)
+
+
+class IncrementalDuplicates(IncrementalAnalysis):
+    """
+    Incremental version of `find_duplicates.list_duplicates`, ignoring duplicates marked with `dupok`.
+    """
+    name = 'duplicates'
+
+    def group(self, trade):
+        # The fields that Trade objects are compared by.
+        return _digest('\x1f'.join((
+            trade.trade_id, trade.type, trade.time.isoformat(),
+            trade.buy_currency, trade.sell_currency, trade.fee_currency,
+            _decimal_key(trade.buy_amount), _decimal_key(trade.sell_amount), _decimal_key(trade.fee_amount),
+        )))
+
+    def analyze(self, items):
+        # Like list_duplicates, report the second occurrence of a trade.
+        if len(items) > 1 and 'dupok' not in items[1][1].comment:
+            return items[1][0]
+        return None
+
+    def duplicates(self):
+        """
+        Returns the duplicates, in the order of the export.
+        @rtype: list<Trade>
+        """
+        return self.convert(sorted(self.findings.values(), key=self.positions.__getitem__))
+
+
+class ConvertedPairs(Sequence):
+    """
+    Pairs of export keys whose records are converted to pairs of Trades when they are accessed.
+    """
+
+    def __init__(self, analysis, pairs):
+        """
+        @param analysis: Analysis whose last export holds the records.
+        @type analysis: IncrementalAnalysis
+        @param pairs: Pairs of export keys
+        @type pairs: list<tuple>
+        """
+        self.analysis = analysis
+        self.pairs = pairs
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.pairs)))]
+        return tuple(self.analysis.convert(self.pairs[index]))
+
+    def __iter__(self):
+        batch_size = self.analysis.converter.batch_size
+        for start in range(0, len(self.pairs), batch_size):
+            trades = iter(self.analysis.convert(key for pair in self.pairs[start:start + batch_size] for key in pair))
+            for trade in trades:
+                yield trade, next(trades)
+
+
+class IncrementalMovements(IncrementalAnalysis):
+    """
+    Incremental version of `find_unmatched_movements.match_movements`.
+    """
+    name = 'movements'
+
+    def __init__(self, filename, report=None, window=timedelta(0)):
+        super(IncrementalMovements, self).__init__(filename, report, window=window.total_seconds())
+        self.window = window
+
+    def group(self, trade):
+        if trade.type not in MOVEMENT_TYPES:
+            return None
+        currency, amount = movement_key(trade)
+        return _digest(currency + '\x1f' + _decimal_key(amount))
+
+    def analyze(self, items):
+        keys = dict((id(trade), key) for key, trade in items)
+        result = match_movements([trade for _, trade in items], self.window)
+        return [
+            [[keys[id(withdrawal)], keys[id(deposit)]] for withdrawal, deposit in result.matched],
+            [[keys[id(withdrawal)], keys[id(deposit)]] for withdrawal, deposit in result.ambiguous],
+            [keys[id(trade)] for trade in result.unmatched],
+        ]
+
+    def result(self):
+        """
+        Returns the result of `match_movements` on the whole export. Matched pairs are only converted when they are
+        accessed, converting all of them would defeat the purpose.
+        @rtype: MatchResult
+        """
+        # match_movements goes through the groups in the order of their first movement.
+        groups = sorted(self.findings, key=lambda group: self.positions[self.members[group][0]])
+        matched = []
+        ambiguous = []
+        unmatched = []
+        for group in groups:
+            group_matched, group_ambiguous, group_unmatched = self.findings[group]
+            matched.extend(tuple(pair) for pair in group_matched)
+            ambiguous.extend(group_ambiguous)
+            unmatched.extend(group_unmatched)
+
+        trades = dict(self.converter.convert_items(
+            (key, self.trades[key]) for key in set(unmatched).union(*ambiguous)))
+        unmatched = sorted(trades[key] for key in unmatched)
+        ambiguous = [(trades[withdrawal], trades[deposit]) for withdrawal, deposit in ambiguous]
+        return MatchResult(ConvertedPairs(self, matched), ambiguous, unmatched)
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Timers and counters for API calls and analysis stages.
+
+Profiling is off by default and costs next to nothing then: `stage()` returns a shared no-op context and
+`iterate()` returns the iterable unchanged. Enable it with
+
+ - the `COINTRACKING_PROFILE` environment variable: a filename to write the json summary to, or `-` to print it
+   to stderr. `COINTRACKING_CPROFILE` additionally writes a cProfile dump (pstats format) to the given file.
+ - `--profile [FILE]` and `--cprofile FILE` in the scripts.
+ - `profiling.enable()`
+
+The summary is written when the program exits. For every stage it contains the number of calls, the time spent,
+records per second where records are counted, the stage's own counters (eg bytes and retries of API calls) and
+the peak memory (max resident set size) of the process when the stage last finished.
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+
+_enabled = False
+_stages = OrderedDict()
+_summary_file = None
+_profiler = None
+_cprofile_file = None
+
+
+class Stage(object):
+    """
+    Accumulated timings and counters of a stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.counters = OrderedDict()
+        self.max_rss = None
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        max_rss = _max_rss()
+        with self.lock:
+            self.calls += 1
+            self.seconds += seconds
+            self.max_rss = max_rss
+
+    def add(self, **counters):
+        """
+        Adds to the counters of the stage, eg `add(records=100, bytes=2048)`.
+        """
+        with self.lock:
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_odict(self):
+        result = OrderedDict([
+            ('calls', self.calls),
+            ('seconds', round(self.seconds, 6)),
+        ])
+        result.update(self.counters)
+        if 'records' in self.counters and self.seconds:
+            result['records_per_second'] = round(self.counters['records'] / self.seconds)
+        if self.max_rss is not None:
+            result['max_rss_bytes'] = self.max_rss
+        return result
+
+
+class _Timer(object):
+    """
+    Times one block of a stage. Stages can be timed in several threads at once.
+    """
+
+    def __init__(self, current):
+        self.stage = current
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stage.record(time.perf_counter() - self.start)
+        return False
+
+    def add(self, **counters):
+        self.stage.add(**counters)
+
+
+class _NullStage(object):
+    """
+    Stage that does nothing, used while profiling is disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, **counters):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def _max_rss():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def is_enabled():
+    return _enabled
+
+
+def stage(name):
+    """
+    Returns a context manager that times a block as part of the stage of this name:
+
+        with profiling.stage('match_movements') as s:
+            s.add(records=len(movements))
+            ...
+
+    @param name: Name of the stage, eg `api.getTrades`.
+    @type name: str
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Timer(_get_stage(name))
+
+
+def _get_stage(name):
+    current = _stages.get(name)
+    if current is None:
+        current = _stages.setdefault(name, Stage(name))
+    return current
+
+
+def count(name, **counters):
+    """
+    Adds to the counters of a stage without timing anything, eg `count('transport.http', retries=1)`.
+    """
+    if _enabled:
+        _get_stage(name).add(**counters)
+
+
+def iterate(name, iterable):
+    """
+    Times the production of the items of an iterable (eg parsing), excluding the time the consumer spends on
+    them, and counts them as records of the stage.
+    @param name: Name of the stage
+    @type name: str
+    @param iterable: Items
+    @type iterable: iterable
+    @return: the iterable itself if profiling is disabled
+    @rtype: iterable
+    """
+    if not _enabled:
+        return iterable
+    return _iterate(_get_stage(name), iter(iterable))
+
+
+def _iterate(current, iterator):
+    clock = time.perf_counter
+    seconds = 0.0
+    records = 0
+    try:
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            finally:
+                seconds += clock() - start
+            records += 1
+            yield item
+    except StopIteration:
+        pass
+    finally:
+        current.add(records=records)
+        current.record(seconds)
+
+
+def summary():
+    """
+    Returns the timings and counters of all stages.
+    @rtype: OrderedDict
+    """
+    return OrderedDict((name, current.to_odict()) for name, current in _stages.items())
+
+
+def write_summary(filename=None):
+    """
+    Writes the summary as json to a file, or to stderr if `filename` is `None` or `-`.
+    """
+    data = json.dumps(summary(), indent=4)
+    if filename is None or filename == '-':
+        print(data, file=sys.stderr)
+    else:
+        with open(filename, 'w') as output_file:
+            output_file.write(data + '\n')
+
+
+def enable(summary_file='-', cprofile_file=None):
+    """
+    Enables profiling. The summary (and the cProfile dump) is written when the program exits.
+    @param summary_file: File to write the json summary to, `-` for stderr, `None` to not write it.
+    @type summary_file: str
+    @param cprofile_file: File to write a cProfile dump to. `None` to not run cProfile.
+    @type cprofile_file: str
+    """
+    global _enabled, _summary_file, _profiler, _cprofile_file
+    if not _enabled:
+        atexit.register(_finish)
+    _enabled = True
+    _summary_file = summary_file
+    if cprofile_file and _profiler is None:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _cprofile_file = cprofile_file
+        _profiler.enable()
+
+
+def _finish():
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_cprofile_file)
+    if _summary_file is not None:
+        write_summary(_summary_file)
+
+
+def add_arguments(parser):
+    """
+    Adds the `--profile` and `--cprofile` options to a script's argument parser.
+    """
+    parser.add_argument('--profile', nargs='?', const='-', metavar='SUMMARY_FILE',
+                        help="write timings and counters as json to SUMMARY_FILE (default: stderr)")
+    parser.add_argument('--cprofile', metavar='PSTATS_FILE',
+                        help="also run cProfile and write its stats to PSTATS_FILE")
+
+
+def enable_from_args(args):
+    """
+    Enables profiling if requested by the options added with `add_arguments`.
+    """
+    if args.profile or args.cprofile:
+        enable(args.profile or '-', args.cprofile)
+
+
+if os.environ.get('COINTRACKING_PROFILE') or os.environ.get('COINTRACKING_CPROFILE'):
+    enable(os.environ.get('COINTRACKING_PROFILE') or '-', os.environ.get('COINTRACKING_CPROFILE'))
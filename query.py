@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Queries on local trade data, eg "all Withdrawals of ETH from Kraken in March", without loading Trade objects.
+
+`QueryIndex` works on a `TradeTable` (or a snapshot). Rows are ordered by time once, and every indexed field
+(type, the three currencies, exchange and group, plus `currency` for any of the three) gets a posting list per
+value: the time ranks of its rows, in ascending order. A query picks the shortest posting list of its filters,
+narrows it to the time range with a binary search and checks the other filters on the dictionary codes of the
+candidate rows, so it never scans the whole table unless it has no filter at all.
+
+Results are lazy iterators over rows in time order (`TradeRow`, with the same API as `Trade`). Aggregates
+(`count`, `sum`, `group_by`) run on the same candidates and add scaled integers instead of Decimals.
+
+    index = QueryIndex(TradeTable.from_file('trades.json'))
+    query = index.query(type='Withdrawal', currency='ETH', exchange='Kraken',
+                        start_time=datetime(2018, 3, 1), end_time=datetime(2018, 4, 1))
+    for trade in query:
+        ...
+    query.count()
+    query.sum('sell_amount')
+    index.query(type='Trade').group_by('exchange', 'fee_amount')
+"""
+import argparse
+import sys
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime, date
+from decimal import Decimal
+from heapq import merge
+
+import profiling
+from tools import prettify, iter_trades, ConversionReport, ReportWriter
+from trade_table import AMOUNT_COLUMNS, AMOUNT_EXPONENT, AMOUNT_OVERFLOW, TradeRow, TradeTable
+
+
+INDEXED_FIELDS = ('type', 'buy_currency', 'sell_currency', 'fee_currency', 'exchange', 'group')
+CURRENCY_FIELDS = ('buy_currency', 'sell_currency', 'fee_currency')
+GROUP_KEYS = ('day', 'month', 'year') + INDEXED_FIELDS
+
+
+def _to_timestamp(time):
+    if time is None or isinstance(time, int):
+        return time
+    if isinstance(time, date) and not isinstance(time, datetime):
+        time = datetime.combine(time, datetime.min.time())
+    return int(time.timestamp())
+
+
+class QueryIndex(object):
+    """
+    Secondary indexes on the rows of a TradeTable.
+    """
+
+    def __init__(self, table):
+        """
+        @param table: Trades. The table must not change while it is indexed.
+        @type table: TradeTable
+        """
+        self.table = table
+        with profiling.stage('query.index') as stage:
+            stage.add(records=len(table))
+            self.order = array('I', table.argsort())  # time rank -> row
+            self.times = array('q', (table.times[row] for row in self.order))  # time rank -> time
+            self.postings = {}  # field -> value -> time ranks
+            for field in INDEXED_FIELDS:
+                column = table.strings[field]
+                codes = column.codes
+                lists = [array('I') for _ in column.values]
+                for rank, row in enumerate(self.order):
+                    lists[codes[row]].append(rank)
+                self.postings[field] = dict(zip(column.values, lists))
+            currencies = {}
+            for field in CURRENCY_FIELDS:
+                for value, ranks in self.postings[field].items():
+                    if value:
+                        currencies.setdefault(value, []).append(ranks)
+            # A row with the same currency in several columns is listed once.
+            self.postings['currency'] = dict(
+                (value, array('I', _unique(merge(*lists)))) for value, lists in currencies.items())
+
+    @classmethod
+    def from_file(cls, filename, report=None):
+        """
+        Indexes a json export or a snapshot.
+        @param report: Collects records of a json export that could not be converted.
+        @type report: ConversionReport
+        @rtype: QueryIndex
+        """
+        trades = iter_trades(filename, report)
+        if not isinstance(trades, TradeTable):
+            trades = TradeTable.from_file(filename, report)
+        return cls(trades)
+
+    def __len__(self):
+        return len(self.order)
+
+    def values(self, field):
+        """
+        Returns the values of an indexed field (or `currency`) with the number of rows of each.
+        @rtype: OrderedDict
+        """
+        return OrderedDict((value, len(ranks)) for value, ranks in sorted(self.postings[field].items()) if ranks)
+
+    def query(self, start_time=None, end_time=None, **filters):
+        """
+        Returns a query on the trades.
+        @param start_time: First time (inclusive). `None` for no start time.
+        @type start_time: datetime|date|int
+        @param end_time: Last time (exclusive). `None` for no end time.
+        @type end_time: datetime|date|int
+        @param filters: Values of fields, see `INDEXED_FIELDS`, plus `currency` to match any of the currencies.
+        @rtype: Query
+        """
+        return Query(self, start_time, end_time, filters)
+
+
+def _unique(ranks):
+    last = None
+    for rank in ranks:
+        if rank != last:
+            yield rank
+            last = rank
+
+
+class Query(object):
+    """
+    Filtered view on the trades of a QueryIndex. Iterating yields the matching rows in time order.
+    """
+
+    def __init__(self, index, start_time, end_time, filters):
+        unknown = set(filters).difference(INDEXED_FIELDS + ('currency',))
+        if unknown:
+            raise ValueError("Unknown fields {}".format(sorted(unknown)))
+        self.index = index
+        self.start_time = start_time
+        self.end_time = end_time
+        self.filters = OrderedDict((field, value) for field, value in sorted(filters.items()) if value is not None)
+
+    def filter(self, start_time=None, end_time=None, **filters):
+        """
+        Returns a query that is further restricted. Same parameters as `QueryIndex.query`.
+        @rtype: Query
+        """
+        combined = OrderedDict(self.filters)
+        for field, value in filters.items():
+            if value is not None and combined.get(field, value) != value:
+                value = ()  # Contradicting values, nothing matches.
+            combined[field] = value
+        start_time = max(_to_timestamp(time) for time in (self.start_time, start_time) if time is not None) \
+            if self.start_time is not None or start_time is not None else None
+        end_time = min(_to_timestamp(time) for time in (self.end_time, end_time) if time is not None) \
+            if self.end_time is not None or end_time is not None else None
+        return Query(self.index, start_time, end_time, combined)
+
+    def _rank_range(self):
+        times = self.index.times
+        start_time = _to_timestamp(self.start_time)
+        end_time = _to_timestamp(self.end_time)
+        first = 0 if start_time is None else bisect_left(times, start_time)
+        last = len(times) if end_time is None else bisect_left(times, end_time)
+        return first, last
+
+    def _plan(self):
+        """
+        Returns the candidate time ranks and the checks of the filters that are not applied by the candidates.
+        """
+        first, last = self._rank_range()
+        postings = []
+        for field, value in self.filters.items():
+            ranks = self.index.postings[field].get(value) if isinstance(value, str) else None
+            if ranks is None:
+                return (), []
+            postings.append((len(ranks), field, ranks))
+        if not postings:
+            return range(first, max(first, last)), []
+
+        postings.sort(key=lambda posting: posting[0])
+        _, field, ranks = postings[0]
+        candidates = ranks[bisect_left(ranks, first):bisect_left(ranks, last)]
+
+        strings = self.index.table.strings
+        checks = []
+        for _, field, _ in postings[1:]:
+            value = self.filters[field]
+            fields = CURRENCY_FIELDS if field == 'currency' else (field,)
+            # Compare codes instead of strings. A column without the value cannot match.
+            codes = [(strings[name].codes, strings[name].values.index(value))
+                     for name in fields if value in strings[name].values]
+            checks.append(codes)
+        return candidates, checks
+
+    def _rows(self):
+        candidates, checks = self._plan()
+        order = self.index.order
+        if not checks:
+            for rank in candidates:
+                yield order[rank]
+            return
+        for rank in candidates:
+            row = order[rank]
+            if all(any(codes[row] == code for codes, code in check) for check in checks):
+                yield row
+
+    def __iter__(self):
+        table = self.index.table
+        for row in self._rows():
+            yield TradeRow(table, row)
+
+    def count(self):
+        """
+        Returns the number of matching trades. With a single filter, only binary searches are needed.
+        @rtype: int
+        """
+        candidates, checks = self._plan()
+        if not checks:
+            return len(candidates)
+        return sum(1 for _ in self._rows())
+
+    def sum(self, column):
+        """
+        Returns the sum of an amount column over the matching trades.
+        @param column: One of `trade_table.AMOUNT_COLUMNS`
+        @type column: str
+        @rtype: Decimal
+        """
+        return self.group_by(None, column).get(None, Decimal(0))
+
+    def group_by(self, key, column=None):
+        """
+        Returns the number of matching trades, or the sum of an amount column, per group.
+        @param key: One of `GROUP_KEYS` (`day`, `month` and `year` of the time, or an indexed field), `None` for a
+                    single group.
+        @type key: str
+        @param column: Amount column to sum, see `trade_table.AMOUNT_COLUMNS`. `None` to count.
+        @type column: str
+        @return: result as dict: group -> count or sum, ordered by group
+        @rtype: OrderedDict
+        """
+        if key is not None and key not in GROUP_KEYS:
+            raise ValueError("Unknown group key {}".format(key))
+        if column is not None and column not in AMOUNT_COLUMNS:
+            raise ValueError("Unknown amount column {}".format(column))
+        table = self.index.table
+        if key is None:
+            group_of = lambda row: None
+        elif key in INDEXED_FIELDS:
+            group_of = table.strings[key].codes.__getitem__
+        else:
+            group_of = table.times.__getitem__
+
+        totals = {}
+        overflow = {}
+        if column is None:
+            for row in self._rows():
+                group = group_of(row)
+                totals[group] = totals.get(group, 0) + 1
+        else:
+            amounts = table.amounts[column]
+            scaled = amounts.scaled
+            for row in self._rows():
+                group = group_of(row)
+                value = scaled[row]
+                if value == AMOUNT_OVERFLOW:
+                    overflow[group] = overflow.get(group, Decimal(0)) + amounts.overflow[row]
+                    value = 0
+                totals[group] = totals.get(group, 0) + value
+
+        result = {}
+        for group, total in totals.items():
+            if column is not None:
+                total = Decimal(total).scaleb(-AMOUNT_EXPONENT) + overflow.get(group, Decimal(0))
+            if key in INDEXED_FIELDS:
+                group = table.strings[key].values[group]
+            elif key is not None:
+                group = _period(datetime.fromtimestamp(group).date(), key)
+            result[group] = result.get(group, 0) + total
+        return OrderedDict(sorted(result.items()))
+
+
+def _period(day, key):
+    if key == 'month':
+        return day.replace(day=1)
+    if key == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+
+def _time_arg(value):
+    return datetime.fromtimestamp(int(value)) if value.isdigit() else datetime.fromisoformat(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Queries the trades of a json export or snapshot.")
+    parser.add_argument('json_file')
+    for name in INDEXED_FIELDS + ('currency',):
+        parser.add_argument('--' + name.replace('_', '-'), dest=name,
+                            help="only trades with this {}".format(name.replace('_', ' ')))
+    parser.add_argument('--start-time', type=_time_arg, help="first time, unix time or ISO date (inclusive)")
+    parser.add_argument('--end-time', type=_time_arg, help="last time, unix time or ISO date (exclusive)")
+    parser.add_argument('--count', action='store_true', help="print the number of trades")
+    parser.add_argument('--sum', choices=AMOUNT_COLUMNS, help="print the sum of an amount column")
+    parser.add_argument('--group-by', choices=GROUP_KEYS, help="print the count or sum per group")
+    parser.add_argument('--format', choices=ReportWriter.FORMATS, default='json',
+                        help="output format of the trades (default: json)")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    report = ConversionReport()
+    query_index = QueryIndex.from_file(args.json_file, report)
+    trade_query = query_index.query(args.start_time, args.end_time,
+                                    **dict((name, getattr(args, name)) for name in INDEXED_FIELDS + ('currency',)))
+    if report.rejected:
+        print("Skipped unexpected records:", file=sys.stderr)
+        print(prettify(report.rejected, indent=4), file=sys.stderr)
+
+    if args.group_by:
+        result = trade_query.group_by(args.group_by, args.sum)
+        print(prettify(OrderedDict((str(group), value) for group, value in result.items()), indent=4))
+    elif args.sum:
+        print(trade_query.sum(args.sum))
+    elif args.count:
+        print(trade_query.count())
+    else:
+        # Trades are written as they are found.
+        writer = ReportWriter(format=args.format)
+        for trade in trade_query:
+            writer.write(trade.to_odict(), 'trade')
+        writer.close()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Compact binary snapshot of a trade export.
+
+A snapshot stores the columns of a TradeTable as fixed-width binary arrays (times, scaled amounts, string
+codes), plus the string dictionaries. Loading memory-maps the file and uses the columns in place, so there is
+no json parsing and almost no copying.
+
+Compressed snapshots (see `compression.py`) are decompressed into memory instead of being memory-mapped.
+
+File layout:
+ - magic (8 bytes)
+ - length of the header (uint32, little endian)
+ - header (json): number of rows, byte order, string dictionaries, amount overflows and the column directory
+ - columns, each aligned to 8 bytes
+"""
+import json
+import mmap
+import struct
+import sys
+from array import array
+from decimal import Decimal
+
+from compression import open_file, compression_for, is_compressed
+from trade_table import TradeTable, StringColumn, AmountColumn, AMOUNT_EXPONENT, STRING_COLUMNS, AMOUNT_COLUMNS
+
+
+MAGIC = b'CTSNAP1\0'
+ALIGNMENT = 8
+
+
+class SnapshotError(Exception):
+    """
+    Raised if a file is not a snapshot or was written in an incompatible format.
+    """
+    pass
+
+
+class _BlobStrings(object):
+    """
+    Read-only sequence of strings stored as one utf8 blob and their end offsets.
+    """
+
+    def __init__(self, blob, ends):
+        self.blob = blob
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, row):
+        start = self.ends[row - 1] if row > 0 else 0
+        return bytes(self.blob[start:self.ends[row]]).decode('utf8')
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+
+def is_snapshot(filename):
+    """
+    Returns True if the file is a snapshot.
+    """
+    with open_file(filename, 'rb') as input_file:
+        return input_file.read(len(MAGIC)) == MAGIC
+
+
+def write_snapshot(table, filename):
+    """
+    Writes a trade table to a snapshot file, compressed according to its extension (eg `.gz`).
+    @param table: Trades
+    @type table: TradeTable
+    @param filename: Filename
+    @type filename: str
+    """
+    trade_ids = [trade_id.encode('utf8') for trade_id in table.trade_ids]
+    trade_id_ends = array('q')
+    end = 0
+    for trade_id in trade_ids:
+        end += len(trade_id)
+        trade_id_ends.append(end)
+
+    columns = [
+        ('times', table.times),
+        ('imported_times', table.imported_times),
+        ('trade_id_ends', trade_id_ends),
+        ('trade_id_blob', b''.join(trade_ids)),
+    ]
+    for name in STRING_COLUMNS:
+        columns.append(('codes:' + name, table.strings[name].codes))
+    for name in AMOUNT_COLUMNS:
+        columns.append(('scaled:' + name, table.amounts[name].scaled))
+        columns.append(('exponents:' + name, table.amounts[name].exponents))
+
+    directory = []
+    blobs = []
+    offset = 0
+    for name, column in columns:
+        data = column.tobytes() if isinstance(column, array) else bytes(column)
+        padding = -len(data) % ALIGNMENT
+        directory.append([name, column.typecode if isinstance(column, array) else 'B', offset, len(data)])
+        blobs.append(data + b'\0' * padding)
+        offset += len(data) + padding
+
+    header = json.dumps({
+        'rows': len(table),
+        'byteorder': sys.byteorder,
+        'amount_exponent': AMOUNT_EXPONENT,
+        'itemsizes': dict((typecode, array(typecode).itemsize) for typecode in 'qIb'),
+        'strings': dict((name, table.strings[name].values) for name in STRING_COLUMNS),
+        'overflow': dict((name, dict((str(row), str(value)) for row, value in table.amounts[name].overflow.items()))
+                         for name in AMOUNT_COLUMNS),
+        'columns': directory,
+    }, separators=(',', ':')).encode('utf8')
+    header += b' ' * (-(len(MAGIC) + 4 + len(header)) % ALIGNMENT)
+
+    with open_file(filename, 'wb', compression_for(filename)) as output_file:
+        output_file.write(MAGIC)
+        output_file.write(struct.pack('<I', len(header)))
+        output_file.write(header)
+        for blob in blobs:
+            output_file.write(blob)
+
+
+def load_snapshot(filename):
+    """
+    Memory-maps a snapshot file. The columns of the returned table are read-only views on the file.
+    Compressed snapshots are decompressed into memory.
+    @param filename: Filename
+    @type filename: str
+    @return: trades
+    @rtype: TradeTable
+    """
+    compressed = is_compressed(filename)
+    with open_file(filename, 'rb') as input_file:
+        if input_file.read(len(MAGIC)) != MAGIC:
+            raise SnapshotError("{} is not a trade snapshot".format(filename))
+        header_length = struct.unpack('<I', input_file.read(4))[0]
+        header = json.loads(input_file.read(header_length).decode('utf8'))
+        data_start = len(MAGIC) + 4 + header_length
+        if not compressed:
+            mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    if compressed:
+        # Not all decompressing streams can seek back (eg zstandard), so the file is opened again.
+        with open_file(filename, 'rb') as input_file:
+            mapped = input_file.read()
+
+    if header['byteorder'] != sys.byteorder or header['amount_exponent'] != AMOUNT_EXPONENT or \
+            any(array(typecode).itemsize != size for typecode, size in header['itemsizes'].items()):
+        raise SnapshotError("{} was written on an incompatible platform".format(filename))
+
+    view = memoryview(mapped)
+    columns = {}
+    for name, typecode, offset, length in header['columns']:
+        column = view[data_start + offset:data_start + offset + length]
+        columns[name] = column.cast(typecode) if typecode != 'B' else column
+
+    table = TradeTable()
+    table.times = columns['times']
+    table.imported_times = columns['imported_times']
+    table.trade_ids = _BlobStrings(columns['trade_id_blob'], columns['trade_id_ends'])
+    for name in STRING_COLUMNS:
+        table.strings[name] = StringColumn(header['strings'][name], columns['codes:' + name])
+    for name in AMOUNT_COLUMNS:
+        overflow = dict((int(row), Decimal(value)) for row, value in header['overflow'][name].items())
+        table.amounts[name] = AmountColumn(columns['scaled:' + name], columns['exponents:' + name], overflow)
+    return table
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent local store for trades pulled from the cointracking.info API.
+
+The store is a json file in exactly the format written by `export_to_json.py` (trades keyed by trade id), so all
+scripts that work on a json export also work on a store. Next to it, a small state file records the high-water
+mark of the last sync, which allows fetching only newer records on the next run.
+
+Syncs do not rewrite the json file: new, changed and deleted records are appended to a journal
+(`<filename>.journal`, one json array `[trade_id, record]` per line, `null` for deleted records) whose entries
+replace those of the json file. `read_journal` and `apply_journal` apply it, and all readers of json exports in
+the tools do so. Once the journal has grown to `JOURNAL_COMPACT_RATIO` of the store, it is merged into the json
+file. A line left incomplete by an interrupted save is skipped when reading and cut off before the next append.
+
+Trades that were deleted on cointracking are removed if they fall into the time range of a sync. Deletions of
+older trades are only noticed by a full sync (empty store, or `lookback` reaching back to the first trade).
+
+The store may be compressed (see `compression.py`): it is read whatever its codec and written compressed
+according to its extension, eg `trades.json.gz`.
+
+A store can hold the trades of several accounts. Their trade ids are tagged with the account name
+(`<account>:<trade_id>`), which keeps them unique across accounts, and every account has its own high-water mark.
+"""
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from compression import open_file, compression_for
+
+
+# Fields returned by the API that are not trades (grrrr)
+NON_TRADE_KEYS = ('success', 'method')
+
+ACCOUNT_SEPARATOR = ':'
+
+STATE_SUFFIX = '.state'
+JOURNAL_SUFFIX = '.journal'
+
+# The journal is merged into the json file when it has this many entries per trade of the store.
+JOURNAL_COMPACT_RATIO = 0.25
+
+
+class SyncError(Exception):
+    """
+    Raised if the API returned an error instead of trades.
+    """
+    pass
+
+
+def tag_account(response, account):
+    """
+    Returns a copy of a `get_trades` response with the trade ids (and keys) tagged with the account name.
+    @param response: Result of `api.get_trades()`.
+    @type response: dict
+    @param account: Name of the account
+    @type account: str
+    @rtype: OrderedDict
+    """
+    tagged = OrderedDict()
+    for key, trade in response.items():
+        if key in NON_TRADE_KEYS:
+            tagged[key] = trade
+            continue
+        trade = OrderedDict(trade)
+        trade['trade_id'] = account + ACCOUNT_SEPARATOR + trade['trade_id']
+        tagged[account + ACCOUNT_SEPARATOR + key] = trade
+    return tagged
+
+
+def merge_accounts(responses):
+    """
+    Merges the `get_trades` responses of several accounts into one, with the trade ids tagged with the account.
+    @param responses: Results of `api.get_trades()` by account name.
+    @type responses: dict
+    @rtype: OrderedDict
+    """
+    merged = OrderedDict([('success', 1), ('method', 'getTrades')])
+    for account, response in responses.items():
+        if response.get('success') != 1:
+            raise SyncError("API returned an error for {}: {}".format(account, response.get('error_msg', response)))
+        merged.update(tag_account(response, account))
+    return merged
+
+
+def split_trade_id(trade_id):
+    """
+    Returns the account and the original trade id of a tagged trade id. The account is None for untagged ids.
+    @rtype: tuple
+    """
+    account, separator, original_id = trade_id.rpartition(ACCOUNT_SEPARATOR)
+    return (account, original_id) if separator else (None, trade_id)
+
+
+def read_journal(filename):
+    """
+    Reads the journal of a store.
+    @param filename: Filename of the json file of the store (not of the journal).
+    @type filename: str
+    @return: trade_id -> record, None for deleted records, in the order of the last change; None if there is no
+             journal
+    @rtype: OrderedDict
+    """
+    journal_filename = filename + JOURNAL_SUFFIX
+    if not os.path.exists(journal_filename):
+        return None
+    journal = OrderedDict()
+    with open(journal_filename) as input_file:
+        for line in input_file:
+            try:
+                trade_id, record = json.loads(line, object_pairs_hook=OrderedDict)
+            except ValueError:
+                continue  # Line of an interrupted save, the lines after it are complete.
+            journal.pop(trade_id, None)
+            journal[trade_id] = record
+    return journal
+
+
+def _truncate_partial_line(filename):
+    """
+    Cuts off a last line without newline, left by an interrupted append, so that the next append starts a line.
+    """
+    with open(filename, 'rb+') as journal_file:
+        end = journal_file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(position - 4096, 0)
+            journal_file.seek(start)
+            block = journal_file.read(position - start)
+            if position == end and block.endswith(b'\n'):
+                return
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                journal_file.truncate(start + newline + 1)
+                return
+            position = start
+        journal_file.truncate(0)
+
+
+def apply_journal(items, journal):
+    """
+    Applies a journal to the items of a json file.
+    @param items: (key, record) pairs of the json file
+    @type items: iterable<tuple>
+    @param journal: Result of `read_journal`. None for no journal.
+    @type journal: OrderedDict
+    @return: generator of (key, record) pairs: the changed records in place of the old ones, then the new ones
+    @rtype: generator
+    """
+    if not journal:
+        for item in items:
+            yield item
+        return
+    journal = OrderedDict(journal)
+    for key, record in items:
+        if key in journal:
+            record = journal.pop(key)
+            if record is None:
+                continue
+        yield key, record
+    for key, record in journal.items():
+        if record is not None:
+            yield key, record
+
+
+class TradeStore(object):
+    """
+    Local trade store keyed on `trade_id`.
+    """
+
+    def __init__(self, filename, compact=False):
+        """
+        Opens a store. The store is empty if the file does not exist yet.
+        @param filename: Filename of the json file backing the store.
+        @type filename: str
+        @param compact: Save compact json instead of indented json.
+        @type compact: bool
+        """
+        self.filename = filename
+        self.compact = compact
+        self.state_filename = filename + STATE_SUFFIX
+        self.journal_filename = filename + JOURNAL_SUFFIX
+        self.trades = OrderedDict()
+        self.changes = OrderedDict()  # trade_id -> record (None if deleted) not saved yet
+        self.journal_entries = 0
+        self.state = OrderedDict([('max_time', None), ('max_imported_time', None)])
+
+        if os.path.exists(self.filename):
+            with open_file(self.filename) as input_file:
+                data = json.load(input_file, object_pairs_hook=OrderedDict)
+            journal = read_journal(self.filename)
+            self.journal_entries = len(journal or ())
+            for key, trade in apply_journal(data.items(), journal):
+                if key not in NON_TRADE_KEYS:
+                    self.trades[trade['trade_id']] = trade
+        if os.path.exists(self.state_filename):
+            with open(self.state_filename) as input_file:
+                self.state.update(json.load(input_file))
+        elif self.trades:
+            # Store written by a plain export: derive the high-water mark from the data.
+            self._update_high_water_mark(self.trades.values())
+
+    def __len__(self):
+        return len(self.trades)
+
+    @property
+    def max_time(self):
+        return self.state['max_time']
+
+    @property
+    def max_imported_time(self):
+        return self.state['max_imported_time']
+
+    @property
+    def accounts(self):
+        return list(self.state.get('accounts', ()))
+
+    def _marks(self, account):
+        """
+        Returns the high-water marks of an account, or of the whole store if `account` is None.
+        """
+        if account is None:
+            return self.state
+        accounts = self.state.setdefault('accounts', OrderedDict())
+        if account not in accounts:
+            accounts[account] = OrderedDict([('max_time', None), ('max_imported_time', None)])
+        return accounts[account]
+
+    def _update_high_water_mark(self, trades):
+        for trade in trades:
+            trade_time = int(trade['time'])
+            imported_time = int(trade['imported_time'] or 0)
+            account = split_trade_id(trade['trade_id'])[0]
+            for marks in (self.state, self._marks(account)) if account is not None else (self.state,):
+                if marks['max_time'] is None or trade_time > marks['max_time']:
+                    marks['max_time'] = trade_time
+                if marks['max_imported_time'] is None or imported_time > marks['max_imported_time']:
+                    marks['max_imported_time'] = imported_time
+
+    def upsert(self, response, account=None):
+        """
+        Inserts new trades and replaces existing trades with the same `trade_id`.
+        @param response: Result of `api.get_trades()`.
+        @type response: dict
+        @param account: Name of the account the trades belong to. Their trade ids are tagged with it.
+                        `None` for a single-account store.
+        @type account: str
+        @return: number of inserted and number of updated trades
+        @rtype: tuple
+        """
+        if response.get('success') != 1:
+            raise SyncError("API returned an error: {}".format(response.get('error_msg', response)))
+        if account is not None:
+            response = tag_account(response, account)
+
+        inserted = updated = 0
+        new_trades = []
+        for key, trade in response.items():
+            if key in NON_TRADE_KEYS:
+                continue
+            trade_id = trade['trade_id']
+            if trade_id not in self.trades:
+                inserted += 1
+            elif self.trades[trade_id] != trade:
+                updated += 1
+            else:
+                continue
+            self.trades[trade_id] = trade
+            self.changes[trade_id] = trade
+            new_trades.append(trade)
+
+        self._update_high_water_mark(new_trades)
+        return inserted, updated
+
+    def prune(self, response, start_time=None, account=None):
+        """
+        Removes the trades of an account that are newer than `start_time` but missing in a response for that time
+        range, ie that were deleted on cointracking.
+        @param response: Result of `api.get_trades(start_time=start_time)`.
+        @type response: dict
+        @param start_time: Start of the time range of the response. `None` for all trades.
+        @type start_time: int
+        @param account: Name of the account, see `upsert`.
+        @type account: str
+        @return: number of deleted trades
+        @rtype: int
+        """
+        returned = set(trade['trade_id'] for key, trade in response.items() if key not in NON_TRADE_KEYS)
+        deleted = []
+        for trade_id, trade in self.trades.items():
+            trade_account, original_id = split_trade_id(trade_id)
+            # The API may or may not return trades at exactly start_time.
+            if trade_account == account and original_id not in returned and \
+                    (start_time is None or int(trade['time']) > start_time):
+                deleted.append(trade_id)
+        for trade_id in deleted:
+            del self.trades[trade_id]
+            self.changes[trade_id] = None
+        return len(deleted)
+
+    def _start_time(self, account, lookback):
+        max_time = self._marks(account)['max_time']
+        return max(max_time - lookback, 0) if max_time is not None else None
+
+    def sync(self, get_trades, lookback=86400, account=None):
+        """
+        Fetches all trades newer than the high-water mark, upserts them and removes the trades of that time range
+        that were deleted on cointracking.
+        The API only filters by trade time, so entries that were imported late (or deleted) with an old trade time
+        are only picked up if they fall into the `lookback` window. Use a full sync (empty store) to catch all of
+        those.
+        @param get_trades: Function with the signature of `api.get_trades`.
+        @type get_trades: callable
+        @param lookback: Number of seconds before the high-water mark to fetch again.
+        @type lookback: int
+        @param account: Name of the account to sync, see `upsert`.
+        @type account: str
+        @return: number of inserted, updated and deleted trades
+        @rtype: tuple
+        """
+        start_time = self._start_time(account, lookback)
+        return self._apply(get_trades(start_time=start_time), start_time, account)
+
+    def _apply(self, response, start_time, account):
+        inserted, updated = self.upsert(response, account)
+        return inserted, updated, self.prune(response, start_time, account)
+
+    def sync_accounts(self, fetchers, lookback=86400):
+        """
+        Syncs several accounts. Their trades are fetched concurrently, each from its own high-water mark.
+        @param fetchers: Functions with the signature of `api.get_trades` by account name, eg the `get_trades`
+                         methods of `api.Client`s.
+        @type fetchers: dict
+        @param lookback: Number of seconds before the high-water mark to fetch again.
+        @type lookback: int
+        @return: number of inserted, updated and deleted trades by account name
+        @rtype: OrderedDict
+        """
+        if not fetchers:
+            return OrderedDict()
+        with ThreadPoolExecutor(max_workers=len(fetchers)) as executor:
+            futures = []
+            for account, get_trades in fetchers.items():
+                start_time = self._start_time(account, lookback)
+                futures.append((account, start_time, executor.submit(get_trades, start_time=start_time)))
+            # Apply in order, the store is not thread-safe.
+            return OrderedDict((account, self._apply(future.result(), start_time, account))
+                               for account, start_time, future in futures)
+
+    def save(self):
+        """
+        Appends the changes since the last save to the journal and writes the state. The json file is only
+        rewritten (see `rewrite`) if it does not exist yet or the journal has grown too large.
+        """
+        if not os.path.exists(self.filename) or \
+                self.journal_entries + len(self.changes) > JOURNAL_COMPACT_RATIO * len(self.trades):
+            self.rewrite()
+            return
+        if self.changes:
+            if os.path.exists(self.journal_filename):
+                _truncate_partial_line(self.journal_filename)
+            with open(self.journal_filename, 'a') as output_file:
+                output_file.write(''.join(json.dumps([trade_id, record], separators=(',', ':')) + '\n'
+                                          for trade_id, record in self.changes.items()))
+                # The state must not get ahead of the journal, or the changes would not be fetched again.
+                output_file.flush()
+                os.fsync(output_file.fileno())
+            self.journal_entries += len(self.changes)
+            self.changes = OrderedDict()
+        _write_json_atomic(self.state_filename, self.state, indent=4)
+
+    def rewrite(self):
+        """
+        Writes all trades to the json file (atomically, via a temporary file) and removes the journal.
+        """
+        data = OrderedDict([('success', 1), ('method', 'getTrades')])
+        data.update(self.trades)
+        if self.compact:
+            _write_json_atomic(self.filename, data, separators=(',', ':'))
+        else:
+            _write_json_atomic(self.filename, data, indent=4)
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+        self.changes = OrderedDict()
+        self.journal_entries = 0
+        _write_json_atomic(self.state_filename, self.state, indent=4)
+
+
+def _write_json_atomic(filename, data, **kwargs):
+    tmp_filename = filename + '.tmp'
+    with open_file(tmp_filename, 'w', compression_for(filename)) as output_file:
+        json.dump(data, output_file, **kwargs)
+    os.replace(tmp_filename, filename)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import pytest
+
+from api import Client, fetch_accounts
+from store import TradeStore
+
+
+def _trade(trade_id, time):
+    return OrderedDict([
+        ('type', 'Deposit'), ('time', str(time)), ('trade_id', trade_id),
+        ('buy_currency', 'BTC'), ('sell_currency', ''), ('fee_currency', ''),
+        ('buy_amount', '1.0'), ('sell_amount', ''), ('fee_amount', ''),
+        ('exchange', 'Kraken'), ('group', ''), ('comment', ''),
+        ('imported_from', ''), ('imported_time', str(time)),
+    ])
+
+
+class AccountsHandler(BaseHTTPRequestHandler):
+    """
+    Answers `getTrades` with the trades of the account of the API key and records the requests. Requests wait
+    until the requests of all accounts have arrived.
+    """
+
+    def do_POST(self):
+        params = dict(parse_qsl(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8')))
+        server = self.server
+        server.requests.append((self.headers['Key'], params))
+        server.barrier.wait(timeout=5)
+        response = OrderedDict([('success', 1), ('method', params['method'])])
+        start_time = int(params.get('start_time', 0))
+        for trade in server.trades[self.headers['Key']]:
+            if int(trade['time']) >= start_time:
+                response[trade['trade_id']] = trade
+        body = json.dumps(response).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def accounts_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), AccountsHandler)
+    server.requests = []
+    server.barrier = threading.Barrier(2)
+    server.trades = {
+        'shop-key': [_trade(str(i), 1000 + i) for i in range(10)],
+        'home-key': [_trade(str(i), 5000 + i) for i in range(5)],
+    }
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _no_sleep(seconds):
+    raise AssertionError("Waited {} seconds".format(seconds))
+
+
+def _clients(server):
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    # Two calls per account fit into the burst of each rate limiter, but not into a shared one.
+    return [Client(key, 'secret', name=name, url=url, calls_per_hour=2, max_retries=0, sleep=_no_sleep)
+            for name, key in (('shop', 'shop-key'), ('home', 'home-key'))]
+
+
+def test_fetch_accounts_is_concurrent(accounts_server):
+    shop, home = _clients(accounts_server)
+    assert shop.transport.rate_limiter is not home.transport.rate_limiter
+    for _ in range(1000):
+        shop.transport.next_nonce()
+
+    responses = fetch_accounts([shop, home], start_time=1005)
+    assert list(responses) == ['shop', 'home']
+    assert list(responses['shop'])[2:] == [str(i) for i in range(5, 10)]
+    assert list(responses['home'])[2:] == [str(i) for i in range(5)]
+    assert fetch_accounts([]) == OrderedDict()
+
+    nonces = dict((key, int(params['nonce'])) for key, params in accounts_server.requests)
+    assert nonces['home-key'] < nonces['shop-key'] - 500
+    assert all(params['method'] == 'getTrades' and params['start_time'] == '1005'
+               for _, params in accounts_server.requests)
+
+
+def test_sync_accounts_from_clients(tmp_path, accounts_server):
+    shop, home = _clients(accounts_server)
+    store = TradeStore(str(tmp_path / 'trades.json'))
+    fetchers = OrderedDict((client.name, client.get_trades) for client in (shop, home))
+    assert store.sync_accounts(fetchers) == OrderedDict([('shop', (10, 0, 0)), ('home', (5, 0, 0))])
+    accounts_server.trades['shop-key'].append(_trade('10', 1010))
+    assert store.sync_accounts(fetchers, lookback=5) == OrderedDict([('shop', (1, 0, 0)), ('home', (0, 0, 0))])
+
+    start_times = [(key, params.get('start_time')) for key, params in accounts_server.requests[2:]]
+    assert sorted(start_times) == [('home-key', '4999'), ('shop-key', '1004')]
+    assert len(store) == 16
+    assert store.trades['shop:10']['trade_id'] == 'shop:10'
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+from collections import OrderedDict
+
+import async_api
+
+
+def _stub(trades):
+    """
+    Returns a `get_trades` over a list of trade dicts, with the filters and ordering of the API.
+    """
+    def get_trades(limit=None, order=None, start_time=None, end_time=None):
+        selected = [trade for trade in sorted(trades, key=lambda trade: int(trade['time']))
+                    if (start_time is None or int(trade['time']) >= start_time) and
+                    (end_time is None or int(trade['time']) <= end_time)]
+        response = OrderedDict([('success', 1), ('method', 'getTrades')])
+        for trade in selected[:limit]:
+            response[trade['trade_id']] = trade
+        return response
+    return get_trades
+
+
+def _trades(times):
+    return [OrderedDict([('trade_id', str(i)), ('time', str(t))]) for i, t in enumerate(times)]
+
+
+def test_fetches_all_trades_without_end_time():
+    now = int(time.time())
+    rnd = random.Random(5)
+    # Many trades in the current second and some dated in the future.
+    times = [rnd.randint(now - 86400 * 30, now) for _ in range(300)] + [now] * 20 + \
+        [now + rnd.randint(1, 86400 * 365) for _ in range(40)] + [5]
+    trades = _trades(times)
+    result = async_api.get_trades(get_trades=_stub(trades), shard_limit=25, shards=4)
+    assert sorted(key for key in result if key not in ('success', 'method')) == \
+        sorted(trade['trade_id'] for trade in trades)
+
+
+def test_time_range_is_respected():
+    trades = _trades(range(1000, 2000, 3))
+    result = async_api.get_trades(start_time=1200, end_time=1500, get_trades=_stub(trades), shard_limit=10)
+    times = [int(trade['time']) for key, trade in result.items() if key not in ('success', 'method')]
+    assert times == list(range(1201, 1501, 3))
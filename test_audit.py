@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from datetime import timedelta
+from decimal import Decimal
+
+from audit import audit
+from benchmark import generate_trades
+from find_duplicates import list_duplicates, list_near_duplicates
+from find_unmatched_movements import match_movements
+from tools import Trade
+from trade_table import TradeTable
+
+
+def _records(num_records=2000, seed=19):
+    return [trade for key, trade in generate_trades(num_records, seed).items() if key not in ('success', 'method')]
+
+
+def _odicts(trades):
+    return [trade.to_odict() for trade in trades]
+
+
+def test_audit_equals_separate_checks():
+    records = _records()
+    for i, record in enumerate(records[:400:20]):
+        # Entered again a bit later with a slightly different amount.
+        amount_field = 'buy_amount' if record['buy_amount'] else 'sell_amount'
+        records.append(OrderedDict(record, trade_id='near{}'.format(i), time=str(int(record['time']) + 30),
+                                   **{amount_field: str(Decimal(record[amount_field]) * Decimal('1.0001'))}))
+    trades = sorted(Trade(**record) for record in records)
+    window = timedelta(minutes=5)
+    report = audit([Trade(**record) for record in records], window=window, fuzzy=True, fuzzy_window=60,
+                   amount_tolerance=Decimal('0.001'), relative=True)
+
+    expected = [trade for trade in list_duplicates(trades) if 'dupok' not in trade.comment]
+    assert expected
+    assert report['checked'] == len(trades)
+    assert report['duplicates'] == _odicts(expected)
+
+    result = match_movements(trades, window)
+    assert report['matched_movements'] == len(result.matched)
+    assert report['unmatched_movements'] == _odicts(result.unmatched)
+    assert report['ambiguous_movements'] == [[w.to_odict(), d.to_odict()] for w, d in result.ambiguous]
+
+    pairs = list_near_duplicates(trades, 60, Decimal('0.001'), True)
+    assert pairs
+    assert report['near_duplicates'] == [[trade1.to_odict(), trade2.to_odict()] for trade1, trade2 in pairs]
+
+    # A table gives the same report.
+    table_report = audit(TradeTable.from_dicts(records), window=window, fuzzy=True, fuzzy_window=60,
+                         amount_tolerance=Decimal('0.001'), relative=True)
+    for name in ('checked', 'duplicates', 'matched_movements', 'unmatched_movements', 'ambiguous_movements',
+                 'near_duplicates', 'negative_balances'):
+        assert table_report[name] == report[name]
+
+
+def _movement(trade_type, trade_id, time, amount, exchange='Kraken'):
+    withdrawal = trade_type in ('Withdrawal', 'Trade')
+    return Trade(type=trade_type, time=str(time), trade_id=trade_id, buy_currency='' if withdrawal else 'BTC',
+                 sell_currency='BTC' if withdrawal else '', fee_currency='',
+                 buy_amount='' if withdrawal else amount, sell_amount=amount if withdrawal else '', fee_amount='',
+                 exchange=exchange, group='', comment='', imported_from='', imported_time=str(time))
+
+
+def test_negative_balances():
+    trades = [
+        _movement('Deposit', '1', 1000, '2'),
+        _movement('Withdrawal', '2', 1100, '1.5'),
+        _movement('Withdrawal', '3', 1200, '1'),  # Goes below zero.
+        _movement('Withdrawal', '4', 1300, '1'),  # Still below zero, not reported again.
+        _movement('Deposit', '5', 1400, '0.000000005', exchange='Binance'),
+        _movement('Withdrawal', '6', 1500, '0.00000001', exchange='Binance'),  # Within the tolerance.
+        _movement('Deposit', '7', 1600, '3'),
+        _movement('Withdrawal', '8', 1700, '2'),  # Below zero again.
+    ]
+    report = audit(reversed(trades), analyses=('balances',))
+    assert [(entry['exchange'], entry['balance'], entry['trade']['trade_id'])
+            for entry in report['negative_balances']] == \
+        [('Kraken', Decimal('-0.5'), '3'), ('Kraken', Decimal('-0.5'), '8')]
+    assert list(report) == ['checked', 'negative_balances', 'seconds']
+    assert isinstance(report, OrderedDict)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import random
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from balances import MOVEMENT_TYPES, BalanceIndex
+from benchmark import generate_trades
+from tools import Trade
+
+
+def _trades(num_records=2000, seed=8):
+    return [Trade(**trade) for key, trade in generate_trades(num_records, seed).items()
+            if key not in ('success', 'method')]
+
+
+def _changes(trade):
+    return [(currency, amount) for currency, amount in (
+        (trade.buy_currency, trade.buy_amount), (trade.sell_currency, -trade.sell_amount),
+        (trade.fee_currency, -trade.fee_amount)) if currency and amount]
+
+
+def _brute_force(trades, time=None, exchange=None, group=None, exclude_movements=False, type=None):
+    # (currency, exchange, group, type) -> balance
+    totals = defaultdict(lambda: Decimal(0))
+    for trade in trades:
+        if time is not None and trade.time > time:
+            continue
+        if exchange is not None and trade.exchange != exchange or group is not None and trade.group != group:
+            continue
+        if type is not None and trade.type != type or exclude_movements and trade.type in MOVEMENT_TYPES:
+            continue
+        for currency, amount in _changes(trade):
+            totals[(currency, trade.exchange, trade.group, trade.type)] += amount
+    return totals
+
+
+def _sum(totals, field=None):
+    result = defaultdict(lambda: defaultdict(lambda: Decimal(0)))
+    for key, amount in totals.items():
+        result[key[field] if field else None][key[0]] += amount
+    return dict((group, dict((currency, amount) for currency, amount in currencies.items() if amount))
+                for group, currencies in result.items())
+
+
+def test_balances_equal_brute_force():
+    trades = _trades()
+    random.Random(1).shuffle(trades)
+    index = BalanceIndex(trades)
+    times = sorted(trade.time for trade in trades)
+    exchanges = sorted(set(trade.exchange for trade in trades))
+    types = sorted(set(trade.type for trade in trades))
+    rnd = random.Random(2)
+    for _ in range(100):
+        time = rnd.choice((None, rnd.choice(times), rnd.choice(times) - timedelta(seconds=1)))
+        filters = dict(exchange=rnd.choice((None,) + tuple(exchanges)), exclude_movements=rnd.random() < 0.3,
+                       type=rnd.choice((None, None) + tuple(types)))
+        expected = _sum(_brute_force(trades, time, **filters)).get(None, {})
+        assert dict(index.balances(time, **filters)) == expected
+        for currency in index.currencies:
+            assert index.balance(currency, time, **filters) == expected.get(currency, 0)
+
+        group_by = rnd.choice(('exchange', 'group', 'type'))
+        expected = _sum(_brute_force(trades, time, exclude_movements=filters['exclude_movements'],
+                                     type=filters['type']), ('exchange', 'group', 'type').index(group_by) + 1)
+        grouped = index.grouped_balance(group_by, time, exclude_movements=filters['exclude_movements'],
+                                        type=filters['type'])
+        assert dict((group, dict(currencies)) for group, currencies in grouped.items()) == \
+            dict((group, currencies) for group, currencies in expected.items() if currencies)
+
+
+def test_daily_balances_equal_brute_force():
+    trades = _trades(500)
+    index = BalanceIndex(trades)
+    exchange = trades[0].exchange
+    daily = index.daily_balances('BTC', exchange=exchange)
+    days = list(daily)
+    assert days == [days[0] + timedelta(days=i) for i in range(len(days))]
+    assert days[0] == min(trade.time for trade in trades if trade.exchange == exchange and
+                          'BTC' in (trade.buy_currency, trade.sell_currency, trade.fee_currency)).date()
+    for day, amount in daily.items():
+        end_of_day = datetime.combine(day, datetime.max.time())
+        assert amount == _sum(_brute_force(trades, end_of_day, exchange=exchange)).get(None, {}).get('BTC', 0)
+    assert isinstance(daily, OrderedDict)
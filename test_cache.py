@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+from cache import CACHE_SUFFIX, ResponseCache
+
+
+def _response(i, size=200):
+    return {'success': 1, 'method': 'getTrades', 'data': str(i) * size}
+
+
+def test_ttl_and_lru_eviction(tmp_path):
+    now = [1000.0]
+    cache = ResponseCache(str(tmp_path), ttls={'getBalance': 10}, clock=lambda: now[0])
+    cache.put('getBalance', {}, _response(1))
+    assert cache.get('getBalance', {'nonce': 5}) == _response(1)
+    now[0] += 11
+    assert cache.get('getBalance', {}) is None
+
+    cache = ResponseCache(str(tmp_path / 'lru'), max_bytes=1)
+    cache.put('getTrades', {'start_time': 1}, _response(1))
+    cache.put('getTrades', {'start_time': 2}, _response(2))
+    assert cache.get('getTrades', {'start_time': 1}) is None
+    assert cache.get('getTrades', {'start_time': 2}) == _response(2)
+    assert cache.evictions == 1
+
+
+def test_concurrent_access(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=20000)
+    errors = []
+
+    def work(thread):
+        try:
+            for i in range(100):
+                # Threads share keys, so the same key is written concurrently.
+                key = {'start_time': (thread + i) % 30}
+                response = cache.get('getTrades', key)
+                assert response is None or response == _response(key['start_time'])
+                cache.put('getTrades', key, _response(key['start_time']))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    files = sorted(name for name in os.listdir(str(tmp_path)))
+    assert files == sorted(key + CACHE_SUFFIX for key in cache.entries)
+    assert cache.size <= 20000
+    assert sum(os.path.getsize(os.path.join(str(tmp_path), name)) for name in files) == cache.size
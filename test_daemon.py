@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import random
+from collections import OrderedDict
+from decimal import Decimal
+
+from benchmark import generate_trades
+from daemon import TradeDaemon, TradeIndex
+from store import TradeStore
+from tools import Trade
+
+
+def _fetcher(trades):
+    def get_trades(start_time=None):
+        response = OrderedDict([('success', 1), ('method', 'getTrades')])
+        for trade_id, trade in trades.items():
+            if start_time is None or int(trade['time']) >= start_time:
+                response[trade_id] = trade
+        return response
+    return get_trades
+
+
+def _assert_same(index, expected):
+    assert sorted((trade.time, trade.trade_id) for trade in index.trades) == \
+        sorted((trade.time, trade.trade_id) for trade in expected.trades)
+    assert [trade.time for trade in index.trades] == sorted(trade.time for trade in index.trades)
+    assert index.by_id == expected.by_id
+    assert set(index.duplicates) == set(expected.duplicates)
+    balances, expected_balances = index.balances, expected.balances
+    assert balances.currencies == expected_balances.currencies
+    assert balances.balances() == expected_balances.balances()
+    for group_by in ('exchange', 'group', 'type'):
+        assert balances.grouped_balance(group_by) == expected_balances.grouped_balance(group_by)
+    for currency in balances.currencies:
+        assert balances.daily_balances(currency) == expected_balances.daily_balances(currency)
+        for time in (trade.time for trade in expected.trades[::50]):
+            assert balances.balance(currency, time) == expected_balances.balance(currency, time)
+
+
+def test_refresh_updates_the_index(tmp_path):
+    filename = str(tmp_path / 'trades.json')
+    trades = OrderedDict((trade_id, trade) for trade_id, trade in generate_trades(2000, 9).items()
+                         if trade_id not in ('success', 'method'))
+    store = TradeStore(filename)
+    store.sync(_fetcher(trades))
+    store.save()
+
+    daemon = TradeDaemon(filename, _fetcher(trades), lookback=3600)
+    rnd = random.Random(3)
+    for _ in range(3):
+        recent = [trade_id for trade_id, trade in trades.items()
+                  if int(trade['time']) >= daemon.store.max_time - 3600]
+        for trade_id in rnd.sample(recent, 5):
+            del trades[trade_id]
+        for trade_id in rnd.sample(recent, 10):
+            if trade_id in trades and trades[trade_id]['buy_amount']:
+                amount = Decimal(trades[trade_id]['buy_amount']) + 1
+                trades[trade_id] = OrderedDict(trades[trade_id], buy_amount=str(amount))
+        for i in range(10):
+            trade = OrderedDict(trades[rnd.choice(list(trades))], trade_id='new{}{}'.format(len(trades), i))
+            trades[trade['trade_id']] = trade
+        old_index = daemon.index
+        old_trades = list(old_index.trades)
+
+        assert daemon.refresh()[2] == 5
+        _assert_same(daemon.index, TradeIndex(Trade(**trade) for trade in daemon.store.trades.values()))
+        assert old_index.trades == old_trades
+        # Series that no trade changed are shared with the old index.
+        assert any(daemon.index.balances.series.get(key) is series
+                   for key, series in old_index.balances.series.items())
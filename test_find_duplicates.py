@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import random
+from decimal import Decimal
+
+import pytest
+
+from find_duplicates import is_near_duplicate, list_near_duplicates
+from tools import Trade
+
+
+def _trade(rnd, trade_id):
+    trade_type = rnd.choice(('Trade', 'Deposit'))
+    sell_currency = 'EUR' if trade_type == 'Trade' else ''
+    return Trade(
+        type=trade_type, time=str(1000 + rnd.randint(0, 200)), trade_id=str(trade_id), buy_currency='BTC',
+        sell_currency=sell_currency, fee_currency='',
+        buy_amount=rnd.choice(('', '0', '0.004', '0.3', '1', '1.005', '1.02', '2')),
+        sell_amount=rnd.choice(('', '100', '100.5', '101')) if sell_currency else '', fee_amount='', exchange='',
+        group='', comment=rnd.choice(('', '', '', 'dupok')), imported_from='', imported_time='1000')
+
+
+def _brute_force(trades, window, tolerance, relative):
+    trades = [trade for trade in trades if 'dupok' not in trade.comment]
+    return [(trade1, trade2) for i, trade1 in enumerate(trades) for trade2 in trades[i + 1:]
+            if is_near_duplicate(trade1, trade2, window, tolerance, relative)]
+
+
+@pytest.mark.parametrize('tolerance,relative', [
+    (Decimal('0'), False), (Decimal('0.01'), False), (Decimal('0.5'), False),
+    (Decimal('0'), True), (Decimal('0.01'), True), (Decimal('0.5'), True),
+])
+def test_near_duplicates_equal_brute_force(tolerance, relative):
+    rnd = random.Random(5)
+    for _ in range(50):
+        trades = [_trade(rnd, i) for i in range(rnd.randint(0, 40))]
+        window = rnd.choice((0, 10, 60))
+        assert list_near_duplicates(trades, window, tolerance, relative) == \
+            _brute_force(trades, window, tolerance, relative)
+
+
+def test_near_duplicates_with_jobs():
+    rnd = random.Random(6)
+    trades = [_trade(rnd, i) for i in range(200)]
+    assert list_near_duplicates(trades, 60, Decimal('0.01'), True, jobs=2) == \
+        _brute_force(trades, 60, Decimal('0.01'), True)
+
+
+def test_invalid_relative_tolerance():
+    with pytest.raises(ValueError):
+        list_near_duplicates([], 60, Decimal('1'), relative=True)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import random
+from collections import OrderedDict
+from datetime import timedelta
+
+from benchmark import generate_trades
+from find_unmatched_movements import match_movements, movement_key
+from tools import Trade
+from trade_table import TradeTable
+
+
+def _movement(rnd, trade_id):
+    withdrawal = rnd.random() < 0.5
+    amount = rnd.choice(('1.0', '1.5', '2.0'))
+    fee = rnd.choice(('', '0.5'))
+    return Trade(
+        type='Withdrawal' if withdrawal else 'Deposit', time=str(1000 + 60 * rnd.randint(0, 20)),
+        trade_id=str(trade_id), buy_currency='' if withdrawal else 'BTC', sell_currency='BTC' if withdrawal else '',
+        fee_currency='BTC' if fee else '', buy_amount='' if withdrawal else amount,
+        sell_amount=amount if withdrawal else '', fee_amount=fee, exchange='Kraken', group='', comment='',
+        imported_from='', imported_time='1000')
+
+
+def _can_match(withdrawal, deposit, window):
+    return movement_key(withdrawal) == movement_key(deposit) and \
+        withdrawal.time <= deposit.time <= withdrawal.time + window
+
+
+def _maximum_matching(movements, window):
+    # Augmenting paths (Kuhn), fine for small inputs.
+    withdrawals = [trade for trade in movements if trade.type == 'Withdrawal']
+    deposits = [trade for trade in movements if trade.type == 'Deposit']
+    partner = {}
+
+    def augment(w, visited):
+        for d, deposit in enumerate(deposits):
+            if d not in visited and _can_match(withdrawals[w], deposit, window):
+                visited.add(d)
+                if d not in partner or augment(partner[d], visited):
+                    partner[d] = w
+                    return True
+        return False
+
+    return sum(1 for w in range(len(withdrawals)) if augment(w, set()))
+
+
+def test_matches_are_one_to_one_and_maximal():
+    rnd = random.Random(4)
+    for _ in range(300):
+        movements = [_movement(rnd, i) for i in range(rnd.randint(0, 12))]
+        window = timedelta(minutes=rnd.choice((0, 1, 5)))
+        result = match_movements(movements, window)
+
+        paired = [trade for pair in result.matched for trade in pair]
+        assert len(set(id(trade) for trade in paired)) == len(paired)
+        assert all(_can_match(withdrawal, deposit, window) for withdrawal, deposit in result.matched)
+        assert set(result.ambiguous) <= set(result.matched)
+        assert sorted(id(trade) for trade in paired + result.unmatched) == sorted(id(trade) for trade in movements)
+        assert len(result.matched) == _maximum_matching(movements, window)
+
+
+def test_table_rows_match_like_trades():
+    records = [trade for key, trade in generate_trades(3000, 13).items() if key not in ('success', 'method')]
+    # Amounts with more than 8 decimal places are kept as Decimals by the table. Add withdrawals with such amounts
+    # and deposits whose amount only gets equal to it with the fee.
+    for i, record in enumerate(records[:400]):
+        if record['type'] == 'Withdrawal' and record['sell_amount'] and '.' in record['sell_amount']:
+            amount = record['sell_amount'].ljust(record['sell_amount'].index('.') + 9, '0')
+            records.append(OrderedDict(record, trade_id='fine{}'.format(i), sell_amount=amount + '5', fee_amount='',
+                                       fee_currency=''))
+            records.append(OrderedDict(record, type='Deposit', trade_id='fine{}d'.format(i), buy_amount=amount + '4',
+                                       buy_currency=record['sell_currency'], sell_amount='', sell_currency='',
+                                       fee_amount='0.000000001', fee_currency=record['sell_currency']))
+    table = TradeTable.from_dicts(records)
+    trades = [Trade(**record) for record in records]
+    for window in (timedelta(0), timedelta(minutes=5)):
+        expected = match_movements(trades, window)
+        result = match_movements(list(table), window)
+        assert [(w.to_odict(), d.to_odict()) for w, d in result.matched] == \
+            [(w.to_odict(), d.to_odict()) for w, d in expected.matched]
+        assert [(w.to_odict(), d.to_odict()) for w, d in result.ambiguous] == \
+            [(w.to_odict(), d.to_odict()) for w, d in expected.ambiguous]
+        assert [trade.to_odict() for trade in result.unmatched] == [trade.to_odict() for trade in expected.unmatched]
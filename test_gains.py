@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import logging
+import random
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal
+
+from gains import GainsEngine
+from tools import Trade
+
+PRICES = {'BTC': 9000, 'ETH': 300}
+
+
+def _price(currency, time):
+    return Decimal(PRICES[currency] + time.month * 10)
+
+
+def _trade(rnd, trade_id, year):
+    time = int(datetime(year, rnd.randint(1, 12), rnd.randint(1, 28)).timestamp())
+    trade_type = rnd.choice(('Trade', 'Trade', 'Trade', 'Income', 'Spend', 'Lost'))
+    currency = rnd.choice(('BTC', 'ETH'))
+    amount = str(rnd.choice((1, 2, 5)) * Decimal('0.5'))
+    fields = dict(type=trade_type, time=str(time), trade_id=str(trade_id), buy_currency='', sell_currency='',
+                  fee_currency='', buy_amount='', sell_amount='', fee_amount='', exchange='Kraken', group='',
+                  comment='', imported_from='', imported_time=str(time))
+    if trade_type == 'Trade':
+        other = rnd.choice(('EUR', 'ETH' if currency == 'BTC' else 'BTC'))
+        other_amount = str(rnd.randint(100, 10000))
+        if rnd.random() < 0.5:
+            fields.update(buy_currency=currency, buy_amount=amount, sell_currency=other, sell_amount=other_amount)
+        else:
+            fields.update(buy_currency=other, buy_amount=other_amount, sell_currency=currency, sell_amount=amount)
+        if rnd.random() < 0.3:
+            fields.update(fee_currency=currency, fee_amount='0.01')
+    elif trade_type == 'Income':
+        fields.update(buy_currency=currency, buy_amount=amount)
+    else:
+        fields.update(sell_currency=currency, sell_amount=amount)
+    return Trade(**fields)
+
+
+def _engine(trades):
+    return GainsEngine(trades, price_lookup=_price).run()
+
+
+def _assert_same(engine, expected):
+    assert engine.realized() == expected.realized()
+    assert engine.unrealized(PRICES) == expected.unrealized(PRICES)
+    assert list(engine.checkpoints) == list(expected.checkpoints)
+    for state, expected_state in zip(engine.states.values(), expected.states.values()):
+        assert dict(state.shortfall) == dict(expected_state.shortfall)
+
+
+def test_recompute_year_equals_full_run():
+    rnd = random.Random(7)
+    years = (2017, 2018, 2020, 2021)  # No trades in 2019.
+    trades = [_trade(rnd, i, rnd.choice(years)) for i in range(400)]
+    by_year = dict((year, [trade for trade in trades if trade.time.year == year]) for year in years + (2019,))
+
+    engine = _engine(trades)
+    before = engine.realized(2017)
+    assert engine.recompute_year(2018) == engine.realized(2018)
+    assert engine.realized(2017) == before
+    _assert_same(engine, _engine(trades))
+
+    for year in (2018, 2019, 2021, 2017):
+        year_trades = [trade for trade in by_year[year] if rnd.random() < 0.8]
+        year_trades += [_trade(rnd, 1000 + year * 100 + i, year) for i in range(10)]
+        by_year[year] = year_trades
+        realized = engine.recompute_year(year, year_trades)
+        expected = _engine([trade for y in sorted(by_year) for trade in by_year[y]])
+        assert realized == expected.realized(year)
+        _assert_same(engine, expected)
+
+
+def _record(trade_type, day, buy=('', ''), sell=('', ''), fee=('', '')):
+    time = str(int(datetime(2020, 1, day).timestamp()))
+    return Trade(type=trade_type, time=time, trade_id=str(day), buy_amount=buy[0], buy_currency=buy[1],
+                 sell_amount=sell[0], sell_currency=sell[1], fee_amount=fee[0], fee_currency=fee[1],
+                 exchange='Kraken', group='', comment='', imported_from='', imported_time=time)
+
+
+def _gains(proceeds, cost):
+    return OrderedDict([('proceeds', Decimal(proceeds)), ('cost', Decimal(cost)),
+                        ('gain', Decimal(proceeds) - Decimal(cost))])
+
+
+def test_base_currency_fees():
+    trades = [
+        _record('Trade', 1, buy=('1', 'BTC'), sell=('1000', 'EUR'), fee=('10', 'EUR')),
+        _record('Trade', 2, buy=('2000', 'EUR'), sell=('1', 'BTC'), fee=('20', 'EUR')),
+        # Part of the cost of the ETH, not of the proceeds of the BTC.
+        _record('Trade', 3, buy=('10', 'ETH'), sell=('3000', 'EUR'), fee=('30', 'EUR')),
+        _record('Trade', 4, buy=('1', 'BTC'), sell=('5', 'ETH'), fee=('5', 'EUR')),
+    ]
+    engine = GainsEngine(trades, methods=('FIFO',), price_lookup=lambda currency, time: 0).run()
+    assert engine.realized()['FIFO'] == OrderedDict([
+        ('BTC', _gains('1980', '1010')),
+        ('ETH', _gains('0', '1515')),
+    ])
+    assert engine.unrealized({'BTC': 0})['FIFO']['BTC']['cost'] == Decimal('5')
+
+
+def test_other_types(caplog):
+    trades = [
+        _record('Staking', 1, buy=('2', 'ETH')),
+        _record('Airdrop', 2, buy=('1', 'ETH')),
+        _record('Margin Profit', 3, buy=('1', 'ETH')),
+        _record('Other Fee', 4, sell=('1', 'ETH')),
+        _record('Margin Loss', 5, sell=('1', 'ETH')),
+        _record('Margin Fee', 6, sell=('10', 'EUR')),
+        _record('Deposit', 7, buy=('5', 'ETH')),
+        _record('Teleport', 8, buy=('100', 'ETH')),
+        _record('Teleport', 9, sell=('100', 'ETH')),
+    ]
+    with caplog.at_level(logging.WARNING, logger='gains'):
+        engine = GainsEngine(trades, methods=('FIFO',), price_lookup=lambda currency, time: 100 * time.day).run()
+    # The fee and the loss dispose of the staked ETH (bought at 100) without proceeds.
+    assert engine.realized()['FIFO'] == OrderedDict([('ETH', _gains('0', '200'))])
+    assert engine.unrealized({'ETH': 300})['FIFO']['ETH']['amount'] == Decimal('2')
+    assert engine.ignored_types == {'Teleport'}
+    assert len([record for record in caplog.records if 'Teleport' in record.getMessage()]) == 1
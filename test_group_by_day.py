@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import random
+
+from benchmark import write_csv
+from group_by_day import process_csv
+
+
+def _lines(filename):
+    with open(filename) as input_file:
+        return input_file.read().splitlines()
+
+
+def _groups(lines):
+    # A group keeps the time and transaction id of its first record, which depend on the order.
+    return sorted(line.rsplit(',', 2)[0] + ',' + line.rsplit(',', 2)[1].split()[0] for line in lines)
+
+
+def test_grouping_does_not_depend_on_order_or_memory(tmp_path):
+    csv_in = str(tmp_path / 'trades.csv')
+    write_csv(csv_in, 20000, seed=2)
+    expected_file = str(tmp_path / 'grouped.csv')
+    process_csv(csv_in, expected_file)
+    expected = _lines(expected_file)
+    assert len(expected) < 20000
+
+    spilled_file = str(tmp_path / 'spilled.csv')
+    process_csv(csv_in, spilled_file, max_groups=50, num_partitions=4)
+    assert _lines(spilled_file) == expected
+
+    parallel_file = str(tmp_path / 'parallel.csv')
+    process_csv(csv_in, parallel_file, jobs=2)
+    assert _lines(parallel_file) == expected
+
+    lines = _lines(csv_in)
+    rows = lines[1:]
+    random.Random(1).shuffle(rows)
+    shuffled_in = str(tmp_path / 'shuffled.csv')
+    with open(shuffled_in, 'w') as output_file:
+        output_file.write('\n'.join([lines[0]] + rows) + '\n')
+    shuffled_file = str(tmp_path / 'shuffled_grouped.csv')
+    process_csv(shuffled_in, shuffled_file)
+    shuffled = _lines(shuffled_file)
+    assert shuffled[0] == expected[0]
+    assert _groups(shuffled[1:]) == _groups(expected[1:])
+
+
+def test_zero_sums_are_left_empty(tmp_path):
+    csv_in = str(tmp_path / 'trades.csv')
+    with open(csv_in, 'w') as output_file:
+        output_file.write('\n'.join([
+            'Type,Buy,Cur.,Sell,Cur.,Fee,Cur.,Exchange,Group,Comment,Date,Tx-ID',
+            'Margin Profit,1.5,BTC,,,0,BTC,Kraken,,,01.02.2020 10:00,a',
+            'Margin Profit,-1.5,BTC,,,0,BTC,Kraken,,,01.02.2020 11:00,b',
+            'Margin Profit,0,ETH,,,,,Kraken,,,01.02.2020 12:00,c',
+        ]) + '\n')
+    csv_out = str(tmp_path / 'grouped.csv')
+    process_csv(csv_in, csv_out)
+    # Like before the records were grouped by hash: a sum of zero is left empty, a single zero is kept.
+    assert _lines(csv_out)[1:] == [
+        'Margin Profit,,BTC,,,,BTC,Kraken,,,01.02.2020 10:00,a',
+        'Margin Profit,0,ETH,,,,,Kraken,,,01.02.2020 12:00,c',
+    ]
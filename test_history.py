@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import random
+from collections import OrderedDict
+
+from cache import CLOSED_RANGE_MIN_AGE
+from history import HistoryStore, find_gaps, merge_interval
+
+STEP = 3600
+NOW = 1000 * STEP
+
+
+def _covered(intervals):
+    return set(time for start, end in intervals for time in range(start, end + 1))
+
+
+def test_merge_interval_and_find_gaps():
+    rnd = random.Random(14)
+    for _ in range(500):
+        intervals = []
+        for _ in range(rnd.randint(0, 6)):
+            start = rnd.randint(0, 40)
+            intervals = merge_interval(intervals, start, start + rnd.randint(0, 5))
+        covered = _covered(intervals)
+        # Sorted, disjoint and not touching, so that adjacent intervals are merged.
+        assert all(end + 1 < next_start for (_, end), (next_start, _) in zip(intervals, intervals[1:]))
+        assert all(start <= end for start, end in intervals)
+
+        start = rnd.randint(0, 45)
+        end = start + rnd.randint(0, 10)
+        gaps = find_gaps(intervals, start, end)
+        assert _covered(gaps) == set(range(start, end + 1)) - covered
+        assert all(gap_end + 1 < next_start for (_, gap_end), (next_start, _) in zip(gaps, gaps[1:]))
+        assert _covered(merge_interval(intervals, start, end)) == covered | set(range(start, end + 1))
+
+
+class FakeClient(object):
+    """
+    Answers with a point every hour and records the requested ranges.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    @staticmethod
+    def value(currency, timestamp):
+        return '{}.{}'.format(len(currency), timestamp)
+
+    def get_historical_currency(self, currency, start_time, end_time):
+        self.requests.append((currency, start_time, end_time))
+        first = -(-start_time // STEP) * STEP
+        return OrderedDict([
+            ('success', 1), ('method', 'getHistoricalCurrency'),
+            (currency, OrderedDict((str(timestamp), self.value(currency, timestamp))
+                                   for timestamp in range(first, end_time + 1, STEP))),
+        ])
+
+
+def _expected(currency, start, end):
+    first = -(-start // STEP) * STEP
+    return dict((str(timestamp), FakeClient.value(currency, timestamp)) for timestamp in range(first, end + 1, STEP))
+
+
+def test_only_gaps_are_fetched(tmp_path):
+    client = FakeClient()
+    store = HistoryStore(str(tmp_path), client, clock=lambda: NOW)
+    assert dict(store.get_range('BTC', 100 * STEP, 200 * STEP)['BTC']) == _expected('BTC', 100 * STEP, 200 * STEP)
+    assert client.requests == [('BTC', 100 * STEP, 200 * STEP)]
+
+    assert dict(store.get_range('BTC', 150 * STEP, 300 * STEP)['BTC']) == _expected('BTC', 150 * STEP, 300 * STEP)
+    assert client.requests[1:] == [('BTC', 200 * STEP + 1, 300 * STEP)]
+    assert store.get_at('BTC', 250 * STEP + 10) == (250 * STEP, {'BTC': FakeClient.value('BTC', 250 * STEP)})
+    assert len(client.requests) == 2
+
+    store.get_range('BTC', 50 * STEP, 350 * STEP)
+    assert client.requests[2:] == [('BTC', 50 * STEP, 100 * STEP - 1), ('BTC', 300 * STEP + 1, 350 * STEP)]
+    store.get_range('ETH', 100 * STEP, 120 * STEP)
+    assert client.requests[4:] == [('ETH', 100 * STEP, 120 * STEP)]
+
+    # The series are kept on disk.
+    client = FakeClient()
+    store = HistoryStore(str(tmp_path), client, clock=lambda: NOW)
+    assert dict(store.get_range('BTC', 50 * STEP, 350 * STEP)['BTC']) == _expected('BTC', 50 * STEP, 350 * STEP)
+    assert dict(store.get_range('ETH', 100 * STEP, 120 * STEP)['ETH']) == _expected('ETH', 100 * STEP, 120 * STEP)
+    assert client.requests == []
+
+
+def test_last_day_is_fetched_again(tmp_path):
+    client = FakeClient()
+    store = HistoryStore(str(tmp_path), client, clock=lambda: NOW)
+    start = NOW - 3 * CLOSED_RANGE_MIN_AGE
+    assert dict(store.get_range('BTC', start)['BTC']) == _expected('BTC', start, NOW)
+    assert dict(store.get_range('BTC', start)['BTC']) == _expected('BTC', start, NOW)
+    closed = NOW - CLOSED_RANGE_MIN_AGE
+    assert client.requests == [('BTC', start, NOW), ('BTC', closed + 1, NOW)]
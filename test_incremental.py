@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+from collections import OrderedDict
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+
+from benchmark import generate_trades
+from find_duplicates import list_duplicates
+from find_unmatched_movements import match_movements
+from incremental import IncrementalAnalysis, IncrementalDuplicates, IncrementalMovements
+from tools import Trade
+
+WINDOW = timedelta(minutes=5)
+
+
+def _mutate(rnd, trades):
+    keys = [key for key in trades if key not in ('success', 'method')]
+    for key in rnd.sample(keys, 20):
+        del trades[key]
+        keys.remove(key)
+    for key in rnd.sample(keys, 20):
+        amount_field = 'buy_amount' if trades[key]['buy_amount'] else 'sell_amount'
+        trades[key] = OrderedDict(trades[key], **{amount_field: str(Decimal(trades[key][amount_field]) + 1)})
+    for key in rnd.sample(keys, 10):
+        trades[key] = trades.pop(key)  # Moved to the end.
+    for i, key in enumerate(rnd.sample(keys, 20)):
+        # A copy of a record is a duplicate, of a movement an ambiguous or unmatched movement.
+        trades['copy{}-{}'.format(len(trades), i)] = OrderedDict(trades[key])
+
+
+def _full_run(trades):
+    trade_objs = [Trade(**trade) for key, trade in trades.items() if key not in ('success', 'method')]
+    duplicates = [trade for trade in list_duplicates(trade_objs) if 'dupok' not in trade.comment]
+    return duplicates, match_movements(trade_objs, WINDOW)
+
+
+def _odicts(trades):
+    return [trade.to_odict() for trade in trades]
+
+
+def _pairs(pairs):
+    return [(withdrawal.to_odict(), deposit.to_odict()) for withdrawal, deposit in pairs]
+
+
+def test_findings_equal_full_run(tmp_path):
+    rnd = random.Random(11)
+    trades = OrderedDict(generate_trades(3000, 12))
+    duplicates_state = str(tmp_path / 'duplicates.state')
+    movements_state = str(tmp_path / 'movements.state')
+    for run in range(4):
+        # Round trip the export through json, like read_export does.
+        export = json.loads(json.dumps(trades), object_pairs_hook=OrderedDict)
+        duplicates = IncrementalDuplicates(duplicates_state).update(export)
+        movements = IncrementalMovements(movements_state, window=WINDOW).update(export)
+        if run:
+            assert movements.changed < len(movements.records) / 10
+
+        expected_duplicates, expected = _full_run(export)
+        assert _odicts(duplicates.duplicates()) == _odicts(expected_duplicates)
+        result = movements.result()
+        assert len(result.matched) == len(expected.matched)
+        assert _pairs(result.matched) == _pairs(expected.matched)
+        assert _pairs(result.matched[:3]) == _pairs(expected.matched[:3])
+        assert _pairs([result.matched[-1]]) == _pairs([expected.matched[-1]])
+        assert _pairs(result.ambiguous) == _pairs(expected.ambiguous)
+        assert _odicts(result.unmatched) == _odicts(expected.unmatched)
+
+        duplicates.save()
+        movements.save()
+        _mutate(rnd, trades)
+
+
+def test_analysis_needs_group_and_analyze(tmp_path):
+    class Incomplete(IncrementalAnalysis):
+        name = 'incomplete'
+
+        def group(self, trade):
+            return trade.type
+
+    with pytest.raises(TypeError):
+        Incomplete(str(tmp_path / 'incomplete.state'))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+from collections import OrderedDict
+
+import pytest
+
+import profiling
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Enables profiling with fresh stages and a clock that only moves when told to.
+    """
+    now = [0.0]
+    monkeypatch.setattr(profiling, '_enabled', True)
+    monkeypatch.setattr(profiling, '_stages', OrderedDict())
+    monkeypatch.setattr(profiling.time, 'perf_counter', lambda: now[0])
+    return now
+
+
+def test_disabled_is_a_no_op(monkeypatch):
+    monkeypatch.setattr(profiling, '_enabled', False)
+    monkeypatch.setattr(profiling, '_stages', OrderedDict())
+    with profiling.stage('parse') as stage:
+        stage.add(records=10)
+    assert profiling.stage('parse') is profiling.stage('convert')
+    profiling.count('parse', records=1)
+    items = [1, 2, 3]
+    assert profiling.iterate('parse', items) is items
+    assert profiling.summary() == OrderedDict()
+
+
+def test_stage_counters(clock):
+    for records in (100, 300):
+        with profiling.stage('convert') as stage:
+            stage.add(records=records, batches=1)
+            clock[0] += 2.0
+    profiling.count('convert', retries=1)
+    with pytest.raises(ValueError):
+        with profiling.stage('match'):
+            clock[0] += 0.5
+            raise ValueError()
+
+    summary = profiling.summary()
+    assert list(summary) == ['convert', 'match']
+    convert = summary['convert']
+    assert [(name, convert[name]) for name in ('calls', 'seconds', 'records', 'batches', 'retries',
+                                               'records_per_second')] == \
+        [('calls', 2), ('seconds', 4.0), ('records', 400), ('batches', 2), ('retries', 1),
+         ('records_per_second', 100)]
+    assert summary['match']['calls'] == 1
+    assert summary['match']['seconds'] == 0.5
+    assert 'records_per_second' not in summary['match']
+    if profiling.resource is not None:
+        assert convert['max_rss_bytes'] > 0
+
+
+def test_iterate_excludes_the_consumer(clock):
+    def produce():
+        for i in range(4):
+            clock[0] += 0.25
+            yield i
+
+    result = []
+    for item in profiling.iterate('parse', produce()):
+        clock[0] += 10.0  # Time of the consumer.
+        result.append(item)
+    assert result == [0, 1, 2, 3]
+    # An iteration that is stopped early is recorded as well.
+    for _ in profiling.iterate('parse', produce()):
+        break
+
+    parse = profiling.summary()['parse']
+    assert parse['calls'] == 2
+    assert parse['seconds'] == 1.25
+    assert parse['records'] == 5
+    assert parse['records_per_second'] == 4
+
+
+@pytest.mark.parametrize('to_file', [True, False])
+def test_write_summary(clock, tmp_path, capsys, to_file):
+    with profiling.stage('api.getTrades') as stage:
+        stage.add(bytes=2048)
+        clock[0] += 1.5
+    if to_file:
+        filename = str(tmp_path / 'profile.json')
+        profiling.write_summary(filename)
+        with open(filename) as input_file:
+            data = json.load(input_file, object_pairs_hook=OrderedDict)
+    else:
+        profiling.write_summary('-')
+        data = json.loads(capsys.readouterr().err, object_pairs_hook=OrderedDict)
+    assert list(data) == ['api.getTrades']
+    assert list(data['api.getTrades'])[:3] == ['calls', 'seconds', 'bytes']
+    assert data['api.getTrades']['seconds'] == 1.5
+    assert data['api.getTrades']['bytes'] == 2048
+
+
+def test_arguments(monkeypatch):
+    enabled = []
+    monkeypatch.setattr(profiling, 'enable', lambda *args: enabled.append(args))
+    parser = argparse.ArgumentParser()
+    profiling.add_arguments(parser)
+    profiling.enable_from_args(parser.parse_args([]))
+    profiling.enable_from_args(parser.parse_args(['--profile']))
+    profiling.enable_from_args(parser.parse_args(['--profile', 'out.json', '--cprofile', 'out.pstats']))
+    profiling.enable_from_args(parser.parse_args(['--cprofile', 'out.pstats']))
+    assert enabled == [('-', None), ('out.json', 'out.pstats'), ('-', 'out.pstats')]
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import random
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from benchmark import generate_trades
+from query import CURRENCY_FIELDS, GROUP_KEYS, INDEXED_FIELDS, QueryIndex
+from tools import Trade
+from trade_table import AMOUNT_COLUMNS, TradeTable
+
+
+@pytest.fixture(scope='module')
+def data():
+    records = [trade for key, trade in generate_trades(3000, 15).items() if key not in ('success', 'method')]
+    # Amounts that the table keeps as Decimals.
+    for i in range(0, 300, 7):
+        records[i] = OrderedDict(records[i], fee_amount='0.0000000015', fee_currency=records[i]['sell_currency'] or
+                                 records[i]['buy_currency'])
+    trades = [Trade(**record) for record in records]
+    return QueryIndex(TradeTable.from_dicts(records)), trades
+
+
+def _matches(trade, start_time, end_time, filters):
+    timestamp = int(trade.time.timestamp())
+    if start_time is not None and timestamp < start_time or end_time is not None and timestamp >= end_time:
+        return False
+    for field, value in filters.items():
+        values = [getattr(trade, name) for name in CURRENCY_FIELDS] if field == 'currency' else \
+            [getattr(trade, field)]
+        if value not in values:
+            return False
+    return True
+
+
+def _group(trade, key):
+    if key is None:
+        return None
+    if key in INDEXED_FIELDS:
+        return getattr(trade, key)
+    day = trade.time.date()
+    return {'day': day, 'month': day.replace(day=1), 'year': day.replace(month=1, day=1)}[key]
+
+
+def _random_query(rnd, trades):
+    times = sorted(int(trade.time.timestamp()) for trade in trades)
+    start_time = rnd.choice((None, rnd.choice(times)))
+    end_time = rnd.choice((None, rnd.choice(times) + rnd.randint(0, 3600)))
+    filters = {}
+    for field in rnd.sample(INDEXED_FIELDS + ('currency',), rnd.randint(0, 3)):
+        if field == 'currency':
+            values = sorted(set(trade.buy_currency for trade in trades if trade.buy_currency))
+        else:
+            values = sorted(set(getattr(trade, field) for trade in trades))
+        filters[field] = rnd.choice(values + ['unknown'] if rnd.random() < 0.1 else values)
+    return start_time, end_time, filters
+
+
+def test_queries_equal_brute_force(data):
+    index, trades = data
+    ordered = sorted(trades)
+    rnd = random.Random(16)
+    for _ in range(200):
+        start_time, end_time, filters = _random_query(rnd, trades)
+        query = index.query(start_time, end_time, **filters)
+        expected = [trade for trade in ordered if _matches(trade, start_time, end_time, filters)]
+        assert [row.to_odict() for row in query] == [trade.to_odict() for trade in expected]
+        assert query.count() == len(expected)
+
+        column = rnd.choice(AMOUNT_COLUMNS)
+        assert query.sum(column) == sum((getattr(trade, column) for trade in expected), Decimal(0))
+        key = rnd.choice(GROUP_KEYS + (None,))
+        groups = OrderedDict()
+        for trade in expected:
+            groups[_group(trade, key)] = groups.get(_group(trade, key), Decimal(0)) + getattr(trade, column)
+        assert query.group_by(key, column) == OrderedDict(sorted(groups.items()))
+        if key is not None:
+            counts = OrderedDict()
+            for trade in expected:
+                counts[_group(trade, key)] = counts.get(_group(trade, key), 0) + 1
+            assert query.group_by(key) == OrderedDict(sorted(counts.items()))
+
+
+def test_filter_narrows_a_query(data):
+    index, trades = data
+    times = sorted(trade.time for trade in trades)
+    start, middle, end = times[100], times[1500], times[2500]
+    query = index.query(start, end, currency='BTC').filter(middle, type='Withdrawal', exchange=None)
+    expected = [trade for trade in sorted(trades) if
+                _matches(trade, int(middle.timestamp()), int(end.timestamp()),
+                         {'currency': 'BTC', 'type': 'Withdrawal'})]
+    assert expected
+    assert [row.to_odict() for row in query] == [trade.to_odict() for trade in expected]
+    assert index.query(currency='BTC').filter(currency='ETH').count() == 0
+    assert index.query(start_time=datetime.fromtimestamp(0).date()).count() == len(trades)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from collections import OrderedDict
+
+import pytest
+
+from incremental import read_export
+from store import SyncError, TradeStore, merge_accounts, read_journal, split_trade_id, tag_account
+from tools import read_trades_from_file, iter_trade_dicts
+
+
+def _trade(trade_id, time, amount='1.0'):
+    return OrderedDict([
+        ('type', 'Deposit'), ('time', str(time)), ('trade_id', trade_id),
+        ('buy_currency', 'BTC'), ('sell_currency', ''), ('fee_currency', ''),
+        ('buy_amount', amount), ('sell_amount', ''), ('fee_amount', ''),
+        ('exchange', 'Kraken'), ('group', ''), ('comment', ''),
+        ('imported_from', ''), ('imported_time', str(time)),
+    ])
+
+
+def _response(*trades):
+    response = OrderedDict([('success', 1), ('method', 'getTrades')])
+    for trade in trades:
+        response[trade['trade_id']] = trade
+    return response
+
+
+def _fetcher(*trades):
+    def get_trades(start_time=None):
+        return _response(*(trade for trade in trades if start_time is None or int(trade['time']) >= start_time))
+    return get_trades
+
+
+def test_sync_appends_to_journal(tmp_path):
+    filename = str(tmp_path / 'trades.json')
+    trades = [_trade(str(i), 1000 + i) for i in range(20)]
+    store = TradeStore(filename)
+    assert store.sync(_fetcher(*trades)) == (20, 0, 0)
+    store.save()
+    assert not os.path.exists(filename + '.journal')
+    mtime = os.stat(filename).st_mtime_ns
+
+    changed = _trade('19', 1019, '2.0')
+    store = TradeStore(filename)
+    assert store.sync(_fetcher(*(trades[:19] + [changed, _trade('20', 1020)])), lookback=5) == (1, 1, 0)
+    store.save()
+    assert os.stat(filename).st_mtime_ns == mtime
+    assert list(read_journal(filename)) == ['19', '20']
+
+    expected = [trade['trade_id'] for trade in trades] + ['20']
+    assert list(TradeStore(filename).trades) == expected
+    assert [key for key, _ in iter_trade_dicts(filename)][2:] == expected
+    assert list(read_trades_from_file(filename))[2:] == expected
+    assert read_export(filename)['19'] == changed
+
+
+def test_sync_prunes_deleted_trades(tmp_path):
+    filename = str(tmp_path / 'trades.json')
+    trades = [_trade(str(i), 1000 + i) for i in range(20)]
+    store = TradeStore(filename)
+    store.sync(_fetcher(*trades))
+    store.save()
+
+    # Trade 18 was deleted on cointracking, trade 2 is older than the sync and is kept.
+    store = TradeStore(filename)
+    assert store.sync(_fetcher(*[trade for trade in trades if trade['trade_id'] not in ('2', '18')]),
+                      lookback=5) == (0, 0, 1)
+    store.save()
+    assert '18' not in TradeStore(filename).trades
+    assert '2' in TradeStore(filename).trades
+    assert '18' not in dict(iter_trade_dicts(filename))
+
+
+def test_large_journal_is_merged(tmp_path):
+    filename = str(tmp_path / 'trades.json')
+    trades = [_trade(str(i), 1000 + i) for i in range(8)]
+    store = TradeStore(filename)
+    store.sync(_fetcher(*trades))
+    store.save()
+
+    store = TradeStore(filename)
+    store.sync(_fetcher(*(trades + [_trade('8', 1008), _trade('9', 1009), _trade('10', 1010)])), lookback=0)
+    store.save()
+    assert not os.path.exists(filename + '.journal')
+    assert list(TradeStore(filename).trades) == [str(i) for i in range(11)]
+
+
+def test_torn_journal_append_is_cut_off(tmp_path):
+    filename = str(tmp_path / 'trades.json')
+    trades = [_trade(str(i), 1000 + i) for i in range(20)]
+    store = TradeStore(filename)
+    store.sync(_fetcher(*trades))
+    store.save()
+    trades.append(_trade('20', 1020))
+    store = TradeStore(filename)
+    store.sync(_fetcher(*trades), lookback=5)
+    store.save()
+
+    # A save that was interrupted in the middle of a line.
+    with open(filename + '.journal', 'a') as journal_file:
+        journal_file.write('["21",{"type":"Dep')
+    assert list(read_journal(filename)) == ['20']
+
+    trades += [_trade('21', 1021), _trade('22', 1022)]
+    store = TradeStore(filename)
+    assert store.sync(_fetcher(*trades), lookback=5) == (2, 0, 0)
+    store.save()
+    with open(filename + '.journal') as journal_file:
+        assert all(line.startswith('["2') for line in journal_file)
+    assert list(read_journal(filename)) == ['20', '21', '22']
+    assert list(TradeStore(filename).trades) == [str(i) for i in range(23)]
+
+
+def test_bad_journal_line_is_skipped(tmp_path):
+    filename = str(tmp_path / 'trades.json')
+    with open(filename + '.journal', 'w') as journal_file:
+        journal_file.write('["1",null]\n["2",{"type\n["3",null]\n')
+    assert list(read_journal(filename)) == ['1', '3']
+
+
+def test_tag_and_merge_accounts():
+    response = _response(_trade('1', 1001), _trade('2', 1002))
+    tagged = tag_account(response, 'shop')
+    assert list(tagged) == ['success', 'method', 'shop:1', 'shop:2']
+    assert tagged['shop:1']['trade_id'] == 'shop:1'
+    assert response['1']['trade_id'] == '1'
+    assert split_trade_id('shop:1') == ('shop', '1')
+    assert split_trade_id('a:b:1') == ('a:b', '1')
+    assert split_trade_id('1') == (None, '1')
+
+    merged = merge_accounts(OrderedDict([('shop', response), ('home', _response(_trade('1', 1003)))]))
+    assert list(merged) == ['success', 'method', 'shop:1', 'shop:2', 'home:1']
+    with pytest.raises(SyncError):
+        merge_accounts({'shop': {'success': 0, 'error_msg': 'Invalid key'}})
+
+
+class _AccountFetcher(object):
+    """
+    Answers like `api.Client.get_trades` for one account and records the requested start times.
+    """
+
+    def __init__(self, trades, barrier):
+        self.trades = trades
+        self.barrier = barrier
+        self.start_times = []
+
+    def get_trades(self, start_time=None):
+        self.start_times.append(start_time)
+        # Both accounts are fetched at the same time.
+        self.barrier.wait(timeout=5)
+        return _fetcher(*self.trades)(start_time=start_time)
+
+
+def test_sync_accounts(tmp_path):
+    filename = str(tmp_path / 'trades.json')
+    barrier = threading.Barrier(2)
+    shop = _AccountFetcher([_trade(str(i), 1000 + i) for i in range(10)], barrier)
+    home = _AccountFetcher([_trade(str(i), 5000 + i) for i in range(5)], barrier)
+    store = TradeStore(filename)
+    assert store.sync_accounts(OrderedDict([('shop', shop.get_trades), ('home', home.get_trades)])) == \
+        OrderedDict([('shop', (10, 0, 0)), ('home', (5, 0, 0))])
+    assert list(store.trades) == ['shop:{}'.format(i) for i in range(10)] + ['home:{}'.format(i) for i in range(5)]
+    assert store.accounts == ['shop', 'home']
+    assert store.max_time == 5004
+    store.save()
+
+    # Every account is synced from its own high-water mark.
+    shop.trades = shop.trades[:9] + [_trade('10', 1010)]
+    home.trades = home.trades + [_trade('9', 5009, '2.0')]
+    store = TradeStore(filename)
+    assert store.sync_accounts(OrderedDict([('shop', shop.get_trades), ('home', home.get_trades)]),
+                               lookback=5) == OrderedDict([('shop', (1, 0, 1)), ('home', (1, 0, 0))])
+    assert shop.start_times == [None, 1004]
+    assert home.start_times == [None, 4999]
+    store.save()
+
+    store = TradeStore(filename)
+    assert 'shop:9' not in store.trades
+    assert store.trades['shop:10']['time'] == '1010'
+    assert store.trades['home:9']['buy_amount'] == '2.0'
+    assert store.state['accounts'] == OrderedDict([
+        ('shop', OrderedDict([('max_time', 1010), ('max_imported_time', 1010)])),
+        ('home', OrderedDict([('max_time', 5009), ('max_imported_time', 5009)])),
+    ])
+    assert store.sync_accounts({}) == OrderedDict()
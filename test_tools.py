@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import json
+from collections import OrderedDict
+
+import pytest
+
+from benchmark import generate_trades, write_trades
+from compression import open_file
+from tools import ExtendedJSONEncoder, ReportWriter, Trade, iter_trade_dicts, iter_trades_from_file
+
+NUMBERS = '{"a": 1.5, "b": 12, "c": -0.25e-3, "d": 7E+2, "e": [1.5, {"f": 2.0}], "g": "1.5", "h": true, ' \
+          '"i": null, "j": 100}'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 4, 8, 1 << 16])
+def test_stream_equals_json_load(tmp_path, chunk_size):
+    filename = str(tmp_path / 'numbers.json')
+    with open(filename, 'w') as output_file:
+        output_file.write(NUMBERS)
+    assert list(iter_trade_dicts(filename, chunk_size)) == list(json.loads(NUMBERS).items())
+
+    filename = str(tmp_path / 'empty.json')
+    with open(filename, 'w') as output_file:
+        output_file.write(' { } ')
+    assert list(iter_trade_dicts(filename, chunk_size)) == []
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 64])
+def test_stream_of_an_export(tmp_path, chunk_size):
+    filename = str(tmp_path / 'trades.json')
+    write_trades(filename, 50, seed=17)
+    with open(filename) as input_file:
+        expected = json.load(input_file, object_pairs_hook=OrderedDict)
+    assert list(iter_trade_dicts(filename, chunk_size)) == list(expected.items())
+
+
+def test_trades_from_compressed_file(tmp_path):
+    filename = str(tmp_path / 'trades.json.gz')
+    trades = generate_trades(50, seed=18)
+    with open_file(filename, 'w') as output_file:
+        json.dump(trades, output_file)
+    expected = [Trade(**trade) for key, trade in trades.items() if key not in ('success', 'method')]
+    assert [trade.to_odict() for trade in iter_trades_from_file(filename)] == \
+        [trade.to_odict() for trade in expected]
+
+
+class TerminalOutput(io.StringIO):
+    def isatty(self):
+        return True
+
+
+def _findings():
+    trades = [Trade(**trade).to_odict() for key, trade in generate_trades(6, 21).items()
+              if key not in ('success', 'method')]
+    return [('duplicate', trades[0]), ('near_duplicate', trades[1:3]), ('unmatched_movement', trades[3])]
+
+
+def _write(output_format, findings, output=None, **options):
+    output = output if output is not None else io.StringIO()
+    with ReportWriter(output, output_format, **options) as writer:
+        for kind, finding in findings:
+            writer.write(finding, kind)
+    assert writer.count == len(findings)
+    return output.getvalue()
+
+
+def test_report_json():
+    findings = _findings()
+    text = _write('json', findings)
+    assert text == json.dumps([finding for _, finding in findings], indent=4, cls=ExtendedJSONEncoder) + '\n'
+    assert _write('json', []) == ''
+
+
+def test_report_ndjson():
+    findings = _findings()
+    records = [json.loads(line, object_pairs_hook=OrderedDict) for line in _write('ndjson', findings).splitlines()]
+    assert [record.pop('finding') for record in records] == [kind for kind, _ in findings]
+    assert records[1] == {'trades': json.loads(json.dumps(findings[1][1], cls=ExtendedJSONEncoder))}
+    assert records[2] == json.loads(json.dumps(findings[2][1], cls=ExtendedJSONEncoder))
+    assert _write('ndjson', []) == ''
+
+
+def test_report_csv():
+    findings = _findings()
+    rows = list(csv.reader(io.StringIO(_write('csv', findings, fields=('trade_id', 'time', 'buy_amount')))))
+    assert rows[0] == ['finding', 'number', 'trade_id', 'time', 'buy_amount']
+    encoder = ExtendedJSONEncoder()
+    expected = [[kind, str(number), trade['trade_id'], trade['time'].isoformat(), encoder.default(trade['buy_amount'])]
+                for number, (kind, finding) in enumerate(findings, 1)
+                for trade in (finding if isinstance(finding, list) else [finding])]
+    assert rows[1:] == expected
+    # Not colored on a terminal either.
+    assert _write('csv', findings, TerminalOutput(), fields=('trade_id', 'time', 'buy_amount')) == \
+        _write('csv', findings, fields=('trade_id', 'time', 'buy_amount'))
+
+
+@pytest.mark.parametrize('output_format', ['json', 'ndjson'])
+def test_report_colors_only_on_terminal(output_format):
+    pytest.importorskip('pygments')
+    findings = _findings()
+    plain = _write(output_format, findings)
+    assert '\x1b[' not in plain
+    colored = _write(output_format, findings, TerminalOutput())
+    assert '\x1b[' in colored
+    assert _write(output_format, findings, TerminalOutput(), use_colors=False) == plain
+    assert _write(output_format, findings, use_colors=True) == colored
+
+
+def test_report_unknown_format():
+    with pytest.raises(ValueError):
+        ReportWriter(io.StringIO(), 'xml')
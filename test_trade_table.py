@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import json
+from collections import OrderedDict
+from decimal import Decimal
+
+import pytest
+
+from benchmark import generate_trades
+from compression import zstandard_available
+from find_duplicates import list_duplicates
+from find_unmatched_movements import MOVEMENT_TYPES, movement_key
+from snapshot import load_snapshot, write_snapshot
+from tools import Trade
+from trade_table import AmountColumn, TradeTable
+
+
+def _records(num_records=2000, seed=3):
+    return [trade for key, trade in generate_trades(num_records, seed).items() if key not in ('success', 'method')]
+
+
+def test_rows_equal_trades():
+    records = _records()
+    table = TradeTable.from_dicts(records)
+    trades = [Trade(**record) for record in records]
+    assert len(table) == len(trades)
+    for row, trade in zip(table, trades):
+        assert row == trade
+        assert hash(row) == hash(trade)
+        assert row.to_odict() == trade.to_odict()
+    assert [row.row for row in table.sorted_rows()] == sorted(range(len(trades)), key=lambda i: trades[i].time)
+
+
+def test_amounts_are_restored_exactly():
+    values = ['1.00000000', '1.000000000', '0.000000001', '-2.5000000000', '1E+5', '0E-12', '123456789012.5',
+              '1.' + '0' * 40]
+    column = AmountColumn()
+    for value in values:
+        column.append(Decimal(value))
+    assert [str(column[row]) for row in range(len(values))] == [str(Decimal(value)) for value in values]
+
+
+def test_equal_amounts_with_more_places_are_equal():
+    # Trade objects treat 1.00000000 and 1.000000000 as the same amount.
+    records = _records(1)
+    records = [OrderedDict(records[0], buy_amount='1.00000000'), OrderedDict(records[0], buy_amount='1.000000000')]
+    table = TradeTable.from_dicts(records)
+    assert table[0] == table[1]
+    assert hash(table[0]) == hash(table[1])
+    assert len(table.list_duplicates()) == len(list_duplicates(Trade(**record) for record in records)) == 1
+
+
+def test_overflow_keys_do_not_collide():
+    # An overflow of 5 must not equal 0.00000005, which is stored as the scaled integer 5.
+    record = _records(1)[0]
+    records = [OrderedDict(record, buy_amount='5.' + '0' * 40), OrderedDict(record, buy_amount='0.00000005'),
+               OrderedDict(record, fee_amount='1E+11'), OrderedDict(record, fee_amount='1000'),
+               OrderedDict(record, buy_amount='5')]
+    table = TradeTable.from_dicts(records)
+    assert table.amounts['buy_amount'].overflow and table.amounts['fee_amount'].overflow
+    trades = [Trade(**record) for record in records]
+    assert [row.to_odict() for row in table.list_duplicates()] == \
+        [trade.to_odict() for trade in list_duplicates(trades)] == [trades[4].to_odict()]
+    assert table.row_key(0) == table.row_key(4) != table.row_key(1)
+    assert table.row_key(2) != table.row_key(3)
+
+
+def test_list_duplicates_equals_trades():
+    records = _records()
+    fee_amount = Decimal(records[5]['fee_amount'] or 0).quantize(Decimal('1E-10'))
+    records.append(OrderedDict(records[5], fee_amount=str(fee_amount)))
+    table = TradeTable.from_dicts(records)
+    trades = [Trade(**record) for record in records]
+    assert [row.to_odict() for row in table.list_duplicates()] == \
+        [trade.to_odict() for trade in list_duplicates(trades)]
+
+
+def test_movement_keys_equal_trades():
+    records = _records()
+    table = TradeTable.from_dicts(records)
+    keys = {}
+    for row, record in zip(table, records):
+        trade = Trade(**record)
+        if trade.type in MOVEMENT_TYPES:
+            # Equal keys for the table must mean equal keys for the Trade objects and vice versa.
+            keys.setdefault(table.movement_key(row.row), set()).add(movement_key(trade))
+    assert all(len(trade_keys) == 1 for trade_keys in keys.values())
+    assert len(set.union(*keys.values())) == len(keys)
+
+
+@pytest.mark.parametrize('extension', [
+    '', '.gz', '.bz2', '.xz',
+    pytest.param('.zst', marks=pytest.mark.skipif(not zstandard_available, reason="zstandard is not installed")),
+])
+def test_snapshot_roundtrip(tmp_path, extension):
+    records = _records()
+    table = TradeTable.from_dicts(records)
+    filename = str(tmp_path / 'trades.snapshot') + extension
+    write_snapshot(table, filename)
+    loaded = load_snapshot(filename)
+    assert [row.to_odict() for row in loaded] == [row.to_odict() for row in table]
+    assert json.dumps([row.trade_key() for row in loaded], default=str) == \
+        json.dumps([row.trade_key() for row in table], default=str)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import pytest
+
+from transport import TokenBucket, Transport, TransportError
+
+
+SECRET = b'secret'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers with the next of the scripted (status, headers, body) responses and records the requests.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        server.requests.append((self.headers['Key'], self.headers['Sign'], body))
+        status, headers, response_body = server.responses.pop(0)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.requests = []
+    server.responses = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _transport(server, sleeps, **options):
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    return Transport(url, 'key', SECRET, calls_per_hour=3600000, sleep=sleeps.append, **options)
+
+
+def test_retries_throttled_failed_and_invalid_responses(stub_server):
+    result = {'success': 1, 'method': 'getBalance'}
+    stub_server.responses = [
+        (429, {'Retry-After': '7'}, b''),
+        (503, {}, b''),
+        (200, {}, b'<html>Bad gateway</html>'),
+        (200, {}, json.dumps(result).encode('utf8')),
+    ]
+    sleeps = []
+    assert _transport(stub_server, sleeps, backoff=1.0).call('getBalance') == result
+    assert sleeps == [7.0, 2.0, 4.0]
+
+    nonces = []
+    for key, sign, body in stub_server.requests:
+        assert key == 'key'
+        assert sign == hmac.new(SECRET, body, hashlib.sha512).hexdigest()
+        params = dict(parse_qsl(body.decode('utf8')))
+        assert params['method'] == 'getBalance'
+        nonces.append(int(params['nonce']))
+    assert nonces == sorted(set(nonces))
+
+
+def test_gives_up_after_max_retries(stub_server):
+    stub_server.responses = [(500, {}, b'')] * 3
+    sleeps = []
+    with pytest.raises(TransportError):
+        _transport(stub_server, sleeps, max_retries=2).call('getTrades', start_time=1)
+    assert len(stub_server.requests) == 3
+    assert b'start_time=1' in stub_server.requests[0][2]
+
+
+def test_token_bucket_limits_the_rate():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    bucket = TokenBucket(rate=0.5, capacity=2, clock=lambda: now[0], sleep=sleep)
+    assert [bucket.acquire() for _ in range(4)] == [0.0, 0.0, 2.0, 2.0]
+    assert now[0] == 4.0
@@ -2,10 +2,19 @@
 """
 Some tools useful in conjunction with the API, for example a Trade object.
 """
+import csv
+import gc
 import json
+import logging
+import sys
 from collections import OrderedDict
 from datetime import datetime, date
 from decimal import Decimal
+from sys import intern
+
+import profiling
+from compression import open_file
+from store import read_journal, apply_journal
 
 try:
     # noinspection PyUnresolvedReferences
@@ -15,13 +24,29 @@ except ImportError:
     pygments_available = False
 
 
-def prettify(data, use_colors=pygments_available, indent=4, newlines=True):
+log = logging.getLogger(__name__)
+
+TRADE_FIELDS = ('type', 'time', 'trade_id', 'buy_currency', 'sell_currency', 'fee_currency',
+                'buy_amount', 'sell_amount', 'fee_amount', 'exchange', 'group', 'comment',
+                'imported_from', 'imported_time')
+_TRADE_FIELD_SET = frozenset(TRADE_FIELDS)
+
+
+def _use_colors(output):
+    """
+    Returns True if colors should be used for an output stream: pygments is installed and it is a terminal.
+    """
+    isatty = getattr(output, 'isatty', None)
+    return pygments_available and isatty is not None and isatty()
+
+
+def prettify(data, use_colors=None, indent=4, newlines=True):
     """
     Prints a dict as prettily formatted json (with indents).
     Uses colors if available.
     @param data: Data to print as json.
     @type data: dict|list
-    @param use_colors: If true, use colors. Default is True if pygments is installed.
+    @param use_colors: If true, use colors. Default is True if pygments is installed and stdout is a terminal.
     @type use_colors: bool
     @param indent: Number of spaces to indent.
     @type indent: int
@@ -30,6 +55,8 @@ def prettify(data, use_colors=pygments_available, indent=4, newlines=True):
     @return: formatted output
     @rtype: str
     """
+    if use_colors is None:
+        use_colors = _use_colors(sys.stdout)
     json_str = json.dumps(data, indent=indent, cls=ExtendedJSONEncoder)
     if not newlines:
         json_str = json_str.replace('\n', '')
@@ -42,13 +69,142 @@ def prettify(data, use_colors=pygments_available, indent=4, newlines=True):
 
 def read_trades_from_file(filename):
     """
-    Reads trades from a json file.
+    Reads trades from a json file, which may be compressed (see `compression.py`). The journal of a trade store
+    (see `store.py`) is applied. Loads the whole file at once; use `iter_trades_from_file` for large files.
     :param filename: Filename
     :type filename: str
     :return: trades
     :rtype: dict
     """
-    return json.load(open(filename), object_pairs_hook=OrderedDict)
+    with profiling.stage('tools.read_trades_from_file') as stage, open_file(filename) as input_file:
+        trades = json.load(input_file, object_pairs_hook=OrderedDict)
+        journal = read_journal(filename)
+        if journal:
+            trades = OrderedDict(apply_journal(trades.items(), journal))
+        stage.add(records=len(trades))
+        return trades
+
+
+def iter_trade_dicts(filename, chunk_size=1 << 16):
+    """
+    Incrementally parses a json export and yields its top-level items one at a time.
+    Only one item is held in memory at a time, independent of the size of the file. Compressed files are
+    decompressed on the fly. The journal of a trade store (see `store.py`) is applied.
+    :param filename: Filename
+    :type filename: str
+    :param chunk_size: Number of characters to read at once.
+    :type chunk_size: int
+    :return: generator of (key, value) tuples
+    :rtype: generator
+    """
+    with open_file(filename) as input_file:
+        stream = _JSONObjectStream(input_file, chunk_size)
+        for item in apply_journal(stream.items(), read_journal(filename)):
+            yield item
+
+
+def iter_trades_from_file(filename, report=None):
+    """
+    Reads trades from a json file and yields them as Trade objects, one at a time.
+    Skips the fields of the API result that are not trades.
+    :param filename: Filename
+    :type filename: str
+    :param report: Collects records that could not be converted, see `convert_trade_objs`.
+    :type report: ConversionReport
+    :return: generator of trades
+    :rtype: generator<Trade>
+    """
+    trades = profiling.iterate('tools.parse_json', (trade for key, trade in iter_trade_dicts(filename)))
+    return iter_trade_objs(trades, report)
+
+
+def iter_trades(filename, report=None):
+    """
+    Reads trades from a json export or from a binary snapshot (see `snapshot.py`).
+    Snapshots are memory-mapped and yield rows that compare equal to the Trade objects read from json.
+    :param filename: Filename
+    :type filename: str
+    :param report: Collects records that could not be converted (json only, snapshots are already converted).
+    :type report: ConversionReport
+    :return: iterable of trades
+    :rtype: iterable<Trade>
+    """
+    import snapshot  # Imported here as snapshot depends on this module.
+    if snapshot.is_snapshot(filename):
+        return snapshot.load_snapshot(filename)
+    return iter_trades_from_file(filename, report)
+
+
+class _JSONObjectStream(object):
+    """
+    Minimal incremental reader for a json file containing a single top-level object.
+    The values of the object are decoded with the standard json decoder, one at a time.
+    """
+
+    def __init__(self, input_file, chunk_size):
+        self.input_file = input_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read_more(self):
+        chunk = self.input_file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """
+        Skips whitespace and returns the next character (or None at the end of the file).
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read_more():
+                return None
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char is None or char not in chars:
+            raise ValueError("Expected one of {!r} but found {!r}".format(chars, char))
+        self.pos += 1
+        return char
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self._read_more():
+                    continue
+                raise
+            # A value at the end of the buffer might continue in the next chunk, and so might a number that
+            # stops before its fraction or exponent (eg `1.` of `1.5`).
+            incomplete = end == len(self.buffer) or \
+                (isinstance(value, (int, float)) and self.buffer[end] in '.eE')
+            if incomplete and not self.eof and self._read_more():
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._decode()
+            self._expect(':')
+            yield key, self._decode()
+            if self._expect(',}') == '}':
+                return
 
 
 class ExtendedJSONEncoder(json.JSONEncoder):
@@ -60,6 +216,29 @@ class ExtendedJSONEncoder(json.JSONEncoder):
         return super(ExtendedJSONEncoder, self).default(obj)
 
 
+def _init_trade(trade, fields):
+    """
+    Sets the attributes of a Trade from the (string) fields of a record.
+    Types, currencies, exchanges and groups repeat across records and are interned, so that all trades share the
+    same string objects.
+    """
+    attrs = trade.__dict__
+    attrs['type'] = intern(fields['type'].strip())
+    attrs['time'] = datetime.fromtimestamp(int(fields['time'].strip()))
+    attrs['trade_id'] = fields['trade_id'].strip()
+    attrs['buy_currency'] = intern(fields['buy_currency'].strip())
+    attrs['sell_currency'] = intern(fields['sell_currency'].strip())
+    attrs['fee_currency'] = intern(fields['fee_currency'].strip())
+    attrs['buy_amount'] = Decimal(fields['buy_amount'].strip() or 0)
+    attrs['sell_amount'] = Decimal(fields['sell_amount'].strip() or 0)
+    attrs['fee_amount'] = Decimal(fields['fee_amount'].strip() or 0)
+    attrs['exchange'] = intern(fields['exchange'].strip())
+    attrs['group'] = intern(fields['group'].strip())
+    attrs['comment'] = fields['comment'].strip()
+    attrs['imported_from'] = fields['imported_from'].strip()
+    attrs['imported_time'] = datetime.fromtimestamp(int(fields['imported_time'].strip()))
+
+
 class Trade(object):
     """
     A trade object represents a single trade entry in cointracking's API.
@@ -69,20 +248,7 @@ class Trade(object):
     # noinspection PyShadowingBuiltins
     def __init__(self, type, time, trade_id, buy_currency, sell_currency, fee_currency,
                  buy_amount, sell_amount, fee_amount, exchange, group, comment, imported_from, imported_time):
-        self.type = type.strip()
-        self.time = datetime.fromtimestamp(int(time.strip()))
-        self.trade_id = trade_id.strip()
-        self.buy_currency = buy_currency.strip()
-        self.sell_currency = sell_currency.strip()
-        self.fee_currency = fee_currency.strip()
-        self.buy_amount = Decimal(buy_amount.strip() or 0)
-        self.sell_amount = Decimal(sell_amount.strip() or 0)
-        self.fee_amount = Decimal(fee_amount.strip() or 0)
-        self.exchange = exchange.strip()
-        self.group = group.strip()
-        self.comment = comment.strip()
-        self.imported_from = imported_from.strip()
-        self.imported_time = datetime.fromtimestamp(int(imported_time.strip()))
+        _init_trade(self, locals())  # The parameters are the fields of the record.
 
     def __key(self):
         """
@@ -138,25 +304,282 @@ class Trade(object):
         ])
 
 
-def convert_trade_objs(trades):
+class ConversionReport(object):
+    """
+    Structured report of the records that could not be converted to Trade objects.
+    """
+
+    def __init__(self):
+        self.converted = 0
+        self.rejected = []
+
+    def reject(self, trade, error):
+        self.rejected.append(OrderedDict([
+            ('error', '{}: {}'.format(type(error).__name__, error)),
+            ('record', trade),
+        ]))
+
+    def to_odict(self):
+        return OrderedDict([
+            ('converted', self.converted),
+            ('rejected', len(self.rejected)),
+            ('rejected_records', self.rejected),
+        ])
+
+
+class ReportWriter(object):
+    """
+    Writes findings to an output stream one at a time, so that the first results appear right away and memory
+    use does not grow with the number of findings.
+
+    A finding is a trade dict, or a list of related trade dicts (eg a pair of near-duplicates). Formats:
+     - json: one json array, formatted like `prettify`. Nothing is written if there are no findings.
+     - ndjson: one compact json object per line, with the kind of finding in `finding`. The trades of a list
+       finding are in `trades`.
+     - csv: one row per trade with the kind of finding, the number of the finding (to group the trades of a
+       list finding) and the trade fields.
+    json and ndjson are colored if the output is a terminal and pygments is installed.
+    """
+
+    FORMATS = ('json', 'ndjson', 'csv')
+
+    # noinspection PyShadowingBuiltins
+    def __init__(self, output=None, format='json', use_colors=None, indent=4, fields=TRADE_FIELDS):
+        """
+        @param output: Stream to write to. Default is stdout.
+        @type output: file
+        @param format: One of `FORMATS`.
+        @type format: str
+        @param use_colors: If true, use colors. Default is True if the output is a terminal.
+        @type use_colors: bool
+        @param indent: Number of spaces to indent json.
+        @type indent: int
+        @param fields: Columns of the csv format.
+        @type fields: tuple
+        """
+        if format not in self.FORMATS:
+            raise ValueError("Unknown format {}".format(format))
+        self.output = output if output is not None else sys.stdout
+        self.format = format
+        self.indent = indent
+        self.fields = fields
+        self.count = 0
+        self._in_array = False
+        self._csv = None
+        self._highlight = None
+        if use_colors is None:
+            use_colors = _use_colors(self.output)
+        if use_colors and pygments_available and format != 'csv':
+            # noinspection PyUnresolvedReferences
+            lexer, formatter = lexers.JsonLexer(), formatters.TerminalFormatter()
+            # noinspection PyUnresolvedReferences
+            self._highlight = lambda text: highlight(text, lexer, formatter).rstrip('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _colored(self, text):
+        return self._highlight(text) if self._highlight is not None else text
+
+    def write(self, finding, kind=None):
+        """
+        Writes a finding.
+        @param finding: Trade dict, or list of trade dicts.
+        @type finding: dict|list
+        @param kind: Kind of finding, eg `duplicate`. Not written in json format.
+        @type kind: str
+        """
+        self.count += 1
+        if self.format == 'json':
+            prefix = ' ' * self.indent
+            text = json.dumps(finding, indent=self.indent, cls=ExtendedJSONEncoder)
+            text = '\n'.join(prefix + line for line in text.split('\n'))
+            self.output.write((',\n' if self._in_array else '[\n') + self._colored(text))
+            self._in_array = True
+        elif self.format == 'ndjson':
+            record = OrderedDict()
+            if kind is not None:
+                record['finding'] = kind
+            if isinstance(finding, list):
+                record['trades'] = finding
+            else:
+                record.update(finding)
+            self.output.write(self._colored(json.dumps(record, cls=ExtendedJSONEncoder, separators=(',', ':'))))
+            self.output.write('\n')
+        else:
+            if self._csv is None:
+                self._csv = csv.writer(self.output)
+                self._csv.writerow(('finding', 'number') + tuple(self.fields))
+            encoder = ExtendedJSONEncoder()
+            for trade in finding if isinstance(finding, list) else [finding]:
+                row = [kind or '', self.count]
+                for field in self.fields:
+                    value = trade.get(field, '')
+                    row.append(encoder.default(value) if isinstance(value, (Decimal, date)) else value)
+                self._csv.writerow(row)
+
+    def close(self):
+        """
+        Finishes the output (closes the json array). Does not close the output stream. Writing more findings
+        after closing starts a new json array.
+        """
+        if self._in_array:
+            self.output.write('\n]\n')
+            self._in_array = False
+        self.output.flush()
+
+
+class TradeConverter(object):
+    """
+    Converts trade dicts to Trade objects in bulk.
+    Records are converted in batches, with the garbage collector paused. If a batch contains an unexpected record,
+    the batch is converted record by record to find it. See the `convert_trade_objs` and
+    `convert_trades_one_by_one` benchmarks in `benchmark.py`.
+    """
+
+    batch_size = 10000
+
+    def __init__(self, report=None):
+        self.report = report
+
+    def convert(self, trade):
+        """
+        Converts a single trade dict. Raises an exception for unexpected records.
+        :rtype: Trade
+        """
+        return self._convert_batch([trade])[0]
+
+    def _convert_batch(self, batch):
+        # Trades do not contain reference cycles. Collecting garbage while allocating a whole batch of them
+        # only costs time, so the collector is paused for the batch.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._convert_trades(batch)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _convert_trades(self, batch):
+        new = Trade.__new__
+        trade_objs = []
+        for trade in batch:
+            if trade.keys() != _TRADE_FIELD_SET:
+                raise ValueError("Unexpected fields {}".format(sorted(set(trade) ^ _TRADE_FIELD_SET)))
+            obj = new(Trade)
+            _init_trade(obj, trade)
+            trade_objs.append(obj)
+        return trade_objs
+
+    def _convert_records(self, batch):
+        """
+        Converts a batch record by record, skipping unexpected records.
+        """
+        return [trade_obj for _, trade_obj in self._convert_items_one_by_one(enumerate(batch))]
+
+    def _convert_items_one_by_one(self, items):
+        converted = []
+        for key, trade in items:
+            # Create trade object. Handle exceptions which mean that we hit an unexpected record.
+            try:
+                converted.append((key, self.convert(trade)))
+            except Exception as e:
+                if self.report is not None:
+                    self.report.reject(trade, e)
+                else:
+                    log.warning("Exception: %s for trade %s. Unexpected data? Skipping record.", e, trade)
+        return converted
+
+    def convert_all(self, trades):
+        """
+        Converts trade dicts. Records that cannot be converted are skipped and added to the report.
+        :param trades: Trade dicts as exported by cointracking.
+        :type trades: iterable<dict>
+        :return: generator of trades
+        :rtype: generator<Trade>
+        """
+        batch = []
+        for trade in trades:
+            # Strip API returns fields that are not trades (grrrr)
+            if trade == 1 or trade == 'getTrades':
+                continue
+
+            batch.append(trade)
+            if len(batch) >= self.batch_size:
+                for obj in self._convert(batch):
+                    yield obj
+                batch = []
+        for obj in self._convert(batch):
+            yield obj
+
+    def convert_items(self, items):
+        """
+        Converts (key, trade dict) pairs, eg the items of an export, keeping the keys with the trades.
+        Records that cannot be converted are skipped and added to the report.
+        :param items: (key, trade dict) pairs
+        :type items: iterable<tuple>
+        :return: generator of (key, Trade) pairs
+        :rtype: generator<tuple>
+        """
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                for converted in self._convert_items(batch):
+                    yield converted
+                batch = []
+        for converted in self._convert_items(batch):
+            yield converted
+
+    def _convert_items(self, batch):
+        with profiling.stage('tools.convert_trades') as stage:
+            try:
+                converted = list(zip([key for key, _ in batch],
+                                     self._convert_batch([trade for _, trade in batch])))
+            except Exception:
+                converted = self._convert_items_one_by_one(batch)
+            stage.add(records=len(converted))
+        if self.report is not None:
+            self.report.converted += len(converted)
+        return converted
+
+    def _convert(self, batch):
+        with profiling.stage('tools.convert_trades') as stage:
+            try:
+                trade_objs = self._convert_batch(batch)
+            except Exception:
+                trade_objs = self._convert_records(batch)
+            stage.add(records=len(trade_objs))
+        if self.report is not None:
+            self.report.converted += len(trade_objs)
+        return trade_objs
+
+
+def convert_trade_objs(trades, report=None):
     """
     Converts trade dicts to Trade objects.
     :param trades: Trades as exported by cointracking.
     :type trades: dict
+    :param report: Collects records that could not be converted. If None, they are logged as warnings.
+    :type report: ConversionReport
     :return: Ordered list of objects.
     :rtype: list<Trade>
     """
-    trade_objs = []
-    for trade in trades.values():
-        # Strip API returns fields that are not trades (grrrr)
-        if trade == 1 or trade == 'getTrades':
-            continue
+    return list(iter_trade_objs(trades.values(), report))
 
-        # Create trade object. Handle exceptions which mean that we hit an unexpected record.
-        try:
-            trade_objs.append(Trade(**trade))
-        except Exception as e:
-            print("Exception: {} for trade {}".format(str(e), str(trade)))
-            print("Unexpected data? Skipping record.")
 
-    return trade_objs
\ No newline at end of file
+def iter_trade_objs(trades, report=None):
+    """
+    Converts trade dicts to Trade objects, one at a time.
+    :param trades: Trade dicts as exported by cointracking.
+    :type trades: iterable<dict>
+    :param report: Collects records that could not be converted. If None, they are logged as warnings.
+    :type report: ConversionReport
+    :return: generator of trades
+    :rtype: generator<Trade>
+    """
+    return TradeConverter(report).convert_all(trades)
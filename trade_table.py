@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+A compact, column-oriented alternative to a list of Trade objects.
+
+Times are stored in typed arrays, amounts as scaled integers and strings (currencies, exchanges, types, ...)
+dictionary-encoded, so that millions of records fit into a fraction of the memory of Trade objects.
+Rows are exposed as light-weight views with the same API as Trade.
+"""
+import logging
+from array import array
+from datetime import datetime
+from decimal import Decimal
+
+from tools import Trade, iter_trade_dicts
+
+
+log = logging.getLogger(__name__)
+
+
+# Amounts are stored as integers in units of 10^-AMOUNT_EXPONENT.
+AMOUNT_EXPONENT = 8
+AMOUNT_OVERFLOW = -2 ** 63  # Marker for amounts that do not fit, they are kept in a separate dict.
+DECIMAL_PRECISION = 28  # Precision of the default decimal context.
+
+STRING_COLUMNS = ('type', 'buy_currency', 'sell_currency', 'fee_currency',
+                  'exchange', 'group', 'comment', 'imported_from')
+AMOUNT_COLUMNS = ('buy_amount', 'sell_amount', 'fee_amount')
+
+
+class StringColumn(object):
+    """
+    Dictionary-encoded string column: every distinct string is stored once, rows store codes.
+    """
+
+    def __init__(self, values=None, codes=None):
+        self.values = values if values is not None else []
+        self.codes = codes if codes is not None else array('I')
+        self._index = dict((value, code) for code, value in enumerate(self.values))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, row):
+        return self.values[self.codes[row]]
+
+    def append(self, value):
+        code = self._index.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self._index[value] = code
+        self.codes.append(code)
+
+
+def _scaled_key(value):
+    """
+    Returns a Decimal in units of 10^-AMOUNT_EXPONENT as integer if it is integral in those units.
+    Decimals with more decimal places never equal such an integer.
+    """
+    scaled = value.scaleb(AMOUNT_EXPONENT)
+    if scaled.is_finite() and scaled == scaled.to_integral_value():
+        return int(scaled)
+    return value
+
+
+class AmountColumn(object):
+    """
+    Decimal column stored as scaled integers plus the exponent of the original value, so that values are
+    restored exactly (including their representation). Values that do not fit are kept in `overflow`.
+    """
+
+    def __init__(self, scaled=None, exponents=None, overflow=None):
+        self.scaled = scaled if scaled is not None else array('q')
+        self.exponents = exponents if exponents is not None else array('b')
+        self.overflow = overflow if overflow is not None else {}
+
+    def __len__(self):
+        return len(self.scaled)
+
+    def __getitem__(self, row):
+        value = self.scaled[row]
+        if value == AMOUNT_OVERFLOW:
+            return self.overflow[row]
+        return Decimal(value).scaleb(-AMOUNT_EXPONENT).quantize(Decimal(1).scaleb(self.exponents[row]))
+
+    def append(self, value):
+        _, digits, exponent = value.as_tuple()
+        # Restoring the representation needs all digits within the precision of the default context.
+        if isinstance(exponent, int) and -128 <= exponent <= 127 and len(digits) <= DECIMAL_PRECISION:
+            # Values with more decimal places are scaled too if the extra places are zeros (eg 1.000000000), so
+            # that equal amounts always get equal scaled integers.
+            scaled = value.scaleb(AMOUNT_EXPONENT)
+            if scaled == scaled.to_integral_value() and AMOUNT_OVERFLOW < scaled < 2 ** 63:
+                self.scaled.append(int(scaled))
+                self.exponents.append(exponent)
+                return
+        self.overflow[len(self.scaled)] = value
+        self.scaled.append(AMOUNT_OVERFLOW)
+        self.exponents.append(0)
+
+    def key(self, row):
+        """
+        Returns a value for a row that compares like the Decimal value, see `keys`.
+        """
+        value = self.scaled[row]
+        return _scaled_key(self.overflow[row]) if value == AMOUNT_OVERFLOW else value
+
+    def keys(self):
+        """
+        Returns a sequence of per-row values that compare like the Decimal values. Overflows are scaled like the
+        other rows where possible, so that they can't equal the scaled integer of a different amount.
+        """
+        if not self.overflow:
+            return self.scaled
+        keys = list(self.scaled)
+        for row, value in self.overflow.items():
+            keys[row] = _scaled_key(value)
+        return keys
+
+
+class TradeTable(object):
+    """
+    Column-oriented table of trades.
+    """
+
+    def __init__(self):
+        self.times = array('q')
+        self.imported_times = array('q')
+        self.trade_ids = []
+        self.strings = dict((name, StringColumn()) for name in STRING_COLUMNS)
+        self.amounts = dict((name, AmountColumn()) for name in AMOUNT_COLUMNS)
+        self._hashes = None
+
+    @classmethod
+    def from_dicts(cls, trades, report=None):
+        """
+        Builds a table from trade dicts as exported by cointracking.
+        :param trades: Trade dicts. Fields of the API result that are not trades are skipped.
+        :type trades: iterable<dict>
+        :param report: Collects records that could not be converted. If None, they are logged as warnings.
+        :type report: tools.ConversionReport
+        :rtype: TradeTable
+        """
+        table = cls()
+        for trade in trades:
+            # Strip API returns fields that are not trades (grrrr)
+            if trade == 1 or trade == 'getTrades':
+                continue
+
+            try:
+                table.append(**trade)
+            except Exception as e:
+                if report is None:
+                    log.warning("Exception: %s for trade %s. Unexpected data? Skipping record.", e, trade)
+                    continue
+                report.reject(trade, e)
+            else:
+                if report is not None:
+                    report.converted += 1
+        return table
+
+    @classmethod
+    def from_file(cls, filename, report=None):
+        """
+        Builds a table from a json export, streaming it record by record.
+        :param filename: Filename
+        :type filename: str
+        :param report: Collects records that could not be converted.
+        :type report: tools.ConversionReport
+        :rtype: TradeTable
+        """
+        return cls.from_dicts((trade for key, trade in iter_trade_dicts(filename)), report)
+
+    @classmethod
+    def from_trades(cls, trades):
+        """
+        Builds a table from Trade objects.
+        :type trades: iterable<Trade>
+        :rtype: TradeTable
+        """
+        table = cls()
+        for trade in trades:
+            table._append_values(
+                trade.type, int(trade.time.timestamp()), trade.trade_id,
+                trade.buy_currency, trade.sell_currency, trade.fee_currency,
+                trade.buy_amount, trade.sell_amount, trade.fee_amount,
+                trade.exchange, trade.group, trade.comment, trade.imported_from, int(trade.imported_time.timestamp()))
+        return table
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("row out of range")
+        return TradeRow(self, row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield TradeRow(self, row)
+
+    # noinspection PyShadowingBuiltins
+    def append(self, type, time, trade_id, buy_currency, sell_currency, fee_currency,
+               buy_amount, sell_amount, fee_amount, exchange, group, comment, imported_from, imported_time):
+        """
+        Appends a trade. Takes the same (string) arguments as Trade.
+        """
+        # Parse everything before appending anything so that a bad record does not leave columns out of sync.
+        self._append_values(
+            type.strip(), int(time.strip()), trade_id.strip(),
+            buy_currency.strip(), sell_currency.strip(), fee_currency.strip(),
+            Decimal(buy_amount.strip() or 0), Decimal(sell_amount.strip() or 0), Decimal(fee_amount.strip() or 0),
+            exchange.strip(), group.strip(), comment.strip(), imported_from.strip(), int(imported_time.strip()))
+
+    # noinspection PyShadowingBuiltins
+    def _append_values(self, type, time, trade_id, buy_currency, sell_currency, fee_currency,
+                       buy_amount, sell_amount, fee_amount, exchange, group, comment, imported_from, imported_time):
+        strings = self.strings
+        amounts = self.amounts
+        self.times.append(time)
+        self.imported_times.append(imported_time)
+        self.trade_ids.append(trade_id)
+        strings['type'].append(type)
+        strings['buy_currency'].append(buy_currency)
+        strings['sell_currency'].append(sell_currency)
+        strings['fee_currency'].append(fee_currency)
+        strings['exchange'].append(exchange)
+        strings['group'].append(group)
+        strings['comment'].append(comment)
+        strings['imported_from'].append(imported_from)
+        amounts['buy_amount'].append(buy_amount)
+        amounts['sell_amount'].append(sell_amount)
+        amounts['fee_amount'].append(fee_amount)
+        self._hashes = None
+
+    def _row_keys(self):
+        """
+        Returns an iterator over the keys of all rows, built column-wise from codes and scaled integers.
+        Keys contain the same fields as `Trade.__key()` and are comparable within this table only.
+        """
+        strings = self.strings
+        return zip(self.trade_ids, strings['type'].codes, self.times,
+                   strings['buy_currency'].codes, strings['sell_currency'].codes, strings['fee_currency'].codes,
+                   self.amounts['buy_amount'].keys(), self.amounts['sell_amount'].keys(),
+                   self.amounts['fee_amount'].keys())
+
+    def row_key(self, row):
+        strings = self.strings
+        return (self.trade_ids[row], strings['type'].codes[row], self.times[row],
+                strings['buy_currency'].codes[row], strings['sell_currency'].codes[row],
+                strings['fee_currency'].codes[row],
+                self.amounts['buy_amount'].key(row), self.amounts['sell_amount'].key(row),
+                self.amounts['fee_amount'].key(row))
+
+    def movement_key(self, row):
+        """
+        Returns the key of `find_unmatched_movements.movement_key` for a row, with the net amount as a scaled
+        integer instead of a Decimal. Net amounts that do not fit are Decimals; keys are comparable within this
+        table only.
+        """
+        if self.strings['type'][row] == 'Withdrawal':
+            currency = self.strings['sell_currency'][row]
+            amount, sign = self.amounts['sell_amount'], -1
+        else:
+            currency = self.strings['buy_currency'][row]
+            amount, sign = self.amounts['buy_amount'], 1
+        scaled = amount.scaled[row]
+        fee = self.amounts['fee_amount'].scaled[row]
+        if scaled != AMOUNT_OVERFLOW and fee != AMOUNT_OVERFLOW:
+            return currency, scaled + sign * fee
+        # Net amounts that can be scaled must be, so that equal amounts get equal keys.
+        return currency, _scaled_key(amount[row] + sign * self.amounts['fee_amount'][row])
+
+    def row_hash(self, row):
+        """
+        Returns the hash of a row, which is the same as the hash of the corresponding Trade object.
+        The hashes of all rows are computed at once on first use.
+        """
+        if self._hashes is None:
+            self._hashes = array('q', (hash(TradeRow(self, i).trade_key()) for i in range(len(self))))
+        return self._hashes[row]
+
+    def argsort(self):
+        """
+        Returns the row numbers ordered by time.
+        :rtype: list<int>
+        """
+        return sorted(range(len(self)), key=self.times.__getitem__)
+
+    def sorted_rows(self):
+        """
+        Returns all rows ordered by time, like `sorted(trades)`.
+        :rtype: list<TradeRow>
+        """
+        return [TradeRow(self, row) for row in self.argsort()]
+
+    def list_duplicates(self):
+        """
+        Returns rows whose key already occurred in an earlier row (each duplicated key is reported once).
+        Same semantics as `find_duplicates.list_duplicates`, but hashes integer keys instead of Trade objects.
+        :rtype: list<TradeRow>
+        """
+        seen = set()
+        dupl = set()
+        duplist = []
+        for row, key in enumerate(self._row_keys()):
+            if key in seen and key not in dupl:
+                duplist.append(TradeRow(self, row))
+                dupl.add(key)
+            else:
+                seen.add(key)
+        return duplist
+
+
+class TradeRow(object):
+    """
+    View on a single row of a TradeTable with the same API as Trade.
+    """
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def type(self):
+        return self.table.strings['type'][self.row]
+
+    @property
+    def time(self):
+        return datetime.fromtimestamp(self.table.times[self.row])
+
+    @property
+    def trade_id(self):
+        return self.table.trade_ids[self.row]
+
+    @property
+    def buy_currency(self):
+        return self.table.strings['buy_currency'][self.row]
+
+    @property
+    def sell_currency(self):
+        return self.table.strings['sell_currency'][self.row]
+
+    @property
+    def fee_currency(self):
+        return self.table.strings['fee_currency'][self.row]
+
+    @property
+    def buy_amount(self):
+        return self.table.amounts['buy_amount'][self.row]
+
+    @property
+    def sell_amount(self):
+        return self.table.amounts['sell_amount'][self.row]
+
+    @property
+    def fee_amount(self):
+        return self.table.amounts['fee_amount'][self.row]
+
+    @property
+    def exchange(self):
+        return self.table.strings['exchange'][self.row]
+
+    @property
+    def group(self):
+        return self.table.strings['group'][self.row]
+
+    @property
+    def comment(self):
+        return self.table.strings['comment'][self.row]
+
+    @property
+    def imported_from(self):
+        return self.table.strings['imported_from'][self.row]
+
+    @property
+    def imported_time(self):
+        return datetime.fromtimestamp(self.table.imported_times[self.row])
+
+    def trade_key(self):
+        """
+        Returns the same key as `Trade.__key()`.
+        """
+        return (
+            self.trade_id, self.type, self.time,
+            self.buy_currency, self.sell_currency, self.fee_currency,
+            self.buy_amount, self.sell_amount, self.fee_amount
+        )
+
+    def to_trade(self):
+        """
+        Materializes the row as a Trade object.
+        :rtype: Trade
+        """
+        trade = Trade.__new__(Trade)
+        for key, value in self.to_odict().items():
+            setattr(trade, key, value)
+        return trade
+
+    def __eq__(self, y):
+        if isinstance(y, TradeRow):
+            if y.table is self.table:
+                return self.row == y.row or self.table.row_key(self.row) == self.table.row_key(y.row)
+            return self.trade_key() == y.trade_key()
+        if isinstance(y, Trade):
+            # noinspection PyProtectedMember
+            return self.trade_key() == y._Trade__key()
+        return NotImplemented
+
+    def __hash__(self):
+        return self.table.row_hash(self.row)
+
+    def __repr__(self):
+        return str(self.trade_key())
+
+    def __lt__(self, other):
+        if isinstance(other, TradeRow) and other.table is self.table:
+            return self.table.times[self.row] < self.table.times[other.row]
+        return self.time < other.time
+
+    def __gt__(self, other):
+        if isinstance(other, TradeRow) and other.table is self.table:
+            return self.table.times[self.row] > self.table.times[other.row]
+        return self.time > other.time
+
+    # Allows Trade.__eq__ to compare against rows.
+    _Trade__key = trade_key
+    to_odict = Trade.to_odict
+    __str__ = Trade.__str__
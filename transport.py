@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP transport for the cointracking.info API.
+
+Keeps a persistent, pooled session, limits the request rate on the client side (token bucket) and retries
+throttled or failed requests (including responses that are not json) with exponential backoff. Nonces are
+strictly increasing, also across retries.
+"""
+import hashlib
+import hmac
+import logging
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import profiling
+
+
+log = logging.getLogger(__name__)
+
+# HTTP status codes that mean "try again later".
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TransportError(Exception):
+    """
+    Raised if a request failed even after retrying.
+    """
+    pass
+
+
+class TokenBucket(object):
+    """
+    Client-side rate limiter. Allows bursts of up to `capacity` calls, refilled at `rate` calls per second.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Takes a token, waiting until one is available.
+        @return: number of seconds waited
+        @rtype: float
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            log.debug("Rate limit reached, waiting %.1f seconds", wait)
+            self.sleep(wait)
+            waited += wait
+
+
+class Transport(object):
+    """
+    Signs and sends API calls.
+    """
+
+    def __init__(self, url, key, secret, calls_per_hour=20, burst=None, max_retries=5, backoff=1.0,
+                 max_backoff=60.0, timeout=60, pool_size=10, sleep=time.sleep):
+        """
+        @param url: API url
+        @type url: str
+        @param key: API key
+        @type key: str
+        @param secret: API secret
+        @type secret: bytes
+        @param calls_per_hour: Request quota of the API key.
+        @type calls_per_hour: float
+        @param burst: Number of calls that can be made at once. `None` allows the whole hourly quota.
+        @type burst: int
+        @param max_retries: Number of retries on throttling and transient errors.
+        @type max_retries: int
+        @param backoff: Seconds to wait before the first retry, doubled on every retry.
+        @type backoff: float
+        @param max_backoff: Maximum seconds to wait between retries.
+        @type max_backoff: float
+        @param timeout: Request timeout in seconds.
+        @type timeout: float
+        @param pool_size: Maximum number of pooled connections.
+        @type pool_size: int
+        """
+        self.url = url
+        self.key = key
+        self.secret = secret
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.sleep = sleep
+        self.rate_limiter = TokenBucket(calls_per_hour / 3600.0, burst or calls_per_hour, sleep=sleep)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._nonce = 0
+        self._nonce_lock = threading.Lock()
+
+    def next_nonce(self):
+        """
+        Returns a nonce based on the current time that is larger than all nonces before.
+        """
+        with self._nonce_lock:
+            self._nonce = max(self._nonce + 1, int(time.time() * 1000))
+            return self._nonce
+
+    def _retry_delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), self.max_backoff)
+        return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+    def call(self, api_method, **kwargs):
+        """
+        Calls an API method.
+        @param api_method: Name of the API method, eg `getTrades`.
+        @type api_method: str
+        @param kwargs: Parameters. Parameters that are None are not sent (None would use API default).
+        @return: result as dict
+        @rtype: dict
+        """
+        params = dict((key, value) for key, value in kwargs.items() if value is not None)
+
+        attempt = 0
+        while True:
+            waited = self.rate_limiter.acquire()
+
+            # Every attempt needs a fresh nonce, the API rejects nonces it has seen before.
+            payload = dict(params)
+            payload['method'] = api_method
+            payload['nonce'] = self.next_nonce()
+
+            payload_bytes = urllib.parse.urlencode(payload).encode('utf8')
+            signed_payload = hmac.new(self.secret, payload_bytes, hashlib.sha512).hexdigest()
+
+            headers = {
+                'Key': self.key,
+                'Sign': signed_payload,
+            }
+
+            response = None
+            try:
+                with profiling.stage('transport.http') as stage:
+                    response = self.session.post(self.url, headers=headers, data=payload, timeout=self.timeout)
+                    stage.add(bytes=len(response.content), rate_limit_wait=waited)
+                if response.status_code in RETRY_STATUS_CODES:
+                    error = "HTTP status {}".format(response.status_code)
+                else:
+                    # A body that is not json (eg a truncated response or an error page) is retried as well.
+                    with profiling.stage('transport.json'):
+                        return response.json()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            except ValueError as e:
+                error = "invalid json: {}".format(e)
+
+            if attempt >= self.max_retries:
+                raise TransportError("{} failed after {} retries: {}".format(api_method, attempt, error))
+            delay = self._retry_delay(attempt, response)
+            log.warning("%s failed (%s), retrying in %.1f seconds", api_method, error, delay)
+            profiling.count('api.' + api_method, retries=1)
+            self.sleep(delay)
+            attempt += 1